@@ -1,57 +1,67 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
-import datetime
+import asyncio
 import logging
-import hashlib
+import time
 import uuid
+import shutil
+import tempfile
+import redis
 from optparse import OptionParser
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 
+import codec
+import scoring
 from exceptions import ValidationError
-from utils import alt_name, check_pairs
-from scoring import get_score, get_interests
-from store import RedisStore
+from utils import check_pairs, build_response, request_method, StreamedResponse, stream_response, RetryPolicy
+from scoring import (
+    get_score, get_interests_many, get_score_async, get_interests_many_async, score_key, interests_keys, ScoreLock
+)
+from auth import admin_digest, check_user_token, verify_token
+from sharding import ShardedStore, parse_nodes
+from store import RedisStore, ReplicaRoutedStore, PrefetchedStore, BucketedScoreStore, WriteBehindStore
+from cache import LRUCache, LocalCachedStore, InterestsCache, entry_size, enable_notifications
+from async_store import AsyncRedisStore
+from async_server import AsyncHTTPServer
+from server import run_server, MODES, THREAD, PREFORK
+from logs import AccessLog, setup_logging
+from metrics import REGISTRY, CONTENT_TYPE, REQUESTS, STAGE_LATENCY, MultiprocessMetrics
 from constants import *
 from fields import *
 
 
-class RequestMeta(type):
-    def __init__(cls, name, bases, dct):
-        super().__init__(name, bases, dct)
-        fields = []
-        for name in dir(cls):
-            attr = getattr(cls, name, None)
-            if isinstance(attr, Field):
-                fields.append(name)
-        cls._fields = fields
-
+def compile_validator(fields):
+    """
+    Builds a flat __init__ that cleans every field with one direct call
+    and stores the result in the field's slot.
+    """
+    namespace = {}
+    lines = ['def __init__(self, **kwargs):', '    get = kwargs.get']
+    for i, (name, field) in enumerate(fields.items()):
+        namespace[f'clean_{i}'] = field.clean
+        lines.append(f'    self.{name} = clean_{i}(get({name!r}))')
+    exec('\n'.join(lines), namespace)
+    return namespace['__init__']
 
-class BasicRequest(metaclass=RequestMeta):
-    def __init__(self, **kwargs):
-        self._set_attributes(kwargs)
 
-    def __get__(self, name):
-        if name in self._fields:
-            return getattr(self, alt_name(name))
-        return getattr(self, name)
+class RequestMeta(type):
+    def __new__(mcs, name, bases, dct):
+        own_fields = {key: value for key, value in dct.items() if isinstance(value, Field)}
+        dct = {key: value for key, value in dct.items() if key not in own_fields}
+        dct['__slots__'] = tuple(own_fields)
+        cls = super().__new__(mcs, name, bases, dct)
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, '_fields', {}))
+        fields.update(own_fields)
+        cls._fields = dict(sorted(fields.items()))
+        cls.__init__ = compile_validator(cls._fields)
+        return cls
 
-    def __set__(self, name, value):
-        if name in self._fields:
-            setattr(self, alt_name(name), value)
-        else:
-            setattr(self, name, value)
 
-    def _set_attributes(self, kwargs):
-        cls = type(self)
-        for field in self._fields:
-            value = kwargs.get(field)
-            prop = getattr(cls, field)
-            if not isinstance(prop, Field):
-                raise TypeError(f'Cannot set non-property {field}')
-            prop.validate(value)
-            setattr(self, field, value)
+class BasicRequest(metaclass=RequestMeta):
+    pass
 
 
 class ClientsInterestsRequest(BasicRequest):
@@ -82,75 +92,356 @@ class MethodRequest(BasicRequest):
 
 def check_auth(request):
     if request.is_admin:
-        digest = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).encode()).hexdigest()
-    else:
-        digest = hashlib.sha512((request.account + request.login + SALT).encode()).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+        return verify_token(admin_digest.get(), request.token)
+    return check_user_token(request.account or '', request.login or '', request.token)
+
+
+def clean_online_score_arguments(arguments):
+    user_info = OnlineScoreRequest(**arguments)
+    if not check_pairs(user_info):
+        raise ValidationError('One of pairs (phone-email), (first_name-last_name), (gender-birthday) is missed')
+    return user_info
+
+
+def validate_online_score_request(method_request, ctx):
+    started = time.perf_counter()
+    try:
+        ctx.update({'has': list(method_request.arguments.keys())})
+        user_info = clean_online_score_arguments(method_request.arguments)
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('validate',))
+    return user_info
+
+
+def validate_clients_interests_request(method_request, ctx):
+    started = time.perf_counter()
+    try:
+        user_info = ClientsInterestsRequest(**method_request.arguments)
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('validate',))
+    ctx.update({'nclients': len(user_info.client_ids)})
+    return user_info
+
+
+def score_arguments(user_info):
+    return {
+        'phone': user_info.phone,
+        'email': user_info.email,
+        'birthday': user_info.birthday,
+        'gender': user_info.gender,
+        'first_name': user_info.first_name,
+        'last_name': user_info.last_name,
+    }
 
 
 def online_score_handler(method_request, ctx, store):
     try:
-        user_info = OnlineScoreRequest(**method_request.arguments)
+        user_info = validate_online_score_request(method_request, ctx)
     except ValidationError as e:
-        logging.error(str(e), ctx)
+        logging.error(str(e), extra={'context': ctx})
+        return str(e), INVALID_REQUEST, ctx
+    if method_request.is_admin:
+        return {"score": 42}, OK, ctx
+    started = time.perf_counter()
+    score = get_score(store=store, **score_arguments(user_info))
+    STAGE_LATENCY.observe(time.perf_counter() - started, ('store',))
+    return {"score": score}, OK, ctx
+
+
+async def online_score_handler_async(method_request, ctx, store):
+    try:
+        user_info = validate_online_score_request(method_request, ctx)
+    except ValidationError as e:
+        logging.error(str(e), extra={'context': ctx})
         return str(e), INVALID_REQUEST, ctx
-    ctx.update({'has': list(method_request.arguments.keys())})
-    if not check_pairs(user_info):
-        error_msg = 'One of pairs (phone-email), (first_name-last_name), (gender-birthday) is missed'
-        logging.error(str(error_msg), ctx)
-        return error_msg, INVALID_REQUEST, ctx
     if method_request.is_admin:
         return {"score": 42}, OK, ctx
-    score = get_score(
-        store=store,
-        phone=user_info.phone,
-        email=user_info.email,
-        birthday=user_info.birthday,
-        gender=user_info.gender,
-        first_name=user_info.first_name,
-        last_name=user_info.last_name
-    )
+    started = time.perf_counter()
+    score = await get_score_async(store=store, **score_arguments(user_info))
+    STAGE_LATENCY.observe(time.perf_counter() - started, ('store',))
     return {"score": score}, OK, ctx
 
 
+def stream_interests(store, client_ids):
+    cids = list(dict.fromkeys(client_ids))
+    for i in range(0, len(cids), INTERESTS_CHUNK_SIZE):
+        started = time.perf_counter()
+        chunk = get_interests_many(store, cids[i:i + INTERESTS_CHUNK_SIZE])
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('store',))
+        yield chunk
+
+
 def clients_interests_handler(method_request, ctx, store):
     try:
-        user_info = ClientsInterestsRequest(**method_request.arguments)
+        user_info = validate_clients_interests_request(method_request, ctx)
     except ValidationError as e:
-        logging.error(str(e), ctx)
+        logging.error(str(e), extra={'context': ctx})
         return str(e), INVALID_REQUEST, ctx
-    ctx.update({'nclients': len(user_info.client_ids)})
-    interests = {cid: get_interests(store, cid) for cid in user_info.client_ids}
+    if ctx.get('streaming') and len(user_info.client_ids) >= STREAM_MIN_CLIENTS:
+        return StreamedResponse(stream_interests(store, user_info.client_ids)), OK, ctx
+    started = time.perf_counter()
+    interests = get_interests_many(store, user_info.client_ids)
+    STAGE_LATENCY.observe(time.perf_counter() - started, ('store',))
     return interests, OK, ctx
 
 
-def method_handler(request, ctx, store):
-    response, code = None, OK
+async def clients_interests_handler_async(method_request, ctx, store):
     try:
-        method_request = MethodRequest(**request['body'])
+        user_info = validate_clients_interests_request(method_request, ctx)
     except ValidationError as e:
-        logging.error(str(e), ctx)
+        logging.error(str(e), extra={'context': ctx})
         return str(e), INVALID_REQUEST, ctx
-    if not check_auth(method_request):
-        logging.error('Unauthenticated', ctx)
-        return response, FORBIDDEN, ctx
-
-    if method_request.method == 'online_score':
-        return online_score_handler(method_request, ctx, store)
-    if method_request.method == 'clients_interests':
-        return clients_interests_handler(method_request, ctx, store)
-    else:
-        logging.error('Service not found', ctx)
-        return response, NOT_FOUND, ctx
+    started = time.perf_counter()
+    interests = await get_interests_many_async(store, user_info.client_ids)
+    STAGE_LATENCY.observe(time.perf_counter() - started, ('store',))
+    return interests, OK, ctx
+
+
+METHODS = {
+    'online_score': online_score_handler,
+    'clients_interests': clients_interests_handler,
+}
+
+ASYNC_METHODS = {
+    'online_score': online_score_handler_async,
+    'clients_interests': clients_interests_handler_async,
+}
+
+
+def authorize(request, ctx):
+    """
+    Validates and authenticates a method request.
+    Returns the method request and None, or None and an error response.
+    """
+    started = time.perf_counter()
+    try:
+        method_request = MethodRequest(**request['body'])
+    except ValidationError as e:
+        logging.error(str(e), extra={'context': ctx})
+        return None, (str(e), INVALID_REQUEST, ctx)
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('validate',))
+    ctx['method'] = method_request.method if method_request.method in METHODS else 'unknown'
+    started = time.perf_counter()
+    authenticated = check_auth(method_request)
+    STAGE_LATENCY.observe(time.perf_counter() - started, ('auth',))
+    if not authenticated:
+        logging.error('Unauthenticated', extra={'context': ctx})
+        return None, (None, FORBIDDEN, ctx)
+    return method_request, None
+
+
+def dispatch(method_request, ctx, store):
+    handler = METHODS.get(method_request.method)
+    if handler is None:
+        logging.error('Service not found', extra={'context': ctx})
+        return None, NOT_FOUND, ctx
+    return handler(method_request, ctx, store)
+
+
+def method_handler(request, ctx, store):
+    method_request, error = authorize(request, ctx)
+    if error:
+        return error
+    return dispatch(method_request, ctx, store)
+
+
+def prefetch_keys(method_requests):
+    """
+    Collects store keys the method requests will read. Requests with
+    invalid arguments are skipped, their handlers report the errors.
+    """
+    cache_keys, keys = [], []
+    for method_request in method_requests:
+        try:
+            if method_request.method == 'online_score' and not method_request.is_admin:
+                user_info = OnlineScoreRequest(**method_request.arguments)
+                cache_keys.append(score_key(user_info.phone, user_info.birthday,
+                                            user_info.first_name, user_info.last_name))
+            elif method_request.method == 'clients_interests':
+                user_info = ClientsInterestsRequest(**method_request.arguments)
+                keys.extend(interests_keys(user_info.client_ids)[1])
+        except ValidationError:
+            continue
+    return cache_keys, keys
+
+
+def batch_handler(request, ctx, store):
+    bodies = request['body']
+    if not isinstance(bodies, list):
+        return 'Batch must be a list of method requests', INVALID_REQUEST, ctx
+    if len(bodies) > MAX_BATCH_SIZE:
+        return f'Batch cannot contain more than {MAX_BATCH_SIZE} requests', INVALID_REQUEST, ctx
+    ctx.update({'nrequests': len(bodies)})
+
+    items = []
+    for i, body in enumerate(bodies):
+        item_ctx = {'request_id': f'{ctx["request_id"]}-{i}'}
+        if isinstance(body, dict):
+            method_request, error = authorize({"body": body, "headers": request["headers"]}, item_ctx)
+        else:
+            method_request, error = None, ('Method request must be an object', INVALID_REQUEST, item_ctx)
+        items.append((method_request, error, item_ctx))
+
+    batch_store = PrefetchedStore(store)
+    batch_store.prefetch(*prefetch_keys(method_request for method_request, _, _ in items if method_request))
+    results = []
+    for method_request, error, item_ctx in items:
+        if error:
+            response, code, _ = error
+        else:
+            try:
+                response, code, _ = dispatch(method_request, item_ctx, batch_store)
+            except Exception as e:
+                logging.exception("Unexpected error: %s" % e)
+                response, code = None, INTERNAL_ERROR
+        results.append(build_response(response, code))
+    try:
+        batch_store.flush()
+    except redis.ConnectionError:
+        logging.error('Cannot connect to Redis cache')
+    return results, OK, ctx
+
+
+async def method_handler_async(request, ctx, store):
+    method_request, error = authorize(request, ctx)
+    if error:
+        return error
+    handler = ASYNC_METHODS.get(method_request.method)
+    if handler is None:
+        logging.error('Service not found', extra={'context': ctx})
+        return None, NOT_FOUND, ctx
+    return await handler(method_request, ctx, store)
+
+
+ASYNC_MODE = 'async'
+ASYNC_ROUTER = {
+    "method": method_handler_async
+}
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
+    """
+    Serves HTTP/1.1 persistent connections. A connection is closed after
+    `keep_alive_timeout` seconds of inactivity or after `max_requests`
+    requests, and `timeout` limits how long reading one request may block.
+    On servers that can park idle connections the handler returns as soon
+    as no request is pending, so idle clients do not hold a worker.
+    Request bodies are read into a buffer reused for the whole connection
+    and limited to `max_body_size` bytes. A buffer grown past
+    `max_kept_buffer` bytes is dropped after its request. Large clients_interests responses
+    to HTTP/1.1 clients are streamed with chunked transfer encoding.
+    `/metrics` is rendered by `metrics`, the process registry by default.
+    """
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
     }
-    store = RedisStore()
+    store = None
+    access_log = AccessLog()
+    protocol_version = "HTTP/1.1"
+    timeout = REQUEST_TIMEOUT
+    keep_alive_timeout = KEEP_ALIVE_TIMEOUT
+    max_requests = MAX_KEEP_ALIVE_REQUESTS
+    max_body_size = MAX_BODY_SIZE
+    buffer_size = 4096
+    max_kept_buffer = 64 * 1024
+    metrics = REGISTRY
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+        self.buffer = bytearray(self.buffer_size)
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        self.handle_pending()
+
+    def resume(self):
+        """Serves a parked connection once its client has sent data."""
+        self.handle_one_request()
+        self.handle_pending()
+        self.finish()
+
+    def handle_pending(self):
+        parking = hasattr(self.server, 'park')
+        while not self.close_connection:
+            if parking and not self.has_pending_input():
+                return
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        super().handle_one_request()
+        # a rare large body must not stay allocated while the connection idles
+        if len(self.buffer) > self.max_kept_buffer:
+            self.buffer = bytearray(self.buffer_size)
+
+    def has_pending_input(self):
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def finish(self):
+        # an idle connection keeps its files until the server resumes or closes it
+        if self.close_connection:
+            super().finish()
+
+    def read_body(self, length):
+        if length > len(self.buffer):
+            self.buffer = bytearray(length)
+        view = memoryview(self.buffer)[:length]
+        received = 0
+        while received < length:
+            n = self.rfile.readinto(view[received:])
+            if not n:
+                raise ConnectionError('Connection closed before the request body was read')
+            received += n
+        return view
+
+    def send_head(self, code, content_type, length=None):
+        """
+        Sends the status line and headers, with Content-Length when `length`
+        is given and chunked transfer encoding otherwise.
+        """
+        self.requests_served += 1
+        if self.requests_served >= self.max_requests:
+            self.close_connection = True
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        if length is None:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(length))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def send_payload(self, code, content_type, payload):
+        self.send_head(code, content_type, len(payload))
+        self.wfile.write(payload)
+
+    def send_chunked(self, code, content_type, pieces):
+        """
+        Writes `pieces` as chunks. Returns the number of body bytes sent,
+        or None when producing them failed and the response was cut short.
+        """
+        self.send_head(code, content_type)
+        sent = 0
+        try:
+            for piece in pieces:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(piece), piece))
+                sent += len(piece)
+        except Exception as e:
+            # the status is already sent, only an unterminated body can signal the error
+            logging.exception("Unexpected error while streaming: %s" % e)
+            self.close_connection = True
+            return None
+        self.wfile.write(b'0\r\n\r\n')
+        return sent
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
@@ -158,17 +449,35 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
-        request = None
+        request, data_string = None, b''
+        path = self.path.strip("/")
+        started = time.perf_counter()
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
-        except:
+            length = int(self.headers['Content-Length'])
+            if length < 0:
+                raise ValueError('Negative Content-Length')
+            if length > self.max_body_size:
+                # the body is left unread, so the connection cannot be reused
+                self.close_connection = True
+                code = REQUEST_ENTITY_TOO_LARGE
+            else:
+                data_string = self.read_body(length)
+        except (TypeError, ValueError, ConnectionError):
+            # the rest of the stream cannot be framed, do not reuse it
+            self.close_connection = True
             code = BAD_REQUEST
+        else:
+            if code == OK:
+                try:
+                    request = codec.loads(data_string)
+                except ValueError:
+                    code = BAD_REQUEST
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('parse',))
 
         if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
+                if self.request_version == "HTTP/1.1":
+                    context["streaming"] = True
                 try:
                     response, code, context = self.router[path]({"body": request, "headers": self.headers}, context,
                                                                 self.store)
@@ -178,30 +487,170 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        REQUESTS.inc((request_method(path, self.router, context), code))
+        if isinstance(response, StreamedResponse) and code == OK:
+            sent = self.send_chunked(code, "application/json", stream_response(response, code))
+            summary = f'<streamed {sent} bytes>' if sent is not None else '<stream failed>'
+            self.access_log.log(self.path, code, data_string, summary, context)
+            return
+        started = time.perf_counter()
+        payload = codec.dumps(build_response(response, code))
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('serialize',))
+        self.access_log.log(self.path, code, data_string, payload, context)
+        self.send_payload(code, "application/json", payload)
+
+    def do_GET(self):
+        route = self.path.strip("/")
+        if route == "metrics":
+            code, content_type, payload = OK, CONTENT_TYPE, self.metrics.render()
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode())
-        return
+            code, content_type = NOT_FOUND, "application/json"
+            payload = codec.dumps(build_response(None, NOT_FOUND))
+        self.send_payload(code, content_type, payload)
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-format", action="store", type="choice", choices=("text", "json"), default="text")
+    op.add_option("--log-sync", action="store_true", default=False,
+                  help="write log records on the request thread instead of a background one")
+    op.add_option("--log-sample-rate", action="store", type=float, default=1.0,
+                  help="share of successful requests written to the access log")
+    op.add_option("--log-max-payload", action="store", type=int, default=1024,
+                  help="max bytes of request and response logged, 0 disables payload logging")
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("--max-body-size", action="store", type=int, default=MAX_BODY_SIZE,
+                  help="largest accepted request body in bytes, larger requests get 413")
+    op.add_option("--redis-host", action="store", default="0.0.0.0")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("--redis-socket", action="store", default=None, help="unix socket path, overrides host and port")
+    op.add_option("--redis-nodes", action="store", default=None,
+                  help="comma separated host:port or socket paths of Redis nodes to shard keys over")
+    op.add_option("--redis-replicas", action="store", default=None,
+                  help="comma separated host:port or socket paths of read replicas of the Redis node")
+    op.add_option("--redis-replica-timeout", action="store", type=float, default=0.5,
+                  help="seconds to wait for a replica reply before reading from the primary")
+    op.add_option("--redis-max-connections", action="store", type=int, default=50)
+    op.add_option("--redis-health-check-interval", action="store", type=int, default=30)
+    op.add_option("--local-cache-size", action="store", type=int, default=0,
+                  help="number of scores kept in process in front of Redis, 0 disables the local cache")
+    op.add_option("--local-cache-ttl", action="store", type=int, default=60 * 60,
+                  help="max seconds a score stays in the local cache")
+    op.add_option("--local-cache-fill-ttl", action="store", type=int, default=60,
+                  help="seconds a score read from Redis stays in the local cache, "
+                       "how long it may be served after its Redis key expired")
+    op.add_option("--score-layout", action="store", type="choice", choices=("keys", "buckets"), default="keys",
+                  help="score cache layout: a Redis key per client or compact hash buckets")
+    op.add_option("--score-bucket-bits", action="store", type=int, default=20,
+                  help="log2 of the number of score buckets, aim for about 100 clients per bucket")
+    op.add_option("--score-skip-legacy", action="store_true", default=False,
+                  help="do not fall back to per-client score keys on a bucket miss")
+    op.add_option("--interests-cache-bytes", action="store", type=int, default=0,
+                  help="memory for interests cached in process, kept fresh by keyspace notifications, 0 disables it")
+    op.add_option("--redis-enable-notifications", action="store_true", default=False,
+                  help="turn on the keyspace notifications the interests cache needs with CONFIG SET")
+    op.add_option("--write-behind", action="store_true", default=False,
+                  help="queue score cache writes and send them to Redis in batches from a background thread")
+    op.add_option("--write-behind-queue-size", action="store", type=int, default=10000,
+                  help="max queued cache writes, further writes are dropped")
+    op.add_option("--score-lock-ttl", action="store", type=float, default=0,
+                  help="seconds a Redis lock guards a score cache fill across processes, 0 disables the lock")
+    op.add_option("-m", "--mode", action="store", type="choice", choices=MODES + (ASYNC_MODE,), default=THREAD)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    if opts.mode == ASYNC_MODE and opts.workers != 1:
+        op.error("async mode runs a single event loop, --workers is not supported")
+    if opts.mode == ASYNC_MODE and opts.score_layout == "buckets":
+        op.error("the bucketed score layout is not supported in async mode")
+    if opts.mode == ASYNC_MODE and opts.write_behind:
+        op.error("write-behind is not supported in async mode")
+    if opts.mode == ASYNC_MODE and opts.interests_cache_bytes:
+        op.error("the interests cache is not supported in async mode")
+    if opts.mode == ASYNC_MODE and opts.redis_nodes:
+        op.error("sharding over Redis nodes is not supported in async mode")
+    if opts.redis_nodes and opts.interests_cache_bytes:
+        op.error("the interests cache needs a single Redis node")
+    if opts.redis_replicas and (opts.redis_nodes or opts.interests_cache_bytes or opts.mode == ASYNC_MODE):
+        op.error("read replicas are only supported with a single Redis node, without the interests cache "
+                 "and outside async mode")
+    log_options = {"filename": opts.log, "structured": opts.log_format == "json"}
+    # background log threads do not survive fork, prefork workers start their own
+    listener = setup_logging(queued=not opts.log_sync and opts.mode != PREFORK, **log_options)
+    access_log = AccessLog(opts.log_sample_rate, opts.log_max_payload)
+    MainHTTPHandler.access_log = access_log
+    MainHTTPHandler.max_body_size = opts.max_body_size
+    # every prefork worker counts its own requests, scrapes add up the snapshots of all workers
+    metrics_dir = tempfile.mkdtemp(prefix='scoring-metrics-') if opts.mode == PREFORK else None
+
+    store_options = {
+        "host": opts.redis_host,
+        "port": opts.redis_port,
+        "unix_socket_path": opts.redis_socket,
+        "max_connections": opts.redis_max_connections,
+    }
+
+    def init_worker():
+        MainHTTPHandler.store.reset()
+        worker_listener = setup_logging(queued=not opts.log_sync, **log_options)
+        if metrics_dir:
+            MainHTTPHandler.metrics = MultiprocessMetrics(metrics_dir)
+            MainHTTPHandler.metrics.start()
+
+        def cleanup():
+            MainHTTPHandler.store.close()
+            if metrics_dir:
+                MainHTTPHandler.metrics.stop()
+            if worker_listener:
+                worker_listener.stop()
+        return cleanup
+
+    logging.info("Starting server at %s (%s mode, %s workers)" % (opts.port, opts.mode, opts.workers))
+    if opts.mode == ASYNC_MODE:
+        store = AsyncRedisStore(**store_options)
+        server = AsyncHTTPServer(ASYNC_ROUTER, store, access_log=access_log, max_body_size=opts.max_body_size)
+        asyncio.run(server.serve_forever("localhost", opts.port))
+    else:
+        if opts.score_lock_ttl:
+            scoring.score_lock = ScoreLock(opts.score_lock_ttl)
+        if opts.redis_nodes:
+            MainHTTPHandler.store = ShardedStore({
+                name: RedisStore(health_check_interval=opts.redis_health_check_interval,
+                                 **dict(store_options, **node_options))
+                for name, node_options in parse_nodes(opts.redis_nodes).items()
+            }, workers_per_shard=opts.redis_max_connections)
+        else:
+            redis_store = RedisStore(health_check_interval=opts.redis_health_check_interval, **store_options)
+            MainHTTPHandler.store = redis_store
+            if opts.redis_replicas:
+                # a failed replica read falls back to the primary, retrying it would only add latency
+                replicas = [
+                    RedisStore(health_check_interval=opts.redis_health_check_interval,
+                               socket_timeout=opts.redis_replica_timeout, retry_policy=RetryPolicy(max_retries=0),
+                               **dict(store_options, **node_options))
+                    for node_options in parse_nodes(opts.redis_replicas).values()
+                ]
+                MainHTTPHandler.store = ReplicaRoutedStore(redis_store, replicas)
+        if opts.score_layout == "buckets":
+            MainHTTPHandler.store = BucketedScoreStore(MainHTTPHandler.store, opts.score_bucket_bits,
+                                                       legacy_reads=not opts.score_skip_legacy)
+        if opts.write_behind:
+            MainHTTPHandler.store = WriteBehindStore(MainHTTPHandler.store, opts.write_behind_queue_size)
+        if opts.interests_cache_bytes:
+            if opts.redis_enable_notifications:
+                enable_notifications(redis_store.store)
+            interests_cache = LRUCache(max_size=10 ** 7, ttl=24 * 60 * 60, max_bytes=opts.interests_cache_bytes,
+                                       sizeof=entry_size)
+            MainHTTPHandler.store = InterestsCache(MainHTTPHandler.store, interests_cache)
+            MainHTTPHandler.store.listen(lambda: redis_store.store)
+        if opts.local_cache_size:
+            cache = LRUCache(max_size=opts.local_cache_size, ttl=opts.local_cache_ttl)
+            MainHTTPHandler.store = LocalCachedStore(MainHTTPHandler.store, cache, opts.local_cache_fill_ttl)
+        try:
+            run_server(("localhost", opts.port), MainHTTPHandler, opts.mode, opts.workers, init_worker)
+        finally:
+            if metrics_dir:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
+        MainHTTPHandler.store.close()
+    if listener:
+        listener.stop()
@@ -0,0 +1,145 @@
+import time
+import uuid
+import asyncio
+import logging
+from http import HTTPStatus
+
+import codec
+from constants import (
+    OK, BAD_REQUEST, NOT_FOUND, REQUEST_ENTITY_TOO_LARGE, INTERNAL_ERROR, KEEP_ALIVE_TIMEOUT, MAX_BODY_SIZE
+)
+from exceptions import RequestEntityTooLarge
+from utils import build_response, request_method
+from metrics import REGISTRY, CONTENT_TYPE, REQUESTS, STAGE_LATENCY
+from logs import AccessLog
+from server import STOP_SIGNALS
+
+
+class AsyncHTTPServer:
+    """
+    Minimal HTTP/1.1 server on top of asyncio streams. Every connection is a
+    coroutine, so thousands of keep-alive clients cost no thread each.
+    `router` maps a path to a coroutine with the `method_handler` signature.
+    Requests with bodies longer than `max_body_size` are answered with 413
+    and the connection is closed without reading them.
+    """
+    def __init__(self, router, store, keep_alive_timeout=KEEP_ALIVE_TIMEOUT, access_log=None,
+                 max_body_size=MAX_BODY_SIZE):
+        self.router = router
+        self.store = store
+        self.access_log = access_log or AccessLog()
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_body_size = max_body_size
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve_forever(self, host, port):
+        """
+        Serves until SIGTERM or SIGINT, then closes the store.
+        """
+        server = await self.start(host, port)
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in STOP_SIGNALS:
+            loop.add_signal_handler(signum, stopped.set)
+        try:
+            async with server:
+                await stopped.wait()
+        finally:
+            for signum in STOP_SIGNALS:
+                loop.remove_signal_handler(signum)
+            self.store.close()
+
+    async def read_request(self, reader):
+        request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+        if not request_line:
+            return None
+        command, path, version = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length < 0:
+            raise ValueError('Negative Content-Length')
+        if length > self.max_body_size:
+            raise RequestEntityTooLarge(f'Request body of {length} bytes is too large')
+        body = await reader.readexactly(length)
+        return command, path, version, headers, body
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError as e:
+                    code = REQUEST_ENTITY_TOO_LARGE if isinstance(e, RequestEntityTooLarge) else BAD_REQUEST
+                    payload = codec.dumps(build_response(None, code))
+                    await self.write_response(writer, code, payload, False)
+                    break
+                if request is None:
+                    break
+                command, path, version, headers, body = request
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                content_type = 'application/json'
+                if command == 'POST':
+                    code, payload = await self.dispatch(path, headers, body)
+                elif command == 'GET' and path.strip('/') == 'metrics':
+                    code, content_type, payload = OK, CONTENT_TYPE, REGISTRY.render()
+                else:
+                    code, payload = NOT_FOUND, codec.dumps(build_response(None, NOT_FOUND))
+                await self.write_response(writer, code, payload, keep_alive, content_type)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, path, headers, body):
+        response, code = {}, OK
+        context = {"request_id": headers.get('http_x_request_id', uuid.uuid4().hex)}
+        request = None
+        route = path.strip("/")
+        started = time.perf_counter()
+        try:
+            request = codec.loads(body)
+        except ValueError:
+            code = BAD_REQUEST
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('parse',))
+
+        if request:
+            if route in self.router:
+                try:
+                    response, code, context = await self.router[route](
+                        {"body": request, "headers": headers}, context, self.store
+                    )
+                except Exception as e:
+                    logging.exception("Unexpected error: %s" % e)
+                    code = INTERNAL_ERROR
+            else:
+                code = NOT_FOUND
+
+        started = time.perf_counter()
+        payload = codec.dumps(build_response(response, code))
+        STAGE_LATENCY.observe(time.perf_counter() - started, ('serialize',))
+        REQUESTS.inc((request_method(route, self.router, context), code))
+        self.access_log.log(path, code, body, payload, context)
+        return code, payload
+
+    async def write_response(self, writer, code, payload, keep_alive, content_type='application/json'):
+        head = (
+            f'HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        )
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
@@ -0,0 +1,154 @@
+import asyncio
+import collections
+
+import redis
+
+from utils import async_redis_retry, RetryPolicy, CircuitBreaker
+
+
+def encode_command(*args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, float):
+            data = repr(arg).encode()
+        else:
+            data = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+async def read_reply(reader):
+    line = await reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise redis.ConnectionError('Connection closed by server')
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b'+':
+        return payload
+    if prefix == b'-':
+        return redis.ResponseError(payload.decode())
+    if prefix == b':':
+        return int(payload)
+    if prefix == b'$':
+        length = int(payload)
+        if length == -1:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if prefix == b'*':
+        length = int(payload)
+        if length == -1:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise redis.ConnectionError(f'Unexpected reply from server: {line!r}')
+
+
+class AsyncRedisConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def execute(self, *args):
+        return (await self.execute_many([args]))[0]
+
+    async def execute_many(self, commands):
+        self.writer.write(b''.join(encode_command(*args) for args in commands))
+        await self.writer.drain()
+        # read every reply before raising, so the connection stays in sync
+        replies = [await read_reply(self.reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, redis.ResponseError):
+                raise reply
+        return replies
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncRedisStore:
+    """
+    Asyncio counterpart of RedisStore speaking RESP over a pool of
+    stream connections, so that many requests can wait on Redis at once
+    without holding a thread each.
+    """
+
+    MAX_CONNECTIONS = 64
+    CHUNK_SIZE = 1000
+
+    def __init__(self, host='0.0.0.0', port=6379, db=0, socket_connect_timeout=5, max_connections=MAX_CONNECTIONS,
+                 retry_policy=None, circuit_breaker=None, unix_socket_path=None):
+        self.host = host
+        self.port = port
+        self.unix_socket_path = unix_socket_path
+        self.db = db
+        self.socket_connect_timeout = socket_connect_timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._idle = collections.deque()
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self):
+        if self.unix_socket_path:
+            address, connect = self.unix_socket_path, asyncio.open_unix_connection(self.unix_socket_path)
+        else:
+            address, connect = f'{self.host}:{self.port}', asyncio.open_connection(self.host, self.port)
+        try:
+            reader, writer = await asyncio.wait_for(connect, self.socket_connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise redis.ConnectionError(f'Cannot connect to {address}: {e}')
+        connection = AsyncRedisConnection(reader, writer)
+        if self.db:
+            await connection.execute('SELECT', self.db)
+        return connection
+
+    async def execute(self, *args):
+        return (await self.execute_many([args]))[0]
+
+    async def execute_many(self, commands):
+        """
+        Sends all commands at once over one connection and reads their replies.
+        """
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._connect()
+            try:
+                reply = await connection.execute_many(commands)
+            except redis.ResponseError:
+                self._idle.append(connection)
+                raise
+            except (OSError, asyncio.IncompleteReadError) as e:
+                connection.close()
+                raise redis.ConnectionError(str(e))
+            except BaseException:
+                connection.close()
+                raise
+            self._idle.append(connection)
+            return reply
+
+    @async_redis_retry
+    async def cache_get(self, key):
+        return await self.execute('GET', key)
+
+    @async_redis_retry
+    async def get(self, key):
+        return await self.execute('GET', key)
+
+    @async_redis_retry
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        chunks = await self.execute_many(
+            [('MGET', *keys[i:i + self.CHUNK_SIZE]) for i in range(0, len(keys), self.CHUNK_SIZE)]
+        )
+        return [value for chunk in chunks for value in chunk]
+
+    @async_redis_retry
+    async def cache_set(self, key, value, expire):
+        await self.execute('SET', key, value, 'EX', expire)
+
+    @async_redis_retry
+    async def clear(self):
+        await self.execute('FLUSHDB')
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
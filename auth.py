@@ -0,0 +1,64 @@
+import hmac
+import time
+import hashlib
+import datetime
+
+from cache import LRUCache
+from constants import SALT, ADMIN_SALT
+
+
+MAX_CACHED_KEY_LENGTH = 256
+
+verified_digests = LRUCache(max_size=4096, ttl=24 * 60 * 60)
+
+
+def user_digest(account, login):
+    return hashlib.sha512((account + login + SALT).encode()).hexdigest()
+
+
+def check_user_token(account, login, token):
+    """
+    Verifies a user token. A digest is cached only after a token matched it
+    and only for short account and login names, so invalid requests cannot
+    fill the cache or evict valid entries.
+    """
+    cacheable = len(account) + len(login) <= MAX_CACHED_KEY_LENGTH
+    digest = verified_digests.get((account, login)) if cacheable else None
+    if digest is not None:
+        return verify_token(digest, token)
+    digest = user_digest(account, login)
+    if not verify_token(digest, token):
+        return False
+    if cacheable:
+        verified_digests.set((account, login), digest)
+    return True
+
+
+class AdminDigest:
+    """
+    Admin token digest for the current local hour. It is computed once per
+    hour window and rolled over on the first call after the window ends.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._state = (None, 0)
+
+    def get(self):
+        digest, expires_at = self._state
+        now = self.clock()
+        if now >= expires_at:
+            digest = self.rollover(now)
+        return digest
+
+    def rollover(self, now):
+        hour = datetime.datetime.fromtimestamp(now).replace(minute=0, second=0, microsecond=0)
+        digest = hashlib.sha512((hour.strftime("%Y%m%d%H") + ADMIN_SALT).encode()).hexdigest()
+        self._state = (digest, (hour + datetime.timedelta(hours=1)).timestamp())
+        return digest
+
+
+admin_digest = AdminDigest()
+
+
+def verify_token(digest, token):
+    return hmac.compare_digest(digest.encode(), (token or '').encode())
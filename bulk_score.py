@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline scoring of a JSONL file of `online_score` arguments.
+
+Every input line is validated like an `online_score` request and the valid
+rows of a chunk are scored with one `get_scores` call. The output has one
+JSON object per non-empty input line, in input order, with the input line
+number, the score and an error message for invalid rows. The input is
+read in chunks and only `window` chunks are in flight at a time, so memory
+does not depend on the file size:
+
+    $ python bulk_score.py --input customers.jsonl --output scores.jsonl --workers 8
+"""
+import sys
+import logging
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+import codec
+from api import clean_online_score_arguments, score_arguments
+from exceptions import ValidationError
+from scoring import get_scores
+from store import RedisStore
+
+
+SCORE_COLUMNS = ('phone', 'email', 'birthday', 'gender', 'first_name', 'last_name')
+
+_store = None
+
+
+def init_worker(store_factory):
+    global _store
+    _store = store_factory()
+
+
+def clean_line(line):
+    """
+    Returns the cleaned arguments of one JSONL line and None, or None and an error.
+    """
+    try:
+        arguments = codec.loads(line)
+    except ValueError:
+        return None, 'Invalid JSON'
+    if not isinstance(arguments, dict):
+        return None, 'Arguments must be an object'
+    try:
+        return score_arguments(clean_online_score_arguments(arguments)), None
+    except ValidationError as e:
+        return None, str(e)
+
+
+def score_chunk(chunk, store=None):
+    """
+    Scores `(line number, line)` pairs and returns the encoded output lines.
+    Valid rows of the chunk are scored together with `get_scores`.
+    """
+    store = _store if store is None else store
+    cleaned = [clean_line(line) for _, line in chunk]
+    valid = [arguments for arguments, _ in cleaned if arguments is not None]
+    columns = {name: [arguments[name] for arguments in valid] for name in SCORE_COLUMNS}
+    scores = iter(get_scores(store, **columns) if valid else ())
+    output = []
+    for (number, _), (arguments, error) in zip(chunk, cleaned):
+        score = next(scores) if arguments is not None else None
+        output.append(codec.dumps({'line': number, 'score': score, 'error': error}) + b'\n')
+    return b''.join(output)
+
+
+def read_chunks(lines, chunk_size):
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        chunk.append((number, line))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_score(lines, output, store_factory, workers=1, chunk_size=1000, window=None):
+    """
+    Scores `lines` and writes the results to the binary file `output`.
+    `store_factory` is called once in every worker process to build its
+    store, so it must be picklable. Returns the number of scored lines.
+    """
+    chunks = read_chunks(lines, chunk_size)
+    scored = 0
+    if workers <= 1:
+        store = store_factory()
+        for chunk in chunks:
+            output.write(score_chunk(chunk, store))
+            scored += len(chunk)
+        return scored
+    window = window or 2 * workers
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(store_factory,)) as pool:
+        for chunk in chunks:
+            if len(pending) >= window:
+                output.write(pending.popleft().result())
+            pending.append(pool.submit(score_chunk, chunk))
+            scored += len(chunk)
+        while pending:
+            output.write(pending.popleft().result())
+    return scored
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-i", "--input", action="store", default=None, help="JSONL file with online_score arguments, stdin by default")
+    op.add_option("-o", "--output", action="store", default=None, help="JSONL file for scores, stdout by default")
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("--chunk-size", action="store", type=int, default=1000, help="lines sent to a worker at once")
+    op.add_option("--window", action="store", type=int, default=None,
+                  help="chunks in flight at once, twice the number of workers by default")
+    op.add_option("--redis-host", action="store", default="0.0.0.0")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("--redis-socket", action="store", default=None, help="unix socket path, overrides host and port")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S',
+                        level=logging.INFO)
+    factory = functools.partial(RedisStore, host=opts.redis_host, port=opts.redis_port,
+                                unix_socket_path=opts.redis_socket, max_connections=1)
+    source = open(opts.input, 'rb') if opts.input else sys.stdin.buffer
+    target = open(opts.output, 'wb') if opts.output else sys.stdout.buffer
+    try:
+        total = bulk_score(source, target, factory, opts.workers, opts.chunk_size, opts.window)
+    finally:
+        source.close()
+        target.close()
+    logging.info('Scored %s lines', total)
@@ -0,0 +1,295 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import redis
+
+from store import StoreProxy
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache bounded by number of entries and, with
+    `max_bytes`, by the total `sizeof` of its entries, with per entry
+    expiration. Least recently used entries are evicted when full.
+    """
+    def __init__(self, max_size=10000, ttl=60 * 60, clock=time.monotonic, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value, size = item
+                if expires_at > self.clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.bytes -= size
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = self.clock() + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(key, value) if self.sizeof is not None else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._data[key] = (expires_at, value, size)
+            self.bytes += size
+            while len(self._data) > self.max_size or self.max_bytes is not None and self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.bytes -= item[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class LocalCachedStore(StoreProxy):
+    """
+    Serves `cache_get` from an in-process LRUCache and falls back to the
+    wrapped store on a miss. Entries never outlive the expiry given to
+    `cache_set`. The store does not tell how long a value read from it has
+    left, so such entries are kept only for `fill_ttl` seconds, which bounds
+    how long a value may be served after it expired in the store.
+    """
+    def __init__(self, store, cache=None, fill_ttl=60):
+        super().__init__(store)
+        self.cache = cache if cache is not None else LRUCache()
+        self.fill_ttl = fill_ttl
+
+    def _fill(self, key, value):
+        self.cache.set(key, value, min(self.fill_ttl, self.cache.ttl))
+
+    def cache_get(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            value = self.store.cache_get(key)
+            if value is not None:
+                self._fill(key, value)
+        return value
+
+    def cache_get_many(self, keys):
+        values = [self.cache.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing:
+            fetched = dict(zip(missing, self.store.cache_get_many(missing)))
+            for i, key in enumerate(keys):
+                if values[i] is None and fetched[key] is not None:
+                    values[i] = fetched[key]
+                    self._fill(key, values[i])
+        return values
+
+    def cache_set(self, key, value, expire):
+        self.cache.set(key, value, min(expire, self.cache.ttl))
+        self.store.cache_set(key, value, expire)
+
+    def cache_set_many(self, mapping, expire):
+        for key, value in mapping.items():
+            self.cache.set(key, value, min(expire, self.cache.ttl))
+        self.store.cache_set_many(mapping, expire)
+
+
+# rough per entry overhead of the interests cache: tuple, dict slot and objects
+ENTRY_OVERHEAD = 120
+MISSING = object()
+
+
+def entry_size(key, value):
+    return ENTRY_OVERHEAD + len(key) + (len(value) if value else 0)
+
+
+class InterestsCache(StoreProxy):
+    """
+    Serves `get` and `get_many` of interests keys from an in-process cache
+    bounded in bytes, missing keys included. The cache is only used while
+    `listen` keeps a subscription to keyspace notifications of those keys:
+    every notification drops the key, and the whole cache is dropped when
+    the subscription is (re)established or lost. A value fetched while an
+    invalidation arrived is not cached.
+    """
+    def __init__(self, store, cache=None, prefix='i:'):
+        super().__init__(store)
+        self.cache = cache if cache is not None else LRUCache(
+            max_size=10 ** 7, ttl=24 * 60 * 60, max_bytes=64 * 2 ** 20, sizeof=entry_size
+        )
+        self.prefix = prefix
+        self.active = False
+        self.generation = 0
+        self.listener = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        if not self.active:
+            return self.store.get_many(keys)
+        values = [self.cache.get(key, MISSING) if key.startswith(self.prefix) else MISSING for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is MISSING]
+        if not missing:
+            return values
+        generation = self.generation
+        fetched = dict(zip(missing, self.store.get_many(missing)))
+        with self._lock:
+            if self.active and generation == self.generation:
+                for key, value in fetched.items():
+                    if key.startswith(self.prefix):
+                        self.cache.set(key, value)
+        return [fetched[key] if value is MISSING else value for key, value in zip(keys, values)]
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self.cache.delete(key)
+
+    def invalidate_all(self):
+        with self._lock:
+            self.generation += 1
+            self.cache.clear()
+
+    def handle_notification(self, message):
+        """
+        Applies a redis-py pub/sub message of a keyspace subscription.
+        """
+        if message['type'] == 'psubscribe':
+            self.invalidate_all()
+            self.active = True
+        elif message['type'] == 'pmessage':
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            self.invalidate(channel.split(':', 1)[1])
+
+    def deactivate(self):
+        self.active = False
+        self.invalidate_all()
+
+    def listen(self, client_factory, db=0):
+        """
+        Starts a thread keeping the keyspace subscription; `client_factory`
+        returns the redis.Redis client to subscribe with.
+        """
+        self.listener = KeyspaceListener(self, client_factory, db)
+        self.listener.start()
+
+    def reset(self):
+        self.deactivate()
+        self.store.reset()
+        if self.listener is not None:
+            self.listen(self.listener.client_factory, self.listener.db)
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+        self.deactivate()
+        self.store.close()
+
+
+class KeyspaceListener:
+    """
+    Subscribes to keyspace notifications of the cache's keys and feeds them
+    to it, reconnecting after `reconnect_delay` when the connection drops.
+    Redis must have notify-keyspace-events enabled, see `enable_notifications`.
+    This is checked on every (re)subscription: while Redis does not publish
+    the events the cache stays off and the check is repeated every
+    `recheck_delay` seconds.
+    """
+    def __init__(self, cache, client_factory, db=0, reconnect_delay=1, poll_timeout=1, recheck_delay=30):
+        self.cache = cache
+        self.client_factory = client_factory
+        self.db = db
+        self.pattern = f'__keyspace@{db}__:{cache.prefix}*'
+        self.reconnect_delay = reconnect_delay
+        self.poll_timeout = poll_timeout
+        self.recheck_delay = recheck_delay
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='keyspace-listener', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stopped.is_set():
+            pubsub = None
+            try:
+                client = self.client_factory()
+                pubsub = client.pubsub()
+                pubsub.psubscribe(self.pattern)
+                if not notifications_enabled(client):
+                    self.cache.deactivate()
+                    self._stopped.wait(self.recheck_delay)
+                    continue
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=self.poll_timeout)
+                    if message is not None:
+                        self.cache.handle_notification(message)
+            except redis.RedisError:
+                logging.error('Lost keyspace notifications, interests cache disabled')
+                self.cache.deactivate()
+                self._stopped.wait(self.reconnect_delay)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+        self.cache.deactivate()
+
+
+def notifications_enabled(client):
+    """
+    Tells whether Redis publishes keyspace events for writes and deletions
+    of string keys, logging an error when it does not.
+    """
+    try:
+        flags = client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+    except redis.ResponseError:
+        logging.error('Cannot read notify-keyspace-events, interests cache disabled')
+        return False
+    if 'K' in flags and ('A' in flags or '$' in flags and 'g' in flags):
+        return True
+    logging.error('Redis does not publish keyspace events (notify-keyspace-events is %r), '
+                  'interests cache disabled', flags)
+    return False
+
+
+def enable_notifications(client, flags='K$gxe'):
+    """
+    Adds `flags` to notify-keyspace-events, keeping the ones already set.
+    """
+    try:
+        current = client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        merged = ''.join(sorted(set(current) | set(flags)))
+        client.config_set('notify-keyspace-events', merged)
+    except redis.ResponseError:
+        logging.warning('Cannot enable keyspace notifications, set notify-keyspace-events to %s', flags)
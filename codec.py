@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+JSON codec used for requests, responses and stored values.
+
+The fastest installed backend is picked (orjson, then ujson, then the
+standard library); set SCORING_JSON_BACKEND to force one. `loads` accepts
+str, bytes or memoryview and `dumps` always returns bytes ready to be
+written to a socket. Run this module to compare
+installed backends:
+
+    $ python codec.py --clients 10000
+"""
+import os
+import re
+import json
+import timeit
+from collections import namedtuple
+from optparse import OptionParser
+
+
+BACKEND_ENV = 'SCORING_JSON_BACKEND'
+
+Codec = namedtuple('Codec', ['name', 'loads', 'dumps'])
+
+
+# no integer that fits in 64 bits has 20 digits in a row
+LONG_DIGITS = re.compile(rb'\d{20}')
+LONG_DIGITS_TEXT = re.compile(r'\d{20}')
+
+
+def _orjson():
+    import orjson
+
+    # orjson reads integers wider than 64 bits as floats and cannot write
+    # them, such documents go through the standard library
+    def loads(data):
+        if (LONG_DIGITS_TEXT if isinstance(data, str) else LONG_DIGITS).search(data):
+            return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+        return orjson.loads(data)
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+    return Codec('orjson', loads, dumps)
+
+
+def _ujson():
+    import ujson
+
+    def loads(data):
+        return ujson.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode()
+
+    return Codec('ujson', loads, dumps)
+
+
+def _stdlib():
+    def loads(data):
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+    def dumps(obj):
+        return json.dumps(obj).encode()
+
+    return Codec('json', loads, dumps)
+
+
+BACKENDS = {
+    'orjson': _orjson,
+    'ujson': _ujson,
+    'json': _stdlib,
+}
+
+
+def load_codec(name=None):
+    """
+    Returns the codec of the named backend, or of the first installed one.
+    """
+    if name:
+        return BACKENDS[name]()
+    for factory in BACKENDS.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+
+
+def available_codecs():
+    codecs = []
+    for factory in BACKENDS.values():
+        try:
+            codecs.append(factory())
+        except ImportError:
+            continue
+    return codecs
+
+
+backend = load_codec(os.environ.get(BACKEND_ENV))
+loads = backend.loads
+dumps = backend.dumps
+
+
+def benchmark(payload, number=100):
+    """
+    Seconds per `dumps` and `loads` of `payload` for every installed backend.
+    """
+    results = {}
+    for c in available_codecs():
+        encoded = c.dumps(payload)
+        results[c.name] = {
+            'dumps': timeit.timeit(lambda: c.dumps(payload), number=number) / number,
+            'loads': timeit.timeit(lambda: c.loads(encoded), number=number) / number,
+        }
+    return results
+
+
+def interests_payload(clients):
+    interests = ['cars', 'pets', 'travel', 'hi-tech', 'sport', 'music', 'books', 'tv', 'cinema', 'geek', 'otus']
+    return {
+        'response': {cid: interests[cid % 7:cid % 7 + 3] for cid in range(clients)},
+        'code': 200,
+    }
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-c", "--clients", action="store", type=int, default=10000)
+    op.add_option("-n", "--number", action="store", type=int, default=100)
+    (opts, args) = op.parse_args()
+    print(f'clients_interests response for {opts.clients} clients, default backend: {backend.name}')
+    for name, timings in benchmark(interests_payload(opts.clients), opts.number).items():
+        print(f'{name:<10} dumps {timings["dumps"] * 1000:8.3f} ms  loads {timings["loads"] * 1000:8.3f} ms')
@@ -1,16 +1,25 @@
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
+MAX_BATCH_SIZE = 1000
+KEEP_ALIVE_TIMEOUT = 75
+REQUEST_TIMEOUT = 10
+MAX_KEEP_ALIVE_REQUESTS = 1000
+MAX_BODY_SIZE = 10 * 2 ** 20
+STREAM_MIN_CLIENTS = 1000
+INTERESTS_CHUNK_SIZE = 1000
 OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
 }
@@ -1,4 +1,19 @@
+import redis
+
+
 class ValidationError(Exception):
     """
     Indicates a field value or is invalid.
-    """
\ No newline at end of file
+    """
+
+
+class CircuitOpenError(redis.ConnectionError):
+    """
+    Raised without calling Redis while the circuit breaker is open.
+    """
+
+
+class RequestEntityTooLarge(ValueError):
+    """
+    Raised when a request body is longer than the server accepts.
+    """
@@ -1,4 +1,5 @@
 import datetime
+import functools
 
 from exceptions import ValidationError
 from utils import prettify_dict
@@ -6,6 +7,8 @@ from constants import GENDERS
 
 
 __all__ = [
+    'DateString',
+    'parse_date',
     'Field',
     'CharField',
     'ArgumentsField',
@@ -18,89 +21,126 @@ __all__ = [
 ]
 
 
+DATE_FORMAT = '%d.%m.%Y'
+
+
+class DateString(str):
+    """
+    Canonical DD.MM.YYYY representation of a date, the parsed value is in `date`.
+    """
+    def __new__(cls, date):
+        self = super().__new__(cls, f'{date.day:02}.{date.month:02}.{date.year:04}')
+        self.date = date
+        return self
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(value):
+    try:
+        return DateString(datetime.datetime.strptime(value, DATE_FORMAT).date())
+    except ValueError:
+        raise ValidationError('Incorrect date format, DD.MM.YYYY expected')
+
+
 class Field:
+    """
+    Field validation is split into `check_presence`, applied to every value,
+    and `check`, applied to non-empty values only. Non-empty values are first
+    normalized by `convert`, if a field defines it. These methods of the whole
+    class hierarchy are collected once into a flat `clean` function, which
+    validates a value and returns the normalized one.
+    """
+    convert = None
     def __init__(self, required=False, nullable=False):
         self.required = required
         self.nullable = nullable
+        self.clean = self.compile()
 
-    def validate(self, value):
+    def check_presence(self, value):
         if value is None and self.required:
             raise ValidationError('Field is required')
         if not value and not self.nullable:
             raise ValidationError('Field cannot be empty')
 
+    def compile(self):
+        presence = self.check_presence
+        convert = self.convert
+        checks = tuple(
+            klass.__dict__['check'].__get__(self) for klass in reversed(type(self).__mro__)
+            if 'check' in klass.__dict__
+        )
+
+        def clean(value):
+            presence(value)
+            if value or value is False:
+                if convert is not None:
+                    value = convert(value)
+                for check in checks:
+                    check(value)
+            return value
+
+        return clean
 
-class CharField(Field):
     def validate(self, value):
-        super().validate(value)
-        if value or isinstance(value, bool):
-            if not isinstance(value, str):
-                raise ValidationError('Field is not a string')
+        self.clean(value)
+
+
+class CharField(Field):
+    def check(self, value):
+        if not isinstance(value, str):
+            raise ValidationError('Field is not a string')
 
 
 class ArgumentsField(Field):
-    def validate(self, value):
-        super().validate(value)
-        if value or isinstance(value, bool):
-            if not isinstance(value, dict):
-                raise ValidationError('Field is not a dict')
+    def check(self, value):
+        if not isinstance(value, dict):
+            raise ValidationError('Field is not a dict')
 
 
 class EmailField(CharField):
-    def validate(self, value):
-        super().validate(value)
-        if value or isinstance(value, bool):
-            if not '@' in value:
-                raise ValidationError('No @ in email')
+    def check(self, value):
+        if not '@' in value:
+            raise ValidationError('No @ in email')
 
 
 class PhoneField(Field):
     number_length = 11
 
-    def validate(self, value):
-        super().validate(value)
-        if value or isinstance(value, bool):
-            if not type(value) in (int, str):
-                raise ValidationError('Phone must be a string or number')
-            if len(str(value)) != self.number_length:
-                raise ValidationError(f'Phone length must be {self.number_length}')
-            if not str(value).startswith('7'):
-                raise ValidationError('Phone must start with 7')
+    def check(self, value):
+        if not type(value) in (int, str):
+            raise ValidationError('Phone must be a string or number')
+        if len(str(value)) != self.number_length:
+            raise ValidationError(f'Phone length must be {self.number_length}')
+        if not str(value).startswith('7'):
+            raise ValidationError('Phone must start with 7')
 
 
 class DateField(Field):
-    def validate(self, value):
-        super().validate(value)
-        if value:
-            try:
-                datetime.datetime.strptime(value, '%d.%m.%Y')
-            except ValueError:
-                raise ValidationError('Incorrect date format, DD.MM.YYYY expected')
+    def convert(self, value):
+        if not isinstance(value, str):
+            raise ValidationError('Incorrect date format, DD.MM.YYYY expected')
+        return parse_date(value)
 
 
 class BirthDayField(DateField):
-    def validate(self, value):
-        super().validate(value)
-        if value or isinstance(value, bool):
-            bdate = datetime.datetime.strptime(value, '%d.%m.%Y')
-            if datetime.datetime.now().year - bdate.year > 70:
-                raise ValidationError('The age cannot be greater than 70')
+    def check(self, value):
+        if datetime.date.today().year - value.date.year > 70:
+            raise ValidationError('The age cannot be greater than 70')
 
 
 class GenderField(Field):
-    def validate(self, value):
+    def check_presence(self, value):
         if value is None and self.required:
             raise ValidationError('Field is required')
-        if value or isinstance(value, bool):
-            if not type(value) == int:
-                raise ValidationError('Gender must contain only numbers')
-            if value not in GENDERS:
-                raise ValidationError(f'Gender must contain only numbers from: {prettify_dict(GENDERS)}')
+
+    def check(self, value):
+        if not type(value) == int:
+            raise ValidationError('Gender must contain only numbers')
+        if value not in GENDERS:
+            raise ValidationError(f'Gender must contain only numbers from: {prettify_dict(GENDERS)}')
 
 
 class ClientIDsField(Field):
-    def validate(self, value):
-        super().validate(value)
-        if value or isinstance(value, bool):
-            if not isinstance(value, list) or not all(isinstance(x, int) for x in value):
-                raise ValidationError('Client ids must be a list of integers')
\ No newline at end of file
+    def check(self, value):
+        if not isinstance(value, list) or not all(isinstance(x, int) for x in value):
+            raise ValidationError('Client ids must be a list of integers')
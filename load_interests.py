@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk import of client interests into the store.
+
+Reads a JSONL dump with one `{"cid": 1, "interests": ["cars", "pets"]}`
+object per line, or a CSV dump with `cid` and `interests` columns where
+interests are separated by `;`. Records are written in batches, each batch
+with one pipelined store call. With `--packed` interests are stored as
+indexes into a shared vocabulary instead of JSON lists:
+
+    $ python load_interests.py --input interests.jsonl --batch-size 5000 --packed
+"""
+import io
+import csv
+import sys
+import logging
+from optparse import OptionParser
+
+import codec
+from scoring import VOCABULARY_KEY, MAX_VOCABULARY_SIZE, pack_interests
+from store import RedisStore
+
+
+def read_jsonl(lines):
+    for line in lines:
+        if line.strip():
+            record = codec.loads(line)
+            yield record['cid'], record['interests']
+
+
+def read_csv(lines, separator=';'):
+    for row in csv.DictReader(io.TextIOWrapper(lines, encoding='utf-8', newline='')):
+        interests = row['interests']
+        yield int(row['cid']), interests.split(separator) if interests else []
+
+
+class VocabularyBuilder:
+    """
+    Assigns indexes to interest names, continuing the vocabulary in the store.
+    Interning a name past MAX_VOCABULARY_SIZE raises ValueError, so a batch
+    with such a name fails before any of it is written.
+    """
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.saved = len(self.names)
+
+    def intern(self, name):
+        i = self.index.get(name)
+        if i is None:
+            if len(self.names) >= MAX_VOCABULARY_SIZE:
+                raise ValueError(f'Interests vocabulary is full ({MAX_VOCABULARY_SIZE} names), cannot add {name!r}')
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    @property
+    def changed(self):
+        return len(self.names) > self.saved
+
+
+def encode_batch(batch, vocabulary=None):
+    if vocabulary is None:
+        return {f'i:{cid}': codec.dumps(interests) for cid, interests in batch}
+    return {f'i:{cid}': pack_interests([vocabulary.intern(name) for name in interests]) for cid, interests in batch}
+
+
+def load_interests(store, records, batch_size=1000, packed=False):
+    """
+    Writes `(cid, interests)` records to the store, `batch_size` at a time.
+    New vocabulary names are saved before the values referring to them.
+    Returns the number of written records.
+    """
+    vocabulary = VocabularyBuilder(codec.loads(store.get(VOCABULARY_KEY) or b'[]')) if packed else None
+    written, batch = 0, []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            written += write_batch(store, batch, vocabulary)
+            batch = []
+    if batch:
+        written += write_batch(store, batch, vocabulary)
+    return written
+
+
+def write_batch(store, batch, vocabulary):
+    mapping = encode_batch(batch, vocabulary)
+    if vocabulary is not None and vocabulary.changed:
+        store.set_many({VOCABULARY_KEY: codec.dumps(vocabulary.names)})
+        vocabulary.saved = len(vocabulary.names)
+    store.set_many(mapping)
+    return len(batch)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-i", "--input", action="store", default=None, help="interests dump, stdin by default")
+    op.add_option("-f", "--format", action="store", type="choice", choices=("jsonl", "csv"), default=None,
+                  help="dump format, guessed from the file extension by default")
+    op.add_option("--separator", action="store", default=";", help="separator of interests in CSV dumps")
+    op.add_option("-b", "--batch-size", action="store", type=int, default=1000)
+    op.add_option("--packed", action="store_true", default=False,
+                  help="store interests as vocabulary indexes instead of JSON lists")
+    op.add_option("--redis-host", action="store", default="0.0.0.0")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("--redis-socket", action="store", default=None, help="unix socket path, overrides host and port")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S',
+                        level=logging.INFO)
+    dump_format = opts.format or ('csv' if (opts.input or '').endswith('.csv') else 'jsonl')
+    source = open(opts.input, 'rb') if opts.input else sys.stdin.buffer
+    store = RedisStore(host=opts.redis_host, port=opts.redis_port, unix_socket_path=opts.redis_socket)
+    try:
+        records = read_csv(source, opts.separator) if dump_format == 'csv' else read_jsonl(source)
+        total = load_interests(store, records, opts.batch_size, opts.packed)
+    finally:
+        source.close()
+        store.close()
+    logging.info('Loaded interests of %s clients', total)
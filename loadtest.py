@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load generator for the scoring API.
+
+Replays method requests from a JSONL file (one /method body per line) or a
+generated corpus against a running server and reports throughput, latency
+percentiles and response codes per method. A report can be saved as a
+baseline and later runs compared against it:
+
+    $ python loadtest.py --generate 1000 --concurrency 16 --requests 20000 --save baseline.json
+    $ python loadtest.py --input requests.jsonl --rps 500 --duration 30 --compare baseline.json
+"""
+import json
+import time
+import random
+import threading
+import itertools
+import http.client
+from collections import defaultdict
+from optparse import OptionParser
+
+from auth import user_digest
+
+
+PERCENTILES = (50, 95, 99)
+METRICS = ('rps',) + tuple(f'p{p}' for p in PERCENTILES) + ('max',)
+
+
+def generate_corpus(size, seed=0):
+    rnd = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        account, login = 'horns&hoofs', f'user{rnd.randrange(100)}'
+        if i % 2:
+            method = 'clients_interests'
+            arguments = {'client_ids': rnd.sample(range(1000), rnd.randint(1, 20))}
+        else:
+            method = 'online_score'
+            arguments = {
+                'phone': f'7{rnd.randrange(10 ** 10):010}',
+                'email': f'{login}@otus.ru',
+                'first_name': login,
+                'last_name': 'Ivanov',
+                'birthday': f'{rnd.randint(1, 28):02}.{rnd.randint(1, 12):02}.{rnd.randint(1960, 2010)}',
+                'gender': rnd.choice([0, 1, 2]),
+            }
+        corpus.append({
+            'account': account,
+            'login': login,
+            'method': method,
+            'token': user_digest(account, login),
+            'arguments': arguments,
+        })
+    return corpus
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0
+    rank = max(int(round(p / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class LoadRunner:
+    """
+    Sends requests from `corpus` with `concurrency` threads, each keeping
+    its own connection. With `rps` set, requests are started on a fixed
+    schedule and latency is measured from the scheduled start, so a slow
+    server is not hidden by the generator backing off.
+    """
+    def __init__(self, host, port, corpus, concurrency=1, rps=None, path='/method/', timeout=10):
+        self.host = host
+        self.port = port
+        self.corpus = corpus
+        self.concurrency = concurrency
+        self.rps = rps
+        self.path = path
+        self.timeout = timeout
+        self.results = []
+        self._lock = threading.Lock()
+
+    def run(self, requests=None, duration=None):
+        counter = itertools.count()
+        started = time.perf_counter()
+        deadline = started + duration if duration else None
+        threads = [
+            threading.Thread(target=self.worker, args=(counter, started, requests, deadline))
+            for _ in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.results, time.perf_counter() - started
+
+    def worker(self, counter, started, requests, deadline):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        results = []
+        try:
+            for i in counter:
+                if requests is not None and i >= requests:
+                    break
+                scheduled = started + i / self.rps if self.rps else time.perf_counter()
+                if deadline is not None and scheduled >= deadline:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                body = self.corpus[i % len(self.corpus)]
+                code = self.send(conn, body)
+                results.append((body.get('method', 'unknown'), code, time.perf_counter() - scheduled))
+        finally:
+            conn.close()
+            with self._lock:
+                self.results.extend(results)
+
+    def send(self, conn, body):
+        try:
+            conn.request('POST', self.path, json.dumps(body), {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            return 'error'
+        try:
+            return json.loads(data).get('code', response.status)
+        except ValueError:
+            return response.status
+
+
+def summarize(results, elapsed):
+    by_method = defaultdict(list)
+    for method, code, latency in results:
+        by_method[method].append((code, latency))
+        by_method['total'].append((code, latency))
+    report = {}
+    for method, items in sorted(by_method.items()):
+        latencies = sorted(latency for _, latency in items)
+        codes = defaultdict(int)
+        for code, _ in items:
+            codes[str(code)] += 1
+        stats = {'requests': len(items), 'rps': len(items) / elapsed if elapsed else 0}
+        for p in PERCENTILES:
+            stats[f'p{p}'] = percentile(latencies, p)
+        stats['max'] = latencies[-1]
+        stats['codes'] = dict(sorted(codes.items()))
+        report[method] = stats
+    return report
+
+
+def format_report(report):
+    lines = [f'{"method":<20}{"requests":>10}{"rps":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}  codes']
+    for method, stats in report.items():
+        lines.append(
+            f'{method:<20}{stats["requests"]:>10}{stats["rps"]:>10.1f}'
+            + ''.join(f'{stats[f"p{p}"] * 1000:>10.2f}' for p in PERCENTILES)
+            + f'{stats["max"] * 1000:>10.2f}  '
+            + ', '.join(f'{code}: {count}' for code, count in stats['codes'].items())
+        )
+    return '\n'.join(lines)
+
+
+def compare(report, baseline):
+    """
+    Relative change of every metric against the baseline, in percent.
+    """
+    diff = {}
+    for method, stats in report.items():
+        if method not in baseline:
+            continue
+        diff[method] = {}
+        for metric in METRICS:
+            before = baseline[method][metric]
+            diff[method][metric] = (stats[metric] - before) / before * 100 if before else 0
+    return diff
+
+
+def format_comparison(diff):
+    lines = [f'{"method":<20}' + ''.join(f'{metric:>10}' for metric in METRICS)]
+    for method, stats in diff.items():
+        lines.append(f'{method:<20}' + ''.join(f'{stats[metric]:>+9.1f}%' for metric in METRICS))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--host", action="store", default="localhost")
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-i", "--input", action="store", default=None, help="JSONL file with one method request per line")
+    op.add_option("-g", "--generate", action="store", type=int, default=1000,
+                  help="size of generated corpus, used when no input is given")
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-r", "--rps", action="store", type=float, default=None, help="target request rate")
+    op.add_option("-n", "--requests", action="store", type=int, default=None)
+    op.add_option("-d", "--duration", action="store", type=float, default=None, help="seconds")
+    op.add_option("--save", action="store", default=None, help="save report as JSON baseline")
+    op.add_option("--compare", action="store", default=None, help="JSON baseline to compare with")
+    (opts, args) = op.parse_args()
+    if opts.requests is None and opts.duration is None:
+        opts.requests = 10000
+
+    corpus = load_corpus(opts.input) if opts.input else generate_corpus(opts.generate)
+    runner = LoadRunner(opts.host, opts.port, corpus, opts.concurrency, opts.rps)
+    results, elapsed = runner.run(opts.requests, opts.duration)
+    report = summarize(results, elapsed)
+    print(format_report(report))
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if opts.compare:
+        with open(opts.compare) as f:
+            print()
+            print(format_comparison(compare(report, json.load(f))))
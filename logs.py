@@ -0,0 +1,95 @@
+import json
+import queue
+import random
+import logging
+import logging.handlers
+
+
+TEXT_FORMAT = '[%(asctime)s] %(levelname).1s %(message)s'
+DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Plain text format with the record context, if any, appended to the message.
+    """
+    def __init__(self):
+        super().__init__(TEXT_FORMAT, DATE_FORMAT)
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        context = getattr(record, 'context', None)
+        return f'{message} {context}' if context else message
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line with the record context merged into it.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, DATE_FORMAT),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging(filename=None, level=logging.INFO, structured=False, queued=True):
+    """
+    Configures the root logger, replacing its handlers. With `queued` the
+    calling thread only puts records on a queue and a background listener
+    writes them; the returned listener should be stopped on shutdown to flush it.
+    """
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if structured else TextFormatter())
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers.clear()
+    if not queued:
+        root.addHandler(handler)
+        return None
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
+
+
+def truncate(payload, limit):
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        if len(payload) <= limit:
+            return bytes(payload).decode('utf-8', 'replace')
+        return bytes(payload[:limit]).decode('utf-8', 'ignore') + f'... ({len(payload)} bytes)'
+    payload = str(payload)
+    if len(payload) <= limit:
+        return payload
+    return payload[:limit] + f'... ({len(payload)} chars)'
+
+
+class AccessLog:
+    """
+    Access log of served requests. Error responses are always logged,
+    successful ones with probability `sample_rate`. Request and response
+    payloads are cut to `max_payload` bytes.
+    """
+    def __init__(self, sample_rate=1.0, max_payload=1024, logger=None):
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload
+        self.logger = logger or logging.getLogger('access')
+
+    def log(self, path, code, request_body, response_body, context):
+        if code < 400 and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        context = dict(context, path=path, code=code)
+        if self.max_payload:
+            context['request'] = truncate(request_body, self.max_payload)
+            context['response'] = truncate(response_body, self.max_payload)
+        self.logger.info('%s %s', path, code, extra={'context': context})
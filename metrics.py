@@ -0,0 +1,226 @@
+import os
+import json
+import bisect
+import logging
+import threading
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """
+    Values are kept in per-thread shards, so updates never take a lock:
+    a thread only writes its own shard and shards are summed on render.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _merged(self):
+        raise NotImplementedError
+
+    def _labels(self, labels, extra=''):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def merge(self, merged, other):
+        """
+        Adds the merged values `other` of the same metric to `merged`.
+        """
+        raise NotImplementedError
+
+    def render(self, merged=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples(self._merged() if merged is None else merged))
+        return lines
+
+    def _samples(self, merged):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._merged().get(labels, 0)
+
+    def _merged(self):
+        merged = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            self.merge(merged, dict(shard))
+        return merged
+
+    def merge(self, merged, other):
+        for labels, value in other.items():
+            merged[labels] = merged.get(labels, 0) + value
+
+    def _samples(self, merged):
+        return [f'{self.name}{self._labels(labels)} {value}' for labels, value in sorted(merged.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # bucket counts, +Inf bucket, sum
+            state = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def _merged(self):
+        merged = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            self.merge(merged, dict(shard))
+        return merged
+
+    def merge(self, merged, other):
+        for labels, state in other.items():
+            total = merged.setdefault(labels, [0] * len(state[:-1]) + [0.0])
+            for i, value in enumerate(list(state)):
+                total[i] += value
+
+    def count(self, labels=()):
+        state = self._merged().get(labels)
+        return sum(state[:-1]) if state else 0
+
+    def _samples(self, merged):
+        lines = []
+        for labels, state in sorted(merged.items()):
+            cumulative = 0
+            for bound, value in zip(self.buckets + ('+Inf',), state):
+                cumulative += value
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{self._labels(labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {state[-1]}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def snapshot(self):
+        return {metric.name: metric._merged() for metric in self.metrics}
+
+    def render(self, snapshots=()):
+        """
+        Renders the metrics with the values of `snapshots` of other
+        processes added to the ones of this process.
+        """
+        lines = []
+        for metric in self.metrics:
+            merged = metric._merged()
+            for snapshot in snapshots:
+                metric.merge(merged, snapshot.get(metric.name, {}))
+            lines.extend(metric.render(merged))
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class MultiprocessMetrics:
+    """
+    Shares the metrics of prefork workers through files in `directory`.
+    Every worker writes a snapshot of its registry there every `interval`
+    seconds and the worker answering a scrape adds the snapshots of all the
+    others to its own values, so a scrape lags by at most `interval`.
+    Snapshots of stopped workers are kept, so that counters never go back.
+    """
+    def __init__(self, directory, registry=None, interval=1):
+        self.directory = directory
+        self.registry = REGISTRY if registry is None else registry
+        self.interval = interval
+        self.path = os.path.join(directory, f'{os.getpid()}.json')
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                logging.exception('Cannot write metrics snapshot')
+
+    def write(self):
+        snapshot = {
+            name: [[list(labels), value] for labels, value in merged.items()]
+            for name, merged in self.registry.snapshot().items()
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+    def others(self):
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if not filename.endswith('.json') or path == self.path:
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            snapshots.append({
+                name: {tuple(labels): value for labels, value in items} for name, items in snapshot.items()
+            })
+        return snapshots
+
+    def render(self):
+        return self.registry.render(self.others())
+
+
+REGISTRY = Registry()
+
+REQUESTS = Counter('scoring_requests_total', 'Served requests by method and response code.', ('method', 'code'))
+STAGE_LATENCY = Histogram('scoring_stage_seconds', 'Time spent in request processing stages.', ('stage',))
+SCORE_CACHE = Counter('scoring_score_cache_total', 'Score cache lookups by result.', ('result',))
+REDIS_LATENCY = Histogram('scoring_redis_seconds', 'Latency of Redis store calls, retries included.', ('operation',))
+REDIS_RETRIES = Counter('scoring_redis_retries_total', 'Retried Redis store calls.', ('operation',))
+WRITE_BEHIND = Counter('scoring_write_behind_total', 'Write-behind cache writes by result.', ('result',))
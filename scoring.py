@@ -1,26 +1,35 @@
+import time
+import uuid
+import struct
 import logging
 import hashlib
-import json
+import threading
+from array import array
+
 import redis
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+import codec
+from utils import SingleFlight
+from metrics import SCORE_CACHE
+
+
+def score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or '',
         last_name or '',
         str(phone) or '',
         birthday or '',
     ]
-    key = 'uid:' + hashlib.md5(''.join(key_parts).encode()).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
+    return 'uid:' + hashlib.md5(''.join(key_parts).encode()).hexdigest()
+
+
+def compute_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
     score = 0
-    try:
-        score = store.cache_get(key) or score
-    except redis.ConnectionError:
-        logging.error('Cannot connect to Redis cache')
-    if score:
-        return score
     if phone:
         score += 1.5
     if email:
@@ -29,11 +38,264 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score, 60 * 60)
     return score
 
 
+class ScoreLock:
+    """
+    Cross-process lock around filling a score cache key, kept in the store
+    with SET NX for `ttl` seconds. Callers that do not get it poll the cache
+    for the holder's result and compute the score themselves if it does not
+    show up before the lock expires.
+    """
+    def __init__(self, ttl=5, poll_interval=0.01, sleep=time.sleep, clock=time.monotonic):
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.sleep = sleep
+        self.clock = clock
+
+    def run(self, store, key, fill):
+        lock_key, token = f'lock:{key}', uuid.uuid4().hex
+        try:
+            acquired = store.acquire_lock(lock_key, token, self.ttl)
+        except redis.ConnectionError:
+            return fill()
+        if acquired:
+            try:
+                return fill()
+            finally:
+                try:
+                    store.release_lock(lock_key, token)
+                except redis.ConnectionError:
+                    pass
+        deadline = self.clock() + self.ttl
+        while self.clock() < deadline:
+            self.sleep(self.poll_interval)
+            try:
+                score = store.cache_get(key)
+            except redis.ConnectionError:
+                break
+            if score:
+                return float(score)
+        return fill()
+
+
+# concurrent misses of a key in this process compute it once;
+# set `score_lock` to a ScoreLock to coalesce them across processes too
+score_flight = SingleFlight()
+score_lock = None
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(phone, birthday, first_name, last_name)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    score = None
+    try:
+        score = store.cache_get(key)
+    except redis.ConnectionError:
+        logging.error('Cannot connect to Redis cache')
+    if score:
+        SCORE_CACHE.inc(('hit',))
+        return float(score)
+
+    def fill():
+        score = compute_score(phone, email, birthday, gender, first_name, last_name)
+        # cache for 60 minutes
+        try:
+            store.cache_set(key, score, 60 * 60)
+        except redis.ConnectionError:
+            logging.error('Cannot connect to Redis cache')
+        return score
+
+    lock = score_lock
+    score, shared = score_flight.do(key, fill if lock is None else lambda: lock.run(store, key, fill))
+    SCORE_CACHE.inc(('shared',) if shared else ('miss',))
+    return score
+
+
+def presence(column, rows):
+    """
+    Truthiness flags of the given rows of a column; a missing column is all False.
+    """
+    if column is None:
+        return [False] * len(rows)
+    return [bool(column[i]) for i in rows]
+
+
+def compute_scores(phone, email, birthday_gender, names):
+    """
+    Vectorized `compute_score` over columns of presence flags.
+    Uses NumPy when it is installed and a typed array otherwise.
+    """
+    if numpy is not None:
+        scores = (
+            1.5 * numpy.asarray(phone, dtype=bool)
+            + 1.5 * numpy.asarray(email, dtype=bool)
+            + 1.5 * numpy.asarray(birthday_gender, dtype=bool)
+            + 0.5 * numpy.asarray(names, dtype=bool)
+        )
+        return scores.tolist()
+    return array('d', (
+        1.5 * p + 1.5 * e + 1.5 * bg + 0.5 * n for p, e, bg, n in zip(phone, email, birthday_gender, names)
+    )).tolist()
+
+
+def get_scores(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    """
+    Scores of many clients given as columns of equal length, same results as
+    calling `get_score` for every row in order. Cached scores are fetched with one
+    `cache_get_many` call and the missing ones computed in one pass and
+    stored with one `cache_set_many` call. Missing columns are all None.
+    """
+    size = len(phone)
+    columns = [c if c is not None else [None] * size for c in (birthday, first_name, last_name)]
+    keys = [score_key(*row) for row in zip(phone, *columns)]
+    cached = [None] * size
+    try:
+        cached = store.cache_get_many(keys)
+    except redis.ConnectionError:
+        logging.error('Cannot connect to Redis cache')
+    missing = [i for i, value in enumerate(cached) if not value]
+    SCORE_CACHE.inc(('hit',), size - len(missing))
+    SCORE_CACHE.inc(('miss',), len(missing))
+    scores = [float(value) if value else None for value in cached]
+    if not missing:
+        return scores
+    has_birthday, has_gender, has_first, has_last = (
+        presence(column, missing) for column in (birthday, gender, first_name, last_name)
+    )
+    computed = compute_scores(
+        presence(phone, missing),
+        presence(email, missing),
+        [b and g for b, g in zip(has_birthday, has_gender)],
+        [f and l for f, l in zip(has_first, has_last)],
+    )
+    # an empty profile scores int 0 like in `compute_score`, and rows
+    # sharing a key get the first row's score as a cache hit would
+    mapping = {}
+    for i, score in zip(missing, computed):
+        key = keys[i]
+        if key in mapping:
+            scores[i] = float(mapping[key])
+        else:
+            scores[i] = mapping[key] = score or 0
+    try:
+        store.cache_set_many(mapping, 60 * 60)
+    except redis.ConnectionError:
+        logging.error('Cannot connect to Redis cache')
+    return scores
+
+
+async def get_score_async(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(phone, birthday, first_name, last_name)
+    score = None
+    try:
+        score = await store.cache_get(key)
+    except redis.ConnectionError:
+        logging.error('Cannot connect to Redis cache')
+    if score:
+        SCORE_CACHE.inc(('hit',))
+        return float(score)
+    SCORE_CACHE.inc(('miss',))
+    score = compute_score(phone, email, birthday, gender, first_name, last_name)
+    try:
+        await store.cache_set(key, score, 60 * 60)
+    except redis.ConnectionError:
+        logging.error('Cannot connect to Redis cache')
+    return score
+
+
+VOCABULARY_KEY = 'interests:vocabulary'
+# first byte of packed interests, JSON values never start with it
+PACKED = b'\x00'
+# packed indexes are uint16, so the vocabulary holds at most this many names
+MAX_VOCABULARY_SIZE = 1 << 16
+
+
+def pack_interests(ids):
+    """
+    Packs vocabulary indexes of interests as a marker byte and uint16 values.
+    """
+    return PACKED + struct.pack(f'<{len(ids)}H', *ids)
+
+
+def unpack_interests(value):
+    """
+    Vocabulary indexes of packed interests, None for values in other formats.
+    """
+    if not isinstance(value, bytes) or value[:1] != PACKED:
+        return None
+    return struct.unpack(f'<{(len(value) - 1) // 2}H', value[1:])
+
+
+class InterestsVocabulary:
+    """
+    Interest names of the packed format in index order, kept in the store
+    as a JSON list under VOCABULARY_KEY. The list only grows, so the copy
+    cached here is reloaded only when a value refers past its end.
+    """
+    def __init__(self):
+        self.names = []
+        self._lock = threading.Lock()
+
+    def needs_reload(self, packed):
+        size = len(self.names)
+        return any(ids and max(ids) >= size for ids in packed)
+
+    def load(self, raw):
+        names = codec.loads(raw) if raw else []
+        with self._lock:
+            if len(names) > len(self.names):
+                self.names = names
+
+    def decode(self, value, ids):
+        if ids is None:
+            return codec.loads(value) if value else []
+        names = self.names
+        return [names[i] for i in ids if i < len(names)]
+
+
+interests_vocabulary = InterestsVocabulary()
+
+
+def decode_interests(store, values):
+    packed = [unpack_interests(value) for value in values]
+    if interests_vocabulary.needs_reload(packed):
+        interests_vocabulary.load(store.get(VOCABULARY_KEY))
+    return [interests_vocabulary.decode(value, ids) for value, ids in zip(values, packed)]
+
+
+async def decode_interests_async(store, values):
+    packed = [unpack_interests(value) for value in values]
+    if interests_vocabulary.needs_reload(packed):
+        interests_vocabulary.load(await store.get(VOCABULARY_KEY))
+    return [interests_vocabulary.decode(value, ids) for value, ids in zip(values, packed)]
+
+
 def get_interests(store, cid):
-    r = store.get(f'i:{cid}')
-    return json.loads(r) if r else []
+    return decode_interests(store, [store.get(f'i:{cid}')])[0]
+
+
+async def get_interests_async(store, cid):
+    return (await decode_interests_async(store, [await store.get(f'i:{cid}')]))[0]
+
+
+def interests_keys(cids):
+    cids = list(dict.fromkeys(cids))
+    return cids, [f'i:{cid}' for cid in cids]
+
+
+def get_interests_many(store, cids):
+    """
+    Fetches interests of all clients with one bulk store call.
+    Duplicated ids are fetched once. Values are JSON lists or packed
+    vocabulary indexes, see `pack_interests`.
+    """
+    cids, keys = interests_keys(cids)
+    return dict(zip(cids, decode_interests(store, store.get_many(keys))))
+
+
+async def get_interests_many_async(store, cids):
+    cids, keys = interests_keys(cids)
+    return dict(zip(cids, await decode_interests_async(store, await store.get_many(keys))))
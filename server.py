@@ -0,0 +1,264 @@
+import os
+import signal
+import socket
+import time
+import logging
+import selectors
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+
+THREAD = 'thread'
+PREFORK = 'prefork'
+MODES = (THREAD, PREFORK)
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTP server handling connections in a bounded pool of worker threads.
+    When every worker is busy the accept loop waits, so pending clients
+    queue up in the listen backlog instead of in memory.
+
+    A handler may return with `close_connection` unset and a `resume`
+    method instead of blocking its worker while a keep-alive connection is
+    idle. Such connections are parked: a selector thread watches them and
+    hands them back to the pool when the client sends data. They are
+    closed after `keep_alive_timeout` seconds of inactivity.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=1, bind_and_activate=True):
+        self.workers = workers
+        self.keep_alive_timeout = getattr(handler_class, 'keep_alive_timeout', None)
+        self._slots = threading.BoundedSemaphore(workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http-worker')
+        self._selector = selectors.DefaultSelector()
+        self._parked = {}
+        self._parking = []
+        self._parking_lock = threading.Lock()
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._closed = False
+        self._watcher = threading.Thread(target=self._watch, name='http-keep-alive', daemon=True)
+        self._watcher.start()
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self._executor.submit(self.process_request_thread, request, client_address)
+        except RuntimeError:
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            handler = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+        else:
+            self._keep_or_close(handler)
+        finally:
+            self._slots.release()
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def resume(self, handler):
+        try:
+            handler.resume()
+        except Exception:
+            self.handle_error(handler.connection, handler.client_address)
+            self.shutdown_request(handler.connection)
+        else:
+            self._keep_or_close(handler)
+
+    def _keep_or_close(self, handler):
+        if getattr(handler, 'close_connection', True):
+            self.shutdown_request(handler.connection)
+        elif not self.park(handler):
+            self._close_parked(handler)
+
+    def park(self, handler):
+        """
+        Hands an idle keep-alive connection over to the selector thread.
+        Returns False when the server is closing.
+        """
+        with self._parking_lock:
+            if self._closed:
+                return False
+            self._parked[handler.connection] = (handler, time.monotonic())
+            self._parking.append(handler.connection)
+        self._waker.send(b'\0')
+        return True
+
+    def _watch(self):
+        while not self._closed:
+            for key, _ in self._selector.select(timeout=1):
+                if key.fileobj is self._wakeup:
+                    self._register_parked()
+                    continue
+                self._selector.unregister(key.fileobj)
+                with self._parking_lock:
+                    handler, _ = self._parked.pop(key.fileobj)
+                try:
+                    self._executor.submit(self.resume, handler)
+                except RuntimeError:
+                    self._close_parked(handler)
+            self._expire_parked()
+
+    def _register_parked(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._parking_lock:
+            parking, self._parking = self._parking, []
+        for request in parking:
+            self._selector.register(request, selectors.EVENT_READ)
+
+    def _expire_parked(self):
+        if self.keep_alive_timeout is None:
+            return
+        deadline = time.monotonic() - self.keep_alive_timeout
+        with self._parking_lock:
+            expired = [handler for handler, parked_at in self._parked.values()
+                       if parked_at < deadline and handler.connection not in self._parking]
+            for handler in expired:
+                del self._parked[handler.connection]
+        for handler in expired:
+            self._selector.unregister(handler.connection)
+            self._close_parked(handler)
+
+    def _close_parked(self, handler):
+        handler.close_connection = True
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.connection)
+
+    def server_close(self):
+        super().server_close()
+        with self._parking_lock:
+            self._closed = True
+            parked = list(self._parked.values())
+            self._parked.clear()
+        self._waker.send(b'\0')
+        self._watcher.join()
+        for handler, _ in parked:
+            self._close_parked(handler)
+        self._executor.shutdown(wait=True)
+        self._selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+
+class ReusePortHTTPServer(ThreadPoolHTTPServer):
+    """
+    HTTP server binding its socket with SO_REUSEPORT, so that several
+    processes can listen on the same port and the kernel balances
+    incoming connections between them.
+    """
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def handle_stop_signals(stop):
+    """
+    Calls `stop` on SIGTERM and SIGINT. The handlers stay installed, so
+    cleanup after a stop is not cut short by a second signal.
+    """
+    if threading.current_thread() is threading.main_thread():
+        for signum in STOP_SIGNALS:
+            signal.signal(signum, lambda signum, frame: stop())
+
+
+def serve(server):
+    """
+    Serves until SIGTERM or SIGINT, then lets running requests finish.
+    """
+    handle_stop_signals(lambda: threading.Thread(target=server.shutdown, daemon=True).start())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def _signal_children(children, signum):
+    for pid in children:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def serve_prefork(server_address, handler_class, workers, init_worker=None, grace_period=30):
+    """
+    Fork `workers` processes, each one with its own listening socket on the
+    same address. `init_worker` is called in every child right after fork
+    and should re-create per-process resources such as store connections.
+    It may return a callable to run when the worker stops.
+    On SIGTERM or SIGINT the children are sent SIGTERM and given
+    `grace_period` seconds to finish their requests and cleanup before
+    they are killed.
+    """
+    children = set()
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code, cleanup = 0, None
+            try:
+                if init_worker is not None:
+                    cleanup = init_worker()
+                serve(ReusePortHTTPServer(server_address, handler_class))
+            except Exception:
+                logging.exception('Worker %s crashed', os.getpid())
+                code = 1
+            finally:
+                if cleanup is not None:
+                    cleanup()
+                os._exit(code)
+        logging.info('Started worker %s', pid)
+        children.add(pid)
+
+    def stop():
+        if signal.getsignal(signal.SIGALRM) is not kill:
+            logging.info('Stopping workers')
+            signal.signal(signal.SIGALRM, kill)
+            signal.alarm(grace_period)
+            _signal_children(children, signal.SIGTERM)
+
+    def kill(signum, frame):
+        logging.error('Workers did not stop in %s seconds, killing them', grace_period)
+        _signal_children(children, signal.SIGKILL)
+
+    handle_stop_signals(stop)
+    try:
+        while children:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            children.discard(pid)
+    finally:
+        signal.alarm(0)
+
+
+def run_server(server_address, handler_class, mode=THREAD, workers=1, init_worker=None):
+    if mode not in MODES:
+        raise ValueError(f'Unknown server mode: {mode}')
+    if workers < 1:
+        raise ValueError('Number of workers must be positive')
+    if mode == PREFORK:
+        serve_prefork(server_address, handler_class, workers, init_worker)
+    else:
+        serve(ThreadPoolHTTPServer(server_address, handler_class, workers))
@@ -0,0 +1,202 @@
+import bisect
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring. Every node is placed on the ring `vnodes` times
+    and a key belongs to the first node point after the key's hash, so
+    adding or removing a node only moves the keys of that node's points.
+    """
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self.nodes = []
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            raise ValueError(f'Node {node} is already on the ring')
+        self.nodes.append(node)
+        for i in range(self.vnodes):
+            point = ring_hash(f'{node}#{i}')
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def get(self, key):
+        if not self._points:
+            raise LookupError('Hash ring has no nodes')
+        index = bisect.bisect(self._points, ring_hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+def parse_nodes(spec):
+    """
+    Connection options of comma separated `host:port` or unix socket path nodes.
+    """
+    nodes = {}
+    for node in filter(None, (part.strip() for part in spec.split(','))):
+        if node.startswith('/'):
+            nodes[node] = {'unix_socket_path': node}
+        else:
+            host, _, port = node.rpartition(':')
+            nodes[node] = {'host': host or 'localhost', 'port': int(port), 'unix_socket_path': None}
+    return nodes
+
+
+class ShardedStore:
+    """
+    Spreads keys over several stores with a consistent hash ring. Single key
+    calls go to the key's shard; bulk calls are split per shard and the
+    shards are called in parallel, results keep the order of the keys.
+    Hash fields live on the shard of their hash.
+    `shards` maps node names, which place them on the ring, to stores.
+    One shard of a bulk call is called on the calling thread and the others
+    on a pool of `workers_per_shard` threads per shard, which should match
+    the connection pool size of a shard store.
+    """
+    def __init__(self, shards, vnodes=160, workers_per_shard=8):
+        self.shards = dict(shards)
+        self.vnodes = vnodes
+        self.workers_per_shard = workers_per_shard
+        self.ring = HashRing(self.shards, vnodes)
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def shard(self, key):
+        return self.shards[self.ring.get(key)]
+
+    def add_shard(self, name, store):
+        """
+        Adds a shard; keys it now owns are read as misses until written again.
+        """
+        with self._lock:
+            ring = HashRing(list(self.shards) + [name], self.vnodes)
+            self.shards = dict(self.shards, **{name: store})
+            self.ring = ring
+            self._resize()
+
+    def remove_shard(self, name):
+        with self._lock:
+            ring = HashRing([node for node in self.shards if node != name], self.vnodes)
+            self.ring = ring
+            store = self.shards[name]
+            self.shards = {node: shard for node, shard in self.shards.items() if node != name}
+            self._resize()
+        return store
+
+    def _new_executor(self):
+        workers = max(len(self.shards), 1) * self.workers_per_shard
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard')
+
+    def _resize(self):
+        executor = self._executor
+        self._executor = self._new_executor()
+        executor.shutdown(wait=False)
+
+    def _split(self, items, key=None):
+        """
+        Groups item indexes by shard, as `(store, indexes)` pairs.
+        """
+        ring, shards = self.ring, self.shards
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(ring.get(item if key is None else key(item)), []).append(i)
+        return [(shards[node], indexes) for node, indexes in groups.items()]
+
+    def _run(self, calls):
+        """
+        Runs callables, in parallel when there are several, and returns their
+        results. The first one runs on the calling thread.
+        """
+        if not calls:
+            return []
+        futures = [self._executor.submit(call) for call in calls[1:]]
+        return [calls[0]()] + [future.result() for future in futures]
+
+    def _read_many(self, method, items, key=None):
+        parts = self._split(items, key)
+        results = self._run([
+            functools.partial(getattr(store, method), [items[i] for i in indexes]) for store, indexes in parts
+        ])
+        values = [None] * len(items)
+        for (_, indexes), result in zip(parts, results):
+            for i, value in zip(indexes, result):
+                values[i] = value
+        return values
+
+    def cache_get(self, key):
+        return self.shard(key).cache_get(key)
+
+    def get(self, key):
+        return self.shard(key).get(key)
+
+    def cache_get_many(self, keys):
+        return self._read_many('cache_get_many', keys)
+
+    def get_many(self, keys):
+        return self._read_many('get_many', keys)
+
+    def cache_set(self, key, value, expire):
+        self.shard(key).cache_set(key, value, expire)
+
+    def cache_set_many(self, mapping, expire):
+        keys = list(mapping)
+        self._run([
+            functools.partial(store.cache_set_many, {keys[i]: mapping[keys[i]] for i in indexes}, expire)
+            for store, indexes in self._split(keys)
+        ])
+
+    def set_many(self, mapping):
+        keys = list(mapping)
+        self._run([
+            functools.partial(store.set_many, {keys[i]: mapping[keys[i]] for i in indexes})
+            for store, indexes in self._split(keys)
+        ])
+
+    def hash_get_many(self, items):
+        return self._read_many('hash_get_many', items, key=lambda item: item[0])
+
+    def hash_set_many(self, items, expire):
+        self._run([
+            functools.partial(store.hash_set_many, [items[i] for i in indexes], expire)
+            for store, indexes in self._split(items, key=lambda item: item[0])
+        ])
+
+    def acquire_lock(self, key, token, ttl):
+        return self.shard(key).acquire_lock(key, token, ttl)
+
+    def release_lock(self, key, token):
+        self.shard(key).release_lock(key, token)
+
+    def clear(self):
+        self._run([store.clear for store in self.shards.values()])
+
+    def reset(self):
+        """
+        Resets every shard and the worker threads, which do not survive fork.
+        """
+        for store in self.shards.values():
+            store.reset()
+        self._executor = self._new_executor()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for store in self.shards.values():
+            store.close()
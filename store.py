@@ -1,19 +1,75 @@
+import time
+import random
+import struct
+import logging
+import threading
 import redis
 
-from utils import redis_retry
+from utils import redis_retry, RetryPolicy, CircuitBreaker
+from metrics import WRITE_BEHIND
 
 
-class RedisStore:
+# deletes the lock only if it is still held by the caller's token
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
 
-    MAX_RETRY = 5
-    DELAY = 2
 
-    def __init__(self, host='0.0.0.0', port=6379, db=0, socket_connect_timeout=5, max_retry_count=MAX_RETRY, retry_delay=DELAY):
-        self.max_retry_count = max_retry_count
-        self.retry_delay = retry_delay
-        self.store = redis.Redis(
-            host=host, port=port, db=db, socket_connect_timeout=socket_connect_timeout
+def make_connection_pool(host='0.0.0.0', port=6379, db=0, unix_socket_path=None, max_connections=50, pool_timeout=5,
+                         socket_connect_timeout=5, socket_timeout=None, socket_keepalive=True, health_check_interval=30):
+    """
+    Builds a thread-safe bounded pool. When all connections are in use
+    callers wait up to `pool_timeout` seconds instead of opening new ones.
+    """
+    kwargs = {
+        'db': db,
+        'max_connections': max_connections,
+        'timeout': pool_timeout,
+        'socket_timeout': socket_timeout,
+        'health_check_interval': health_check_interval,
+    }
+    if unix_socket_path:
+        return redis.BlockingConnectionPool(
+            connection_class=redis.UnixDomainSocketConnection, path=unix_socket_path, **kwargs
         )
+    return redis.BlockingConnectionPool(
+        host=host, port=port, socket_connect_timeout=socket_connect_timeout, socket_keepalive=socket_keepalive, **kwargs
+    )
+
+
+class RedisStore:
+    """
+    Redis backed store. Safe to share between threads; after fork call
+    `reset` in the child so that it does not reuse the parent's sockets.
+    Connection settings are passed to `make_connection_pool`, or a ready
+    pool can be given with `connection_pool`. Failed calls are retried
+    according to `retry_policy`, and once `circuit_breaker` opens they fail
+    fast with CircuitOpenError.
+    """
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, host='0.0.0.0', port=6379, db=0, socket_connect_timeout=5, retry_policy=None,
+                 circuit_breaker=None, connection_pool=None, **pool_kwargs):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.pool_kwargs = dict(host=host, port=port, db=db, socket_connect_timeout=socket_connect_timeout,
+                                **pool_kwargs)
+        self.connection_pool = connection_pool or make_connection_pool(**self.pool_kwargs)
+        self.store = redis.Redis(connection_pool=self.connection_pool)
+
+    def reset(self):
+        """
+        Replaces the connection pool with a fresh one, dropping inherited connections.
+        """
+        self.connection_pool = make_connection_pool(**self.pool_kwargs)
+        self.store = redis.Redis(connection_pool=self.connection_pool)
+
+    def close(self):
+        self.connection_pool.disconnect()
 
     @redis_retry
     def cache_get(self, key):
@@ -23,10 +79,520 @@ class RedisStore:
     def get(self, key):
         return self.store.get(key)
 
+    @redis_retry
+    def cache_get_many(self, keys):
+        return self._mget(keys)
+
+    @redis_retry
+    def get_many(self, keys):
+        return self._mget(keys)
+
+    def _mget(self, keys):
+        """
+        Fetches values of all keys in a single round trip.
+        Large key lists are split into several pipelined MGET commands.
+        """
+        if not keys:
+            return []
+        if len(keys) <= self.CHUNK_SIZE:
+            return self.store.mget(keys)
+        pipe = self.store.pipeline(transaction=False)
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            pipe.mget(keys[i:i + self.CHUNK_SIZE])
+        return [value for chunk in pipe.execute() for value in chunk]
+
     @redis_retry
     def cache_set(self, key, value, expire):
         self.store.set(key, value, expire)
 
+    @redis_retry
+    def cache_set_many(self, mapping, expire):
+        pipe = self.store.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, expire)
+        pipe.execute()
+
+    @redis_retry
+    def set_many(self, mapping):
+        """
+        Sets keys without expiry in one pipeline of chunked MSET commands.
+        """
+        items = list(mapping.items())
+        pipe = self.store.pipeline(transaction=False)
+        for i in range(0, len(items), self.CHUNK_SIZE):
+            pipe.mset(dict(items[i:i + self.CHUNK_SIZE]))
+        pipe.execute()
+
+    @redis_retry
+    def hash_get_many(self, items):
+        """
+        Values of `(hash, field)` pairs, fetched with pipelined HGET commands.
+        """
+        if not items:
+            return []
+        pipe = self.store.pipeline(transaction=False)
+        for name, field in items:
+            pipe.hget(name, field)
+        return pipe.execute()
+
+    @redis_retry
+    def hash_set_many(self, items, expire):
+        """
+        Sets `(hash, field, value)` triples and (re)sets the expiry of every
+        touched hash, all in one pipeline.
+        """
+        pipe = self.store.pipeline(transaction=False)
+        names = {}
+        for name, field, value in items:
+            pipe.hset(name, field, value)
+            names[name] = None
+        for name in names:
+            pipe.expire(name, expire)
+        pipe.execute()
+
+    @redis_retry
+    def acquire_lock(self, key, token, ttl):
+        return bool(self.store.set(key, token, px=int(ttl * 1000), nx=True))
+
+    @redis_retry
+    def release_lock(self, key, token):
+        self.store.eval(RELEASE_LOCK, 1, key, token)
+
     @redis_retry
     def clear(self):
         self.store.flushdb()
+
+
+class MemoryStore:
+    """
+    In-process store with the RedisStore interface, for tests and local
+    runs without Redis. Values are returned as bytes, like Redis does.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.data = {}
+        self.expires = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode()
+        return repr(value).encode()
+
+    def _get(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= self.clock():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return self.data.get(key)
+
+    def _set(self, key, value, expire=None):
+        self.data[key] = value
+        if expire is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = self.clock() + expire
+
+    def cache_get(self, key):
+        return self.get(key)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def cache_get_many(self, keys):
+        return self.get_many(keys)
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def cache_set(self, key, value, expire):
+        self.cache_set_many({key: value}, expire)
+
+    def cache_set_many(self, mapping, expire):
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, self.encode(value), expire)
+
+    def set_many(self, mapping):
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, self.encode(value))
+
+    def hash_get_many(self, items):
+        with self._lock:
+            return [(self._get(name) or {}).get(field) for name, field in items]
+
+    def hash_set_many(self, items, expire):
+        with self._lock:
+            for name, field, value in items:
+                fields = self._get(name) or {}
+                fields[field] = self.encode(value)
+                self._set(name, fields, expire)
+
+    def acquire_lock(self, key, token, ttl):
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, self.encode(token), ttl)
+            return True
+
+    def release_lock(self, key, token):
+        with self._lock:
+            if self._get(key) == self.encode(token):
+                self.data.pop(key, None)
+                self.expires.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.data.clear()
+            self.expires.clear()
+
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StoreProxy:
+    """
+    Base class for stores wrapping another store.
+    Everything that is not overridden is delegated to the wrapped store.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+class PrefetchedStore(StoreProxy):
+    """
+    Serves reads from values fetched in bulk by `prefetch` and buffers
+    cache writes until `flush`, so that many requests handled against it
+    share a few pipelined round trips. Locks are not taken: a buffered fill
+    is invisible to other processes until `flush`, so they could only wait
+    for the lock to expire.
+    """
+    def __init__(self, store):
+        super().__init__(store)
+        self.cached = {}
+        self.values = {}
+        self.writes = {}
+
+    def prefetch(self, cache_keys=(), keys=()):
+        cache_keys = [key for key in dict.fromkeys(cache_keys) if key not in self.cached]
+        keys = [key for key in dict.fromkeys(keys) if key not in self.values]
+        try:
+            if cache_keys:
+                self.cached.update(zip(cache_keys, self.store.cache_get_many(cache_keys)))
+            if keys:
+                self.values.update(zip(keys, self.store.get_many(keys)))
+        except redis.ConnectionError:
+            logging.error('Cannot prefetch from Redis')
+
+    def cache_get(self, key):
+        if key in self.writes:
+            return self.writes[key][0]
+        if key in self.cached:
+            return self.cached[key]
+        return self.store.cache_get(key)
+
+    def get(self, key):
+        if key in self.values:
+            return self.values[key]
+        return self.store.get(key)
+
+    def get_many(self, keys):
+        missing = [key for key in dict.fromkeys(keys) if key not in self.values]
+        if missing:
+            self.values.update(zip(missing, self.store.get_many(missing)))
+        return [self.values[key] for key in keys]
+
+    def cache_set(self, key, value, expire):
+        self.writes[key] = (value, expire)
+
+    def acquire_lock(self, key, token, ttl):
+        return True
+
+    def release_lock(self, key, token):
+        pass
+
+    def flush(self):
+        by_expire = {}
+        for key, (value, expire) in self.writes.items():
+            by_expire.setdefault(expire, {})[key] = value
+        self.writes = {}
+        for expire, mapping in by_expire.items():
+            self.store.cache_set_many(mapping, expire)
+
+
+class ReplicaRoutedStore(StoreProxy):
+    """
+    Sends reads to replicas and everything else to the wrapped primary.
+    A replica is picked at random with probability inversely proportional
+    to its recent latency. A replica whose call fails or times out is
+    skipped for `cooldown` seconds and the read is served by the primary;
+    when no replica is healthy all reads go to the primary. Replica stores
+    should have a socket timeout, or a hung replica blocks its readers.
+    """
+    def __init__(self, primary, replicas, cooldown=5, smoothing=0.2, clock=time.monotonic, rand=random.random):
+        super().__init__(primary)
+        self.replicas = list(replicas)
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.clock = clock
+        self.rand = rand
+        self.latency = [None] * len(self.replicas)
+        self.down_until = [0] * len(self.replicas)
+
+    def choose(self):
+        """
+        Index of the replica to read from, None when none is healthy.
+        """
+        now = self.clock()
+        weights = [
+            (i, 1 / max(latency, 1e-6) if latency is not None else None)
+            for i, latency in enumerate(self.latency) if self.down_until[i] <= now
+        ]
+        if not weights:
+            return None
+        # replicas without measurements are tried first
+        for i, weight in weights:
+            if weight is None:
+                return i
+        point = self.rand() * sum(weight for _, weight in weights)
+        for i, weight in weights:
+            point -= weight
+            if point < 0:
+                return i
+        return weights[-1][0]
+
+    def observe(self, i, elapsed):
+        latency = self.latency[i]
+        self.latency[i] = elapsed if latency is None else latency + self.smoothing * (elapsed - latency)
+
+    def read(self, method, *args):
+        i = self.choose()
+        if i is not None:
+            started = time.perf_counter()
+            try:
+                value = getattr(self.replicas[i], method)(*args)
+            except (redis.ConnectionError, redis.TimeoutError):
+                logging.error('Replica %s is unavailable, reading from the primary', i)
+                self.down_until[i] = self.clock() + self.cooldown
+            else:
+                self.observe(i, time.perf_counter() - started)
+                return value
+        return getattr(self.store, method)(*args)
+
+    def cache_get(self, key):
+        return self.read('cache_get', key)
+
+    def get(self, key):
+        return self.read('get', key)
+
+    def cache_get_many(self, keys):
+        return self.read('cache_get_many', keys)
+
+    def get_many(self, keys):
+        return self.read('get_many', keys)
+
+    def hash_get_many(self, items):
+        return self.read('hash_get_many', items)
+
+    def reset(self):
+        self.store.reset()
+        for replica in self.replicas:
+            replica.reset()
+
+    def close(self):
+        self.store.close()
+        for replica in self.replicas:
+            replica.close()
+
+
+class BucketedScoreStore(StoreProxy):
+    """
+    Compact layout of the score cache. Instead of a string key per client,
+    a `uid:` key's md5 digest is split into a bucket number (its first
+    `bucket_bits` bits) and a 12-byte binary field of a small Redis hash,
+    so that hashes stay listpack encoded. A value is packed with its expiry
+    time into 12 bytes; every write also extends the expiry of the whole bucket.
+    Bucket names include the number of the current `window` of time, so a
+    bucket stops receiving writes when its window ends and expires with all
+    its stale fields. Reads look in the current and the previous window, so
+    `window` must not be shorter than the longest expiry.
+    Keys missing from the buckets are read from the old string layout,
+    which is then left to expire; turn `legacy_reads` off once it has.
+    Other keys are passed to the wrapped store as is.
+    """
+    PREFIX = 'uid:'
+    VALUE = struct.Struct('<dI')
+
+    def __init__(self, store, bucket_bits=20, legacy_reads=True, window=60 * 60, clock=time.time):
+        if not 1 <= bucket_bits <= 32:
+            raise ValueError(f'bucket_bits must be between 1 and 32, got {bucket_bits}')
+        super().__init__(store)
+        self.bucket_bits = bucket_bits
+        self.legacy_reads = legacy_reads
+        self.window = window
+        self.clock = clock
+
+    def locate(self, key, window=None):
+        if window is None:
+            window = int(self.clock() // self.window)
+        digest = bytes.fromhex(key[len(self.PREFIX):])
+        bucket = int.from_bytes(digest[:4], 'big') >> (32 - self.bucket_bits)
+        return f's:{window:x}:{bucket:x}', digest[4:]
+
+    def pack(self, value, expire):
+        return self.VALUE.pack(float(value), int(self.clock() + expire))
+
+    def unpack(self, packed):
+        if packed is None:
+            return None
+        value, expires_at = self.VALUE.unpack(packed)
+        return repr(value) if expires_at > self.clock() else None
+
+    def cache_get(self, key):
+        return self.cache_get_many([key])[0]
+
+    def cache_get_many(self, keys):
+        scored = [i for i, key in enumerate(keys) if key.startswith(self.PREFIX)]
+        values = [None] * len(keys)
+        window = int(self.clock() // self.window)
+        items = [self.locate(keys[i], w) for i in scored for w in (window, window - 1)]
+        packed = iter(self.store.hash_get_many(items))
+        for i, current, previous in zip(scored, packed, packed):
+            values[i] = self.unpack(current) or self.unpack(previous)
+        legacy = [
+            key for key, value in zip(keys, values)
+            if value is None and (self.legacy_reads or not key.startswith(self.PREFIX))
+        ]
+        if legacy:
+            fetched = dict(zip(legacy, self.store.cache_get_many(legacy)))
+            values = [fetched.get(key) if value is None else value for key, value in zip(keys, values)]
+        return values
+
+    def cache_set(self, key, value, expire):
+        self.cache_set_many({key: value}, expire)
+
+    def cache_set_many(self, mapping, expire):
+        items, other = [], {}
+        for key, value in mapping.items():
+            if key.startswith(self.PREFIX):
+                items.append(self.locate(key) + (self.pack(value, expire),))
+            else:
+                other[key] = value
+        if items:
+            self.store.hash_set_many(items, expire)
+        if other:
+            self.store.cache_set_many(other, expire)
+
+
+class WriteBehindStore(StoreProxy):
+    """
+    Queues cache writes and returns at once; a background thread writes
+    them to the wrapped store with `cache_set_many` in batches. Writes to a
+    key still queued replace the queued value, and reads see queued values.
+    At most `max_pending` keys are queued, further writes are dropped.
+    `close` writes out what is queued. After fork call `reset` in the child
+    to start its own writer thread.
+    """
+    def __init__(self, store, max_pending=10000, flush_interval=0.01):
+        super().__init__(store)
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._start()
+
+    def _start(self):
+        self.pending = {}
+        self.writing = {}
+        self._closed = False
+        self._ready = threading.Condition()
+        self._writer = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._writer.start()
+
+    def reset(self):
+        self.store.reset()
+        self._start()
+
+    def _queued(self, key):
+        queued = self.pending.get(key)
+        return queued if queued is not None else self.writing.get(key)
+
+    def cache_get(self, key):
+        queued = self._queued(key)
+        return queued[0] if queued is not None else self.store.cache_get(key)
+
+    def cache_get_many(self, keys):
+        queued = [self._queued(key) for key in keys]
+        missing = [key for key, item in zip(keys, queued) if item is None]
+        fetched = dict(zip(missing, self.store.cache_get_many(missing))) if missing else {}
+        return [item[0] if item is not None else fetched[key] for key, item in zip(keys, queued)]
+
+    def cache_set(self, key, value, expire):
+        self.cache_set_many({key: value}, expire)
+
+    def cache_set_many(self, mapping, expire):
+        with self._ready:
+            if self._closed:
+                raise RuntimeError('Write-behind store is closed')
+            for key, value in mapping.items():
+                if len(self.pending) >= self.max_pending and key not in self.pending:
+                    WRITE_BEHIND.inc(('dropped',))
+                    continue
+                self.pending[key] = (value, expire)
+                WRITE_BEHIND.inc(('queued',))
+            self._ready.notify()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self.pending and not self._closed:
+                    self._ready.wait()
+                closed = self._closed
+            if not closed:
+                # let writes arriving meanwhile join the batch
+                time.sleep(self.flush_interval)
+            with self._ready:
+                batch, self.pending = self.pending, {}
+            self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch):
+        self.writing = batch
+        by_expire = {}
+        for key, (value, expire) in batch.items():
+            by_expire.setdefault(expire, {})[key] = value
+        for expire, mapping in by_expire.items():
+            try:
+                self.store.cache_set_many(mapping, expire)
+            except Exception:
+                logging.exception('Cannot write %s queued values to Redis cache', len(mapping))
+                WRITE_BEHIND.inc(('failed',), len(mapping))
+            else:
+                WRITE_BEHIND.inc(('written',), len(mapping))
+        self.writing = {}
+
+    def flush(self):
+        """
+        Writes out what is queued now on the calling thread.
+        """
+        with self._ready:
+            batch, self.pending = self.pending, {}
+        self._write(batch)
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._writer.join()
+        self.store.close()
@@ -0,0 +1,107 @@
+import json
+import asyncio
+import hashlib
+
+import api
+from async_server import AsyncHTTPServer
+
+
+class AsyncDictStore:
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    async def cache_get(self, key):
+        return self.data.get(key)
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def cache_set(self, key, value, expire):
+        self.data[key] = value
+
+
+def method_body(method, arguments):
+    login, account = 'h&f', 'horns&hoofs'
+    return {
+        'account': account,
+        'login': login,
+        'method': method,
+        'token': hashlib.sha512((account + login + api.SALT).encode()).hexdigest(),
+        'arguments': arguments,
+    }
+
+
+async def exchange(reader, writer, body, path='/method/'):
+    payload = json.dumps(body).encode()
+    writer.write(f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(payload)}\r\n\r\n'.encode()
+                 + payload)
+    await writer.drain()
+    status = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line == b'\r\n':
+            break
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
+    data = await reader.readexactly(int(headers['content-length']))
+    return int(status.split()[1]), json.loads(data)
+
+
+def run_with_server(store, scenario, **options):
+    async def main():
+        server = await AsyncHTTPServer(api.ASYNC_ROUTER, store, **options).start('localhost', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('localhost', port)
+        try:
+            return await scenario(reader, writer)
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(main())
+
+
+def test_keep_alive_connection_serves_several_requests():
+    store = AsyncDictStore({'i:1': '["books"]', 'i:2': '["cars", "geek"]'})
+
+    async def scenario(reader, writer):
+        first = await exchange(reader, writer, method_body('clients_interests', {'client_ids': [1, 2]}))
+        second = await exchange(reader, writer, method_body('online_score', {'first_name': 'a', 'last_name': 'b'}))
+        return first, second
+
+    (code, first), (_, second) = run_with_server(store, scenario)
+    assert code == api.OK
+    assert first == {'response': {'1': ['books'], '2': ['cars', 'geek']}, 'code': api.OK}
+    assert second == {'response': {'score': 0.5}, 'code': api.OK}
+
+
+def test_errors_use_method_handler_semantics():
+    async def scenario(reader, writer):
+        forbidden = await exchange(reader, writer, dict(method_body('online_score', {}), token='bad'))
+        invalid = await exchange(reader, writer, method_body('clients_interests', {'client_ids': []}))
+        not_found = await exchange(reader, writer, method_body('online_score', {}), path='/unknown/')
+        return forbidden, invalid, not_found
+
+    forbidden, invalid, not_found = run_with_server(AsyncDictStore(), scenario)
+    assert forbidden == (api.FORBIDDEN, {'error': 'Forbidden', 'code': api.FORBIDDEN})
+    assert invalid[0] == api.INVALID_REQUEST
+    assert not_found == (api.NOT_FOUND, {'error': 'Not Found', 'code': api.NOT_FOUND})
+
+
+def test_request_body_size_is_limited():
+    async def scenario(reader, writer):
+        body = method_body('online_score', {'first_name': 'a', 'last_name': 'b'})
+        small = await exchange(reader, writer, body)
+        large = await exchange(reader, writer, dict(body, padding='x' * 1000))
+        return small, large, await reader.read()
+
+    small, large, rest = run_with_server(AsyncDictStore(), scenario, max_body_size=500)
+    assert small[0] == api.OK
+    assert large == (api.REQUEST_ENTITY_TOO_LARGE, {'error': 'Request Entity Too Large',
+                                                   'code': api.REQUEST_ENTITY_TOO_LARGE})
+    assert rest == b''
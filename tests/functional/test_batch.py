@@ -0,0 +1,81 @@
+import hashlib
+
+import api
+
+
+class CountingStore:
+    """
+    In-memory store recording every call made to it.
+    """
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.calls = []
+
+    def cache_get_many(self, keys):
+        self.calls.append(('cache_get_many', list(keys)))
+        return [self.data.get(key) for key in keys]
+
+    def get_many(self, keys):
+        self.calls.append(('get_many', list(keys)))
+        return [self.data.get(key) for key in keys]
+
+    def cache_set_many(self, mapping, expire):
+        self.calls.append(('cache_set_many', dict(mapping)))
+        self.data.update(mapping)
+
+
+def method_body(method, arguments, login='h&f'):
+    account = 'horns&hoofs'
+    return {
+        'account': account,
+        'login': login,
+        'method': method,
+        'token': hashlib.sha512((account + login + api.SALT).encode()).hexdigest(),
+        'arguments': arguments,
+    }
+
+
+def handle(bodies, store):
+    return api.batch_handler({'body': bodies, 'headers': {}}, {'request_id': 'r'}, store)
+
+
+def test_batch_results_in_order():
+    store = CountingStore({'i:1': '["books"]', 'i:2': '["cars"]'})
+    response, code, ctx = handle([
+        method_body('clients_interests', {'client_ids': [1, 2]}),
+        method_body('online_score', {'first_name': 'a', 'last_name': 'b'}),
+        dict(method_body('online_score', {}), token='bad'),
+        method_body('unknown', {}),
+        method_body('online_score', {'phone': '79175002040'}),
+        'not an object',
+    ], store)
+    assert code == api.OK
+    assert ctx['nrequests'] == 6
+    assert response[:4] == [
+        {'response': {1: ['books'], 2: ['cars']}, 'code': api.OK},
+        {'response': {'score': 0.5}, 'code': api.OK},
+        {'error': 'Forbidden', 'code': api.FORBIDDEN},
+        {'error': 'Not Found', 'code': api.NOT_FOUND},
+    ]
+    assert [r['code'] for r in response[4:]] == [api.INVALID_REQUEST, api.INVALID_REQUEST]
+
+
+def test_batch_coalesces_store_calls():
+    store = CountingStore({'i:1': '["books"]'})
+    bodies = [method_body('clients_interests', {'client_ids': [1, cid]}) for cid in range(2, 5)]
+    bodies += [method_body('online_score', {'first_name': 'a', 'last_name': name}) for name in 'bcb']
+    response, code, _ = handle(bodies, store)
+    assert all(r['code'] == api.OK for r in response)
+    assert [name for name, _ in store.calls] == ['cache_get_many', 'get_many', 'cache_set_many']
+    assert store.calls[1][1] == ['i:1', 'i:2', 'i:3', 'i:4']
+    assert len(store.calls[2][1]) == 2
+
+
+def test_batch_must_be_list():
+    _, code, _ = handle({'method': 'online_score'}, CountingStore())
+    assert code == api.INVALID_REQUEST
+
+
+def test_batch_size_limit():
+    _, code, _ = handle([{}] * (api.MAX_BATCH_SIZE + 1), CountingStore())
+    assert code == api.INVALID_REQUEST
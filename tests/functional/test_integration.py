@@ -26,6 +26,11 @@ def cases(cases):
     return decorator
 
 
+class DictStore(dict):
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+
 class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
@@ -140,12 +145,12 @@ class TestSuite(unittest.TestCase):
     ])
     def test_ok_interests_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
-        store = {
+        store = DictStore({
             'i:0': '["interest1", "interest2"]',
             'i:1': '["interest1", "interest2"]',
             'i:2': '["interest1", "interest2"]',
             'i:3': '["interest1", "interest2"]',
-        }
+        })
         self.set_valid_auth(request)
         response, code, _ = self.get_response(request, store)
         self.assertEqual(api.OK, code, arguments)
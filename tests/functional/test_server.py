@@ -0,0 +1,392 @@
+import os
+import sys
+import json
+import time
+import signal
+import hashlib
+import textwrap
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import api
+from server import ThreadPoolHTTPServer, ReusePortHTTPServer, THREAD, PREFORK
+
+
+class BarrierStore:
+    """
+    Store whose reads block until `parties` requests are inside it at once.
+    """
+    def __init__(self, parties):
+        self.barrier = threading.Barrier(parties, timeout=5)
+
+    def get_many(self, keys):
+        self.barrier.wait()
+        return ['["books"]' for _ in keys]
+
+
+def interests_request(client_id):
+    login, account = 'h&f', 'horns&hoofs'
+    return {
+        'account': account,
+        'login': login,
+        'method': 'clients_interests',
+        'token': hashlib.sha512((account + login + api.SALT).encode()).hexdigest(),
+        'arguments': {'client_ids': [client_id]},
+    }
+
+
+def post(port, body):
+    conn = http.client.HTTPConnection('localhost', port, timeout=10)
+    try:
+        conn.request('POST', '/method/', json.dumps(body), {'Content-Type': 'application/json'})
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+class BooksStore:
+    def get_many(self, keys):
+        return ['["books"]' for _ in keys]
+
+
+def start_server(store, workers=2, **attributes):
+    handler = type('Handler', (api.MainHTTPHandler,), dict(attributes, store=store))
+    server = ThreadPoolHTTPServer(('localhost', 0), handler, workers=workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture()
+def server():
+    server = start_server(BarrierStore(2))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def keep_alive_server():
+    server = start_server(BooksStore())
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_thread_pool_serves_requests_concurrently(server):
+    port = server.server_address[1]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(lambda cid: post(port, interests_request(cid)), [1, 2]))
+    assert [r['code'] for r in results] == [api.OK, api.OK]
+    assert results[0]['response'] == {'1': ['books']}
+    assert results[1]['response'] == {'2': ['books']}
+
+
+def test_reuse_port_servers_share_address():
+    first = ReusePortHTTPServer(('localhost', 0), api.MainHTTPHandler)
+    second = ReusePortHTTPServer(first.server_address, api.MainHTTPHandler)
+    try:
+        assert first.server_address == second.server_address
+    finally:
+        first.server_close()
+        second.server_close()
+
+
+def test_metrics_endpoint(server):
+    port = server.server_address[1]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(lambda cid: post(port, interests_request(cid)), [1, 2]))
+    conn = http.client.HTTPConnection('localhost', port, timeout=10)
+    try:
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        body = response.read().decode()
+    finally:
+        conn.close()
+    assert response.status == 200
+    assert response.getheader('Content-Type').startswith('text/plain')
+    assert 'scoring_requests_total{method="clients_interests",code="200"}' in body
+    for stage in ('parse', 'validate', 'auth', 'store', 'serialize'):
+        assert f'scoring_stage_seconds_count{{stage="{stage}"}}' in body
+
+
+def test_keep_alive_serves_requests_on_one_connection(keep_alive_server):
+    conn = http.client.HTTPConnection('localhost', keep_alive_server.server_address[1], timeout=10)
+    try:
+        for cid in (1, 2, 3):
+            conn.request('POST', '/method/', json.dumps(interests_request(cid)))
+            response = conn.getresponse()
+            body = response.read()
+            assert response.version == 11
+            assert int(response.getheader('Content-Length')) == len(body)
+            assert json.loads(body)['response'] == {str(cid): ['books']}
+        sock = conn.sock
+        conn.request('GET', '/metrics')
+        conn.getresponse().read()
+        assert conn.sock is sock
+    finally:
+        conn.close()
+
+
+def test_idle_keep_alive_client_does_not_block_others():
+    server = start_server(BooksStore(), workers=1)
+    port = server.server_address[1]
+    idle = http.client.HTTPConnection('localhost', port, timeout=10)
+    try:
+        idle.request('POST', '/method/', json.dumps(interests_request(1)))
+        idle.getresponse().read()
+        assert post(port, interests_request(2))['response'] == {'2': ['books']}
+        idle.request('POST', '/method/', json.dumps(interests_request(3)))
+        assert json.loads(idle.getresponse().read())['response'] == {'3': ['books']}
+    finally:
+        idle.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_idle_connection_closed_after_keep_alive_timeout():
+    server = start_server(BooksStore(), workers=1, keep_alive_timeout=0.1)
+    conn = http.client.HTTPConnection('localhost', server.server_address[1], timeout=10)
+    try:
+        conn.request('POST', '/method/', json.dumps(interests_request(1)))
+        conn.getresponse().read()
+        assert conn.sock.recv(1) == b''
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_connection_closed_after_max_requests(keep_alive_server, monkeypatch):
+    monkeypatch.setattr(keep_alive_server.RequestHandlerClass, 'max_requests', 2)
+    conn = http.client.HTTPConnection('localhost', keep_alive_server.server_address[1], timeout=10)
+    try:
+        conn.request('POST', '/method/', json.dumps(interests_request(1)))
+        first = conn.getresponse()
+        first.read()
+        conn.request('POST', '/method/', json.dumps(interests_request(2)))
+        second = conn.getresponse()
+        second.read()
+    finally:
+        conn.close()
+    assert first.getheader('Connection') is None
+    assert second.getheader('Connection') == 'close'
+
+
+def test_invalid_json_keeps_connection(keep_alive_server):
+    conn = http.client.HTTPConnection('localhost', keep_alive_server.server_address[1], timeout=10)
+    try:
+        conn.request('POST', '/method/', b'{not json')
+        response = conn.getresponse()
+        assert json.loads(response.read())['code'] == api.BAD_REQUEST
+        conn.request('POST', '/method/', json.dumps(interests_request(1)))
+        assert json.loads(conn.getresponse().read())['code'] == api.OK
+    finally:
+        conn.close()
+
+
+class FailingStore(BooksStore):
+    def __init__(self):
+        self.calls = 0
+
+    def get_many(self, keys):
+        self.calls += 1
+        if self.calls > 1:
+            raise RuntimeError('store is gone')
+        return super().get_many(keys)
+
+
+def interests_many_request(client_ids):
+    body = interests_request(0)
+    body['arguments']['client_ids'] = client_ids
+    return json.dumps(body)
+
+
+def test_large_interests_response_is_streamed(keep_alive_server, monkeypatch):
+    monkeypatch.setattr(api, 'STREAM_MIN_CLIENTS', 3)
+    monkeypatch.setattr(api, 'INTERESTS_CHUNK_SIZE', 2)
+    conn = http.client.HTTPConnection('localhost', keep_alive_server.server_address[1], timeout=10)
+    try:
+        conn.request('POST', '/method/', interests_many_request([1, 2, 3, 2, 4]))
+        response = conn.getresponse()
+        body = json.loads(response.read())
+        assert response.getheader('Transfer-Encoding') == 'chunked'
+        assert response.getheader('Content-Length') is None
+        assert body == {'code': 200, 'response': {str(cid): ['books'] for cid in (1, 2, 3, 4)}}
+        conn.request('POST', '/method/', interests_many_request([1, 2]))
+        response = conn.getresponse()
+        assert response.getheader('Content-Length') is not None
+        assert json.loads(response.read())['response'] == {'1': ['books'], '2': ['books']}
+    finally:
+        conn.close()
+
+
+def test_failed_stream_is_cut_short(monkeypatch):
+    monkeypatch.setattr(api, 'STREAM_MIN_CLIENTS', 3)
+    monkeypatch.setattr(api, 'INTERESTS_CHUNK_SIZE', 2)
+    server = start_server(FailingStore())
+    conn = http.client.HTTPConnection('localhost', server.server_address[1], timeout=10)
+    try:
+        conn.request('POST', '/method/', interests_many_request([1, 2, 3, 4]))
+        response = conn.getresponse()
+        assert response.status == 200
+        with pytest.raises(http.client.IncompleteRead):
+            response.read()
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_request_body_size_is_limited(keep_alive_server, monkeypatch):
+    monkeypatch.setattr(keep_alive_server.RequestHandlerClass, 'max_body_size', 64)
+    conn = http.client.HTTPConnection('localhost', keep_alive_server.server_address[1], timeout=10)
+    try:
+        conn.request('POST', '/method/', interests_many_request(list(range(100))))
+        response = conn.getresponse()
+        body = json.loads(response.read())
+    finally:
+        conn.close()
+    assert response.status == api.REQUEST_ENTITY_TOO_LARGE
+    assert body == {'code': 413, 'error': 'Request Entity Too Large'}
+    assert response.getheader('Connection') == 'close'
+
+
+def test_large_request_buffer_is_not_kept():
+    sizes = []
+
+    def handle_one_request(self):
+        api.MainHTTPHandler.handle_one_request(self)
+        sizes.append(len(self.buffer))
+
+    server = start_server(BooksStore(), buffer_size=256, max_kept_buffer=1024, handle_one_request=handle_one_request)
+    conn = http.client.HTTPConnection('localhost', server.server_address[1], timeout=10)
+    try:
+        for client_ids in ([1], list(range(300)), [1]):
+            conn.request('POST', '/method/', interests_many_request(client_ids))
+            assert conn.getresponse().read()
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+    assert sizes[:3] == [256, 256, 256]
+
+
+STOPPING_SERVER = textwrap.dedent("""
+    import os, sys, time
+    from http.server import BaseHTTPRequestHandler
+    from server import run_server
+
+    mode, port, marker = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def init_worker():
+        def cleanup():
+            time.sleep(0.5)
+            open(marker + str(os.getpid()), 'w').close()
+        return cleanup
+
+    run_server(('localhost', port), Handler, mode, 2, init_worker)
+    if mode == 'thread':
+        time.sleep(0.5)
+        open(marker + 'main', 'w').close()
+""")
+
+
+@pytest.mark.parametrize('mode, signum, group, cleanups', [
+    (THREAD, signal.SIGTERM, False, 1),
+    (PREFORK, signal.SIGTERM, False, 2),
+    (PREFORK, signal.SIGINT, True, 2),
+])
+def test_server_stops_gracefully_on_signals(tmp_path, mode, signum, group, cleanups):
+    probe = ReusePortHTTPServer(('localhost', 0), api.MainHTTPHandler)
+    port = probe.server_address[1]
+    probe.server_close()
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    process = subprocess.Popen([sys.executable, '-c', STOPPING_SERVER, mode, str(port), str(tmp_path / 'done-')],
+                               cwd=root, start_new_session=True)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            conn = http.client.HTTPConnection('localhost', port, timeout=1)
+            try:
+                conn.request('GET', '/')
+                conn.getresponse().read()
+                break
+            except OSError:
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+            finally:
+                conn.close()
+        if group:
+            os.killpg(process.pid, signum)
+        else:
+            process.send_signal(signum)
+        assert process.wait(timeout=20) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+    assert len(list(tmp_path.iterdir())) == cleanups
+
+
+PREFORK_METRICS_SERVER = textwrap.dedent("""
+    import sys
+    import api
+    from metrics import MultiprocessMetrics
+    from server import run_server
+
+    port, directory = int(sys.argv[1]), sys.argv[2]
+
+    def init_worker():
+        api.MainHTTPHandler.metrics = MultiprocessMetrics(directory, interval=0.05)
+        api.MainHTTPHandler.metrics.start()
+        return api.MainHTTPHandler.metrics.stop
+
+    run_server(('localhost', port), api.MainHTTPHandler, 'prefork', 2, init_worker)
+""")
+
+
+def test_prefork_metrics_cover_all_workers(tmp_path):
+    probe = ReusePortHTTPServer(('localhost', 0), api.MainHTTPHandler)
+    port = probe.server_address[1]
+    probe.server_close()
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    process = subprocess.Popen([sys.executable, '-c', PREFORK_METRICS_SERVER, str(port), str(tmp_path)], cwd=root)
+    try:
+        deadline = time.monotonic() + 10
+        sent = 0
+        while sent < 40:
+            conn = http.client.HTTPConnection('localhost', port, timeout=1)
+            try:
+                conn.request('POST', '/method/', 'not json')
+                conn.getresponse().read()
+                sent += 1
+            except OSError:
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+            finally:
+                conn.close()
+        assert len(list(tmp_path.iterdir())) == 2
+        time.sleep(0.2)
+        scrapes = []
+        for _ in range(4):
+            conn = http.client.HTTPConnection('localhost', port, timeout=5)
+            try:
+                conn.request('GET', '/metrics')
+                scrapes.append(conn.getresponse().read().decode())
+            finally:
+                conn.close()
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=20)
+    for body in scrapes:
+        counts = [line for line in body.splitlines() if line.startswith('scoring_requests_total')]
+        assert sum(int(line.rsplit(' ', 1)[1]) for line in counts) == 40
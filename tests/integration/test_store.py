@@ -2,7 +2,9 @@ import pytest
 import redis
 import time
 
-from store import RedisStore
+from store import RedisStore, BucketedScoreStore
+from utils import RetryPolicy
+from exceptions import CircuitOpenError
 
 
 @pytest.fixture()
@@ -26,28 +28,104 @@ def test_get_ok(store):
     assert store.get('key') == b'value'
 
 
+def test_get_many_ok(store):
+    store.cache_set('other', 'value2', 60)
+    assert store.get_many(['key', 'missing', 'other']) == [b'value', None, b'value2']
+
+
+def test_get_many_chunked(store):
+    store.CHUNK_SIZE = 2
+    assert store.get_many(['key', 'missing', 'key']) == [b'value', None, b'value']
+
+
+def test_cache_set_many_ok(store):
+    store.cache_set_many({'a': 1.5, 'b': 3.0}, 60)
+    assert store.cache_get_many(['a', 'b', 'missing']) == [b'1.5', b'3.0', None]
+
+
+def unavailable_store(budget=0.5):
+    return RedisStore(port=9999, retry_policy=RetryPolicy(max_retries=5, base_delay=0.1, jitter=0, budget=budget))
+
+
 def test_get_error():
-    store = RedisStore(port=9999, max_retry_count=2, retry_delay=2)
+    store = unavailable_store()
     start_time = time.time()
     with pytest.raises(redis.ConnectionError):
         store.get('key')
     excec_time = time.time() - start_time
-    assert excec_time >= 4
+    assert 0.3 <= excec_time < 1
 
 
 def test_cache_get_error():
-    store = RedisStore(port=9999, max_retry_count=2, retry_delay=2)
+    store = unavailable_store()
     start_time = time.time()
     with pytest.raises(redis.ConnectionError):
         store.cache_get('key')
     excec_time = time.time() - start_time
-    assert excec_time >= 4
+    assert 0.3 <= excec_time < 1
 
 
 def test_cache_set_error():
-    store = RedisStore(port=9999, max_retry_count=2, retry_delay=2)
+    store = unavailable_store()
     start_time = time.time()
     with pytest.raises(redis.ConnectionError):
         store.cache_set('key', 'value', 60)
     excec_time = time.time() - start_time
-    assert excec_time >= 4
+    assert 0.3 <= excec_time < 1
+
+
+def test_open_circuit_fails_fast():
+    store = unavailable_store(budget=0)
+    for _ in range(store.circuit_breaker.failure_threshold):
+        with pytest.raises(redis.ConnectionError):
+            store.get('key')
+    start_time = time.time()
+    with pytest.raises(CircuitOpenError):
+        store.get('key')
+    assert time.time() - start_time < 0.01
+
+
+def test_lock_is_exclusive_and_released_by_holder_only(store):
+    assert store.acquire_lock('lock:key', 'a', 1)
+    assert not store.acquire_lock('lock:key', 'b', 1)
+    store.release_lock('lock:key', 'b')
+    assert not store.acquire_lock('lock:key', 'b', 1)
+    store.release_lock('lock:key', 'a')
+    assert store.acquire_lock('lock:key', 'b', 1)
+
+
+def test_hash_set_many_sets_fields_and_expiry(store):
+    store.hash_set_many([('s:1', b'a', b'1'), ('s:1', b'b', b'2'), ('s:2', b'a', b'3')], 60)
+    assert store.hash_get_many([('s:1', b'a'), ('s:1', b'b'), ('s:2', b'a'), ('s:2', b'b')]) == [b'1', b'2', b'3', None]
+    assert 0 < store.store.ttl('s:1') <= 60
+
+
+def test_bucketed_scores_use_listpack_hashes(store):
+    bucketed = BucketedScoreStore(store, bucket_bits=4)
+    bucketed.cache_set_many({f'uid:{i:032x}': 1.5 for i in range(100)}, 60)
+    assert bucketed.cache_get(f'uid:{7:032x}') == '1.5'
+    assert store.store.object('encoding', 's:0') in (b'listpack', b'ziplist')
+
+
+def test_set_many_writes_without_expiry(store):
+    store.CHUNK_SIZE = 2
+    store.set_many({'i:1': b'["cars"]', 'i:2': b'[]', 'i:3': b'\x00\x01\x00'})
+    assert store.get_many(['i:1', 'i:2', 'i:3']) == [b'["cars"]', b'[]', b'\x00\x01\x00']
+    assert store.store.ttl('i:1') == -1
+
+
+def test_interests_cache_invalidated_by_keyspace_notifications(store):
+    from cache import InterestsCache, enable_notifications
+    enable_notifications(store.store)
+    store.set_many({'i:1': b'["cars"]'})
+    cache = InterestsCache(store)
+    cache.listen(lambda: store.store)
+    deadline = time.monotonic() + 5
+    while not cache.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.get('i:1') == b'["cars"]'
+    store.set_many({'i:1': b'["pets"]'})
+    while cache.get('i:1') != b'["pets"]' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.get('i:1') == b'["pets"]'
+    cache.listener.stop()
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+import redis
+
+from async_store import AsyncRedisStore, encode_command
+from utils import RetryPolicy
+
+
+def test_encode_command():
+    assert encode_command('SET', 'key', 1.5, 'EX', 60) == (
+        b'*5\r\n$3\r\nSET\r\n$3\r\nkey\r\n$3\r\n1.5\r\n$2\r\nEX\r\n$2\r\n60\r\n'
+    )
+
+
+def run_against(replies, scenario):
+    """
+    Runs `scenario(store)` against a fake server answering each command
+    with the next raw reply from `replies`.
+    """
+    commands = []
+
+    async def serve(reader, writer):
+        for reply in replies:
+            commands.append(await reader.read(1024))
+            writer.write(reply)
+            await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(serve, 'localhost', 0)
+        port = server.sockets[0].getsockname()[1]
+        store = AsyncRedisStore(host='localhost', port=port, retry_policy=RetryPolicy(max_retries=0))
+        try:
+            return await scenario(store)
+        finally:
+            store.close()
+            server.close()
+
+    return asyncio.run(main()), commands
+
+
+def test_get_and_set():
+    async def scenario(store):
+        await store.cache_set('key', 'value', 60)
+        return await store.get('key'), await store.cache_get('missing')
+
+    result, commands = run_against([b'+OK\r\n', b'$5\r\nvalue\r\n', b'$-1\r\n'], scenario)
+    assert result == (b'value', None)
+    assert commands[0] == encode_command('SET', 'key', 'value', 'EX', 60)
+
+
+def test_get_many_pipelines_chunks():
+    async def scenario(store):
+        store.CHUNK_SIZE = 2
+        return await store.get_many(['a', 'b', 'c'])
+
+    result, commands = run_against([b'*2\r\n$1\r\n1\r\n$-1\r\n*1\r\n$1\r\n3\r\n'], scenario)
+    assert result == [b'1', None, b'3']
+    assert commands == [encode_command('MGET', 'a', 'b') + encode_command('MGET', 'c')]
+
+
+def test_error_reply():
+    async def scenario(store):
+        with pytest.raises(redis.ResponseError):
+            await store.get('key')
+
+    run_against([b'-WRONGTYPE Operation against a key\r\n'], scenario)
+
+
+def test_connection_error():
+    async def scenario():
+        store = AsyncRedisStore(host='localhost', port=1, retry_policy=RetryPolicy(max_retries=0))
+        with pytest.raises(redis.ConnectionError):
+            await store.get('key')
+
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+import hashlib
+import datetime
+
+from auth import AdminDigest, check_user_token, user_digest, verified_digests, verify_token
+from constants import ADMIN_SALT, SALT
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def expected_admin_digest(moment):
+    return hashlib.sha512((moment.strftime("%Y%m%d%H") + ADMIN_SALT).encode()).hexdigest()
+
+
+def test_user_digest():
+    expected = hashlib.sha512(('horns&hoofs' + 'h&f' + SALT).encode()).hexdigest()
+    assert user_digest('horns&hoofs', 'h&f') == expected
+
+
+def test_only_verified_digests_are_cached():
+    verified_digests.clear()
+    hits = verified_digests.hits
+    token = user_digest('horns&hoofs', 'h&f')
+    assert not check_user_token('horns&hoofs', 'h&f', 'forged')
+    assert len(verified_digests) == 0
+    assert check_user_token('horns&hoofs', 'h&f', token)
+    assert check_user_token('horns&hoofs', 'h&f', token)
+    assert not check_user_token('horns&hoofs', 'h&f', 'forged')
+    assert verified_digests.hits - hits == 2
+    long_login = 'x' * 1000
+    assert check_user_token('horns&hoofs', long_login, user_digest('horns&hoofs', long_login))
+    assert len(verified_digests) == 1
+
+
+def test_admin_digest_rolls_over_each_hour():
+    moment = datetime.datetime(2020, 3, 1, 10, 59, 59)
+    clock = Clock(moment.timestamp())
+    admin = AdminDigest(clock)
+    assert admin.get() == expected_admin_digest(moment)
+    clock.now += 1
+    assert admin.get() == expected_admin_digest(moment + datetime.timedelta(seconds=1))
+    assert admin.get() != expected_admin_digest(moment)
+
+
+def test_admin_digest_is_computed_once_per_window(monkeypatch):
+    admin = AdminDigest(Clock(datetime.datetime(2020, 3, 1, 10).timestamp()))
+    calls = []
+    rollover = admin.rollover
+    monkeypatch.setattr(admin, 'rollover', lambda now: calls.append(now) or rollover(now))
+    for _ in range(3):
+        admin.get()
+    assert len(calls) == 1
+
+
+def test_verify_token():
+    assert verify_token('abc', 'abc')
+    assert not verify_token('abc', 'abd')
+    assert not verify_token('abc', None)
+    assert not verify_token('abc', 'тест')
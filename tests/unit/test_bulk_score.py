@@ -0,0 +1,67 @@
+import io
+import json
+
+from bulk_score import bulk_score, read_chunks, clean_line
+
+
+class DictStore:
+    def __init__(self):
+        self.data = {}
+
+    def cache_get(self, key):
+        return self.data.get(key)
+
+    def cache_get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def cache_set_many(self, mapping, expire):
+        self.data.update(mapping)
+
+
+VALID = {'phone': '79175002040', 'email': 'stupnikov@otus.ru'}
+
+LINES = [
+    json.dumps(VALID).encode() + b'\n',
+    b'\n',
+    b'{broken\n',
+    json.dumps({'phone': '79175002040'}).encode() + b'\n',
+    json.dumps([1, 2]).encode() + b'\n',
+    json.dumps(dict(VALID, first_name='a', last_name='b')).encode() + b'\n',
+]
+
+
+def scored(output):
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_clean_line():
+    arguments, error = clean_line(LINES[0])
+    assert error is None
+    assert arguments['phone'] == VALID['phone'] and arguments['gender'] is None
+    assert clean_line(LINES[2]) == (None, 'Invalid JSON')
+    arguments, error = clean_line(LINES[3])
+    assert arguments is None and 'pairs' in error
+
+
+def test_read_chunks_skips_blank_lines_and_keeps_numbers():
+    chunks = list(read_chunks(LINES, 2))
+    assert [[number for number, _ in chunk] for chunk in chunks] == [[1, 3], [4, 5], [6]]
+
+
+def test_bulk_score_in_process():
+    output = io.BytesIO()
+    assert bulk_score(LINES, output, DictStore, chunk_size=2) == 5
+    rows = scored(output)
+    assert [row['line'] for row in rows] == [1, 3, 4, 5, 6]
+    assert [row['score'] for row in rows] == [3.0, None, None, None, 3.5]
+    assert rows[0]['error'] is None
+    assert rows[3]['error'] == 'Arguments must be an object'
+
+
+def test_bulk_score_with_workers_keeps_input_order():
+    lines = [json.dumps(dict(VALID, first_name=str(i), last_name='x' if i % 3 else '')).encode() for i in range(500)]
+    output = io.BytesIO()
+    assert bulk_score(lines, output, DictStore, workers=3, chunk_size=7, window=2) == 500
+    rows = scored(output)
+    assert [row['line'] for row in rows] == list(range(1, 501))
+    assert [row['score'] for row in rows] == [3.5 if i % 3 else 3.0 for i in range(500)]
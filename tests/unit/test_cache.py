@@ -0,0 +1,255 @@
+import time
+
+import redis
+from mock import Mock
+
+from cache import LRUCache, LocalCachedStore, InterestsCache, KeyspaceListener, notifications_enabled
+from scoring import get_interests_many
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_lru_cache_expires_entries():
+    clock = Clock()
+    cache = LRUCache(ttl=60, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=10)
+    clock.now = 10
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    clock.now = 60
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_local_cached_store_reads_through_once():
+    store = Mock()
+    store.cache_get.return_value = b'3.0'
+    cached = LocalCachedStore(store, LRUCache())
+    assert cached.cache_get('uid:1') == b'3.0'
+    assert cached.cache_get('uid:1') == b'3.0'
+    store.cache_get.assert_called_once_with('uid:1')
+    assert cached.cache.stats()['hits'] == 1
+
+
+def test_local_cached_store_writes_both_tiers():
+    store = Mock()
+    clock = Clock()
+    cached = LocalCachedStore(store, LRUCache(ttl=3600, clock=clock))
+    cached.cache_set('uid:1', 3.0, 60)
+    store.cache_set.assert_called_once_with('uid:1', 3.0, 60)
+    assert cached.cache_get('uid:1') == 3.0
+    clock.now = 60
+    store.cache_get.return_value = None
+    assert cached.cache_get('uid:1') is None
+
+
+def test_local_cached_store_keeps_read_through_values_for_fill_ttl():
+    store = Mock()
+    clock = Clock()
+    store.cache_get.return_value = b'3.0'
+    store.cache_get_many.return_value = [b'1.5']
+    cached = LocalCachedStore(store, LRUCache(ttl=3600, clock=clock), fill_ttl=60)
+    assert cached.cache_get('uid:1') == b'3.0'
+    assert cached.cache_get_many(['uid:2']) == [b'1.5']
+    store.cache_get.return_value = None
+    clock.now = 59
+    assert cached.cache_get('uid:1') == b'3.0'
+    clock.now = 60
+    assert cached.cache_get('uid:1') is None
+    assert cached.cache.get('uid:2') is None
+
+
+def test_local_cached_store_does_not_cache_misses():
+    store = Mock()
+    store.cache_get.return_value = None
+    cached = LocalCachedStore(store)
+    assert cached.cache_get('uid:1') is None
+    assert cached.cache_get('uid:1') is None
+    assert store.cache_get.call_count == 2
+
+
+def test_local_cached_store_delegates_other_calls():
+    store = Mock()
+    store.get_many.return_value = [b'1']
+    assert LocalCachedStore(store).get_many(['i:1']) == [b'1']
+
+
+def test_lru_cache_bounded_in_bytes():
+    cache = LRUCache(max_bytes=10, sizeof=lambda key, value: len(value))
+    cache.set('a', 'xxxx')
+    cache.set('b', 'yyyy')
+    cache.set('a', 'xxxxx')
+    assert cache.bytes == 9
+    cache.set('c', 'zz')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'xxxxx' and cache.get('c') == 'zz'
+    assert cache.bytes == 7
+    cache.delete('a')
+    assert cache.bytes == 2
+    cache.clear()
+    assert cache.bytes == 0
+
+
+class InterestsBackend:
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+        self.on_read = None
+
+    def get_many(self, keys):
+        self.reads.append(list(keys))
+        values = [self.data.get(key) for key in keys]
+        if self.on_read:
+            self.on_read()
+        return values
+
+
+def subscribed(cache):
+    cache.handle_notification({'type': 'psubscribe', 'pattern': None, 'channel': b'__keyspace@0__:i:*', 'data': 1})
+
+
+def notification(key, event=b'set'):
+    return {'type': 'pmessage', 'pattern': b'__keyspace@0__:i:*', 'channel': f'__keyspace@0__:{key}'.encode(),
+            'data': event}
+
+
+def test_interests_cache_is_inactive_until_subscribed():
+    backend = InterestsBackend({'i:1': b'["cars"]'})
+    cache = InterestsCache(backend)
+    assert cache.get('i:1') == b'["cars"]'
+    assert cache.get('i:1') == b'["cars"]'
+    assert len(backend.reads) == 2
+    assert len(cache.cache) == 0
+
+
+def test_interests_cache_serves_hot_keys_and_applies_notifications():
+    backend = InterestsBackend({'i:1': b'["cars"]'})
+    cache = InterestsCache(backend)
+    subscribed(cache)
+    assert cache.get_many(['i:1', 'i:2']) == [b'["cars"]', None]
+    assert cache.get_many(['i:1', 'i:2', 'other']) == [b'["cars"]', None, None]
+    assert backend.reads == [['i:1', 'i:2'], ['other']]
+    for message in (notification('i:1'), notification('i:2')):
+        backend.data.update({'i:1': b'["pets"]', 'i:2': b'["books"]'})
+        cache.handle_notification(message)
+    assert cache.get_many(['i:1', 'i:2']) == [b'["pets"]', b'["books"]']
+    cache.handle_notification(notification('i:1', b'del'))
+    del backend.data['i:1']
+    assert cache.get('i:1') is None
+
+
+def test_interests_cache_skips_values_raced_by_invalidation():
+    backend = InterestsBackend({'i:1': b'["cars"]'})
+    cache = InterestsCache(backend)
+    subscribed(cache)
+    backend.on_read = lambda: cache.handle_notification(notification('i:1'))
+    assert cache.get('i:1') == b'["cars"]'
+    assert len(cache.cache) == 0
+
+
+def test_interests_cache_dropped_with_subscription():
+    backend = InterestsBackend({'i:1': b'["cars"]'})
+    cache = InterestsCache(backend)
+    subscribed(cache)
+    cache.get('i:1')
+    cache.deactivate()
+    assert len(cache.cache) == 0 and not cache.active
+
+
+def test_get_interests_many_through_interests_cache():
+    backend = InterestsBackend({'i:1': b'["cars"]', 'i:2': b'["pets"]'})
+    cache = InterestsCache(backend)
+    subscribed(cache)
+    assert get_interests_many(cache, [1, 2]) == {1: ['cars'], 2: ['pets']}
+    assert get_interests_many(cache, [2, 1]) == {2: ['pets'], 1: ['cars']}
+    assert len(backend.reads) == 1
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = messages
+        self.patterns = []
+
+    def psubscribe(self, pattern):
+        self.patterns.append(pattern)
+        self.messages.insert(0, {'type': 'psubscribe', 'pattern': None, 'channel': pattern.encode(), 'data': 1})
+
+    def get_message(self, timeout=0):
+        if not self.messages:
+            time.sleep(0.001)
+            return None
+        message = self.messages.pop(0)
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def close(self):
+        pass
+
+
+def redis_client(stream, flags='Kx$g'):
+    return Mock(pubsub=Mock(return_value=stream),
+                config_get=Mock(return_value={'notify-keyspace-events': flags}))
+
+
+def test_notifications_enabled_requires_keyspace_events():
+    assert notifications_enabled(redis_client(None, 'K$g'))
+    assert notifications_enabled(redis_client(None, 'KA'))
+    assert not notifications_enabled(redis_client(None, ''))
+    assert not notifications_enabled(redis_client(None, 'E$g'))
+    assert not notifications_enabled(redis_client(None, 'K$'))
+    client = Mock(config_get=Mock(side_effect=redis.ResponseError('unknown command')))
+    assert not notifications_enabled(client)
+
+
+def test_keyspace_listener_stays_inactive_without_notifications():
+    cache = InterestsCache(InterestsBackend({}))
+    streams = [FakePubSub([]), FakePubSub([])]
+    clients = iter([redis_client(streams[0], flags=''), redis_client(streams[1])])
+    listener = KeyspaceListener(cache, lambda: next(clients), reconnect_delay=0, recheck_delay=0.05)
+    listener.start()
+    time.sleep(0.02)
+    assert not cache.active
+    deadline = time.monotonic() + 5
+    while not cache.active and time.monotonic() < deadline:
+        time.sleep(0.001)
+    listener.stop()
+    assert streams[0].messages and not streams[1].messages
+
+
+def test_keyspace_listener_feeds_notification_stream():
+    backend = InterestsBackend({'i:1': b'["cars"]'})
+    cache = InterestsCache(backend)
+    streams = [FakePubSub([notification('i:1'), redis.ConnectionError()]), FakePubSub([])]
+    clients = iter(redis_client(stream) for stream in streams)
+    listener = KeyspaceListener(cache, lambda: next(clients), db=3, reconnect_delay=0)
+    listener.start()
+    deadline = time.monotonic() + 5
+    while not streams[1].patterns and time.monotonic() < deadline:
+        time.sleep(0.001)
+    while not cache.active and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert streams[0].patterns == streams[1].patterns == ['__keyspace@3__:i:*']
+    assert cache.active
+    cache.get('i:1')
+    assert len(cache.cache) == 1
+    listener.stop()
+    assert not cache.active and len(cache.cache) == 0
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+import codec
+from codec import available_codecs, benchmark, interests_payload, load_codec
+
+
+@pytest.mark.parametrize('backend', available_codecs(), ids=lambda c: c.name)
+def test_backend_matches_stdlib(backend):
+    payload = {'response': {1: ['travel', 'кино'], 2: []}, 'code': 200, 'score': 3.0}
+    encoded = backend.dumps(payload)
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == json.loads(json.dumps(payload))
+    assert backend.loads(encoded) == backend.loads(encoded.decode())
+
+
+def test_orjson_keeps_integers_wider_than_64_bits():
+    backend = pytest.importorskip('orjson') and load_codec('orjson')
+    big = 10 ** 20
+    assert backend.loads(b'{"client_ids": [100000000000000000000, 1]}') == {'client_ids': [big, 1]}
+    assert backend.loads(memoryview(b'[100000000000000000000]')) == [big]
+    assert backend.loads('[100000000000000000000]') == [big]
+    assert json.loads(backend.dumps({'response': {big: ['cars']}, 'code': 200})) == \
+        {'response': {str(big): ['cars']}, 'code': 200}
+    assert backend.loads(b'[1.5, 12345]') == [1.5, 12345]
+
+
+def test_stdlib_is_always_available():
+    assert 'json' in [c.name for c in available_codecs()]
+    assert load_codec('json').dumps({'a': 1}) == b'{"a": 1}'
+
+
+def test_default_backend_is_fastest_installed():
+    assert codec.backend.name == available_codecs()[0].name
+
+
+def test_benchmark_reports_every_backend():
+    results = benchmark(interests_payload(10), number=1)
+    assert set(results) == {c.name for c in available_codecs()}
+    assert all(set(timings) == {'dumps', 'loads'} for timings in results.values())
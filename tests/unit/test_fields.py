@@ -9,7 +9,10 @@ from fields import (
     BirthDayField,
     GenderField,
     ClientIDsField,
+    DateString,
+    parse_date,
 )
+import datetime
 
 from exceptions import ValidationError
 
@@ -311,3 +314,28 @@ def test_clientidsfield_not_valid(required, nullable, value, ex_mes):
     with pytest.raises(ValidationError) as e:
         field.validate(value)
     assert str(e.value) == ex_mes
+
+
+@pytest.mark.parametrize('field', [DateField(), BirthDayField()])
+@pytest.mark.parametrize('value', [True, 20171231])
+def test_datefield_not_a_string(field, value):
+    with pytest.raises(ValidationError) as e:
+        field.validate(value)
+    assert str(e.value) == 'Incorrect date format, DD.MM.YYYY expected'
+
+
+def test_clean_returns_value():
+    assert EmailField().clean('a@b') == 'a@b'
+
+
+def test_datefield_clean_returns_parsed_date():
+    value = BirthDayField().clean('1.2.2000')
+    assert isinstance(value, DateString)
+    assert value == '01.02.2000'
+    assert value.date == datetime.date(2000, 2, 1)
+
+
+def test_parse_date_is_memoized():
+    parse_date.cache_clear()
+    assert parse_date('20.07.2017') is parse_date('20.07.2017')
+    assert parse_date.cache_info().hits == 1
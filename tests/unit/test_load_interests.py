@@ -0,0 +1,65 @@
+import io
+import json
+
+import pytest
+
+import scoring
+import load_interests as load_interests_module
+from load_interests import read_jsonl, read_csv, load_interests
+
+
+class MemoryStore:
+    def __init__(self):
+        self.data = {}
+        self.writes = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set_many(self, mapping):
+        self.writes.append(list(mapping))
+        self.data.update(mapping)
+
+
+def test_read_jsonl():
+    lines = [b'{"cid": 1, "interests": ["cars"]}\n', b'\n', b'{"cid": 2, "interests": []}\n']
+    assert list(read_jsonl(lines)) == [(1, ['cars']), (2, [])]
+
+
+def test_read_csv():
+    dump = io.BytesIO(b'cid,interests\n1,cars;pets\n2,\n')
+    assert list(read_csv(dump)) == [(1, ['cars', 'pets']), (2, [])]
+
+
+def test_load_interests_as_json_in_batches():
+    store = MemoryStore()
+    records = [(cid, ['cars']) for cid in range(5)]
+    assert load_interests(store, records, batch_size=2) == 5
+    assert store.writes == [['i:0', 'i:1'], ['i:2', 'i:3'], ['i:4']]
+    assert json.loads(store.data['i:4']) == ['cars']
+
+
+def test_load_packed_interests_extends_vocabulary(monkeypatch):
+    monkeypatch.setattr(scoring, 'interests_vocabulary', scoring.InterestsVocabulary())
+    store = MemoryStore()
+    store.data[scoring.VOCABULARY_KEY] = b'["books"]'
+    load_interests(store, [(1, ['cars', 'books']), (2, ['pets'])], batch_size=1, packed=True)
+    assert json.loads(store.data[scoring.VOCABULARY_KEY]) == ['books', 'cars', 'pets']
+    assert store.writes[0] == [scoring.VOCABULARY_KEY]
+    assert store.writes[1] == ['i:1']
+    load_interests(store, [(3, ['books'])], packed=True)
+    assert store.writes[-1] == ['i:3']
+    assert scoring.get_interests_many(store, [1, 2, 3]) == {1: ['cars', 'books'], 2: ['pets'], 3: ['books']}
+
+
+def test_load_packed_interests_fails_before_overflowing_vocabulary(monkeypatch):
+    monkeypatch.setattr(load_interests_module, 'MAX_VOCABULARY_SIZE', 2)
+    store = MemoryStore()
+    store.data[scoring.VOCABULARY_KEY] = b'["books"]'
+    with pytest.raises(ValueError, match='vocabulary is full'):
+        load_interests(store, [(1, ['cars']), (2, ['books', 'pets'])], batch_size=2, packed=True)
+    assert store.writes == []
+    assert json.loads(store.data[scoring.VOCABULARY_KEY]) == ['books']
@@ -0,0 +1,56 @@
+import threading
+
+import api
+from server import ThreadPoolHTTPServer
+from loadtest import LoadRunner, generate_corpus, percentile, summarize, compare
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([5], 95) == 5
+    assert percentile([], 50) == 0
+
+
+def test_generated_corpus_is_authenticated():
+    corpus = generate_corpus(10)
+    assert {body['method'] for body in corpus} == {'online_score', 'clients_interests'}
+    assert all(api.check_auth(api.MethodRequest(**body)) for body in corpus)
+
+
+def test_summarize_and_compare():
+    results = [('online_score', 200, 0.01), ('online_score', 422, 0.03), ('clients_interests', 200, 0.02)]
+    report = summarize(results, elapsed=1)
+    assert report['online_score']['requests'] == 2
+    assert report['online_score']['codes'] == {'200': 1, '422': 1}
+    assert report['online_score']['max'] == 0.03
+    assert report['total']['rps'] == 3
+    diff = compare(report, summarize(results[:1] + results[2:], elapsed=1))
+    assert round(diff['online_score']['max']) == 200
+
+
+class DictStore(dict):
+    def cache_get(self, key):
+        return self.get(key)
+
+    def cache_set(self, key, value, expire):
+        self[key] = value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+
+def test_runner_against_server():
+    handler = type('Handler', (api.MainHTTPHandler,), {'store': DictStore()})
+    server = ThreadPoolHTTPServer(('localhost', 0), handler, workers=2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        runner = LoadRunner('localhost', server.server_address[1], generate_corpus(4), concurrency=2)
+        results, elapsed = runner.run(requests=20)
+    finally:
+        server.shutdown()
+        server.server_close()
+    report = summarize(results, elapsed)
+    assert report['total']['requests'] == 20
+    assert report['total']['codes'] == {'200': 20}
@@ -0,0 +1,68 @@
+import json
+import logging
+
+import pytest
+from mock import Mock
+
+from logs import AccessLog, JSONFormatter, TextFormatter, setup_logging, truncate
+
+
+def make_record(message, context=None):
+    record = logging.LogRecord('access', logging.INFO, __file__, 1, message, None, None)
+    if context is not None:
+        record.context = context
+    return record
+
+
+def test_truncate():
+    assert truncate(b'{"a": 1}', 100) == '{"a": 1}'
+    assert truncate(b'x' * 10, 4) == 'xxxx... (10 bytes)'
+    assert truncate({'a': 1}, 3) == "{'a... (8 chars)"
+
+
+def test_json_formatter_merges_context():
+    entry = json.loads(JSONFormatter().format(make_record('done', {'request_id': 'r1', 'code': 200})))
+    assert entry['message'] == 'done'
+    assert entry['level'] == 'INFO'
+    assert entry['request_id'] == 'r1' and entry['code'] == 200
+
+
+def test_text_formatter_appends_context():
+    assert TextFormatter().format(make_record('done', {'code': 200})).endswith("done {'code': 200}")
+    assert TextFormatter().format(make_record('done')).endswith('done')
+
+
+def test_access_log_samples_only_successes():
+    logger = Mock()
+    access_log = AccessLog(sample_rate=0.0, logger=logger)
+    access_log.log('/method/', 200, b'{}', b'{}', {})
+    assert not logger.info.called
+    access_log.log('/method/', 422, b'{}', b'{}', {})
+    assert logger.info.call_count == 1
+
+
+def test_access_log_caps_payload():
+    logger = Mock()
+    AccessLog(max_payload=4, logger=logger).log('/method/', 200, b'{"a": 1}', b'{"response": 1}', {'request_id': 'r'})
+    context = logger.info.call_args[1]['extra']['context']
+    assert context['request'] == '{"a"... (8 bytes)'
+    assert context['response'] == '{"re... (15 bytes)'
+    assert context['request_id'] == 'r' and context['code'] == 200
+
+
+@pytest.fixture()
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_queued_logging_writes_in_background(root_logger, tmp_path):
+    path = tmp_path / 'api.log'
+    listener = setup_logging(str(path), structured=True)
+    logging.getLogger('access').info('served', extra={'context': {'code': 200}})
+    listener.stop()
+    entry = json.loads(path.read_text())
+    assert entry['message'] == 'served' and entry['code'] == 200
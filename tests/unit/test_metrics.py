@@ -0,0 +1,59 @@
+import threading
+
+from metrics import Counter, Histogram, Registry, MultiprocessMetrics
+
+
+def test_counter_sums_thread_shards():
+    counter = Counter('requests_total', 'Requests.', ('method',), registry=Registry())
+
+    def work():
+        for _ in range(1000):
+            counter.inc(('online_score',))
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(('clients_interests',), 2)
+    assert counter.get(('online_score',)) == 4000
+    assert counter.get(('clients_interests',)) == 2
+
+
+def test_histogram_buckets():
+    histogram = Histogram('latency_seconds', 'Latency.', ('stage',), buckets=(0.1, 1), registry=Registry())
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, ('parse',))
+    assert histogram.count(('parse',)) == 4
+    assert histogram.render() == [
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{stage="parse",le="0.1"} 2',
+        'latency_seconds_bucket{stage="parse",le="1"} 3',
+        'latency_seconds_bucket{stage="parse",le="+Inf"} 4',
+        'latency_seconds_sum{stage="parse"} 2.65',
+        'latency_seconds_count{stage="parse"} 4',
+    ]
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    Counter('hits_total', 'Cache hits.', registry=registry).inc()
+    assert registry.render() == b'# HELP hits_total Cache hits.\n# TYPE hits_total counter\nhits_total 1\n'
+
+
+def test_multiprocess_metrics_add_up_worker_snapshots(tmp_path):
+    workers = []
+    for i in range(3):
+        registry = Registry()
+        Counter('hits_total', 'Cache hits.', registry=registry).inc(amount=i + 1)
+        Histogram('latency_seconds', 'Latency.', buckets=(1,), registry=registry).observe(0.5)
+        metrics = MultiprocessMetrics(str(tmp_path), registry)
+        metrics.path = str(tmp_path / f'{i}.json')
+        workers.append(metrics)
+    for metrics in workers[1:]:
+        metrics.write()
+    (tmp_path / 'broken.json').write_text('{')
+    rendered = workers[0].render().decode()
+    assert 'hits_total 6\n' in rendered
+    assert 'latency_seconds_count 3\n' in rendered
@@ -0,0 +1,33 @@
+import pytest
+
+from api import BasicRequest, MethodRequest, OnlineScoreRequest
+from fields import CharField, GenderField
+from exceptions import ValidationError
+
+
+def test_request_is_slotted():
+    request = OnlineScoreRequest(first_name='Ivan', phone=71234567890, unknown='ignored')
+    assert not hasattr(request, '__dict__')
+    assert request.first_name == 'Ivan'
+    assert request.phone == 71234567890
+    assert request.email is None
+    with pytest.raises(AttributeError):
+        request.unknown = 1
+
+
+def test_fields_are_collected_once():
+    assert list(MethodRequest._fields) == ['account', 'arguments', 'login', 'method', 'token']
+    assert MethodRequest(login='admin', token='', arguments={}, method='m').is_admin
+
+
+def test_fields_are_inherited():
+    class Base(BasicRequest):
+        name = CharField(required=True)
+
+    class Child(Base):
+        gender = GenderField()
+
+    assert list(Child._fields) == ['gender', 'name']
+    assert Child(name='a', gender=1).name == 'a'
+    with pytest.raises(ValidationError):
+        Child(gender=1)
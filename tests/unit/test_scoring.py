@@ -1,9 +1,18 @@
 import json
+import time
+import random
+import asyncio
+import threading
 import pytest
 from mock import Mock
 import redis
 
-from scoring import get_score, get_interests
+import scoring
+from store import PrefetchedStore
+from scoring import (
+    ScoreLock, InterestsVocabulary, pack_interests, unpack_interests, get_score, get_interests, get_score_async,
+    get_interests_async, get_interests_many, get_scores
+)
 
 
 def test_get_score_with_cache_data():
@@ -27,6 +36,13 @@ def test_get_score_cache_connection_error():
     assert score == 3
 
 
+def test_get_score_cache_set_connection_error():
+    store = Mock()
+    store.cache_get.return_value = None
+    store.cache_set.side_effect = redis.ConnectionError()
+    assert get_score(store, 71234567890, 'email@com') == 3
+
+
 def test_get_interests_with_store():
     cid = 1
     interests = '{"dogs": 1}'
@@ -39,3 +55,264 @@ def test_get_interests_without_store():
     store.get.side_effect = redis.ConnectionError()
     with pytest.raises(Exception):
         get_interests(store, 1)
+
+
+def test_get_interests_many_fetches_unique_keys_once():
+    store = Mock()
+    store.get_many.return_value = ['["dogs"]', None]
+    assert get_interests_many(store, [1, 2, 1]) == {1: ['dogs'], 2: []}
+    store.get_many.assert_called_once_with(['i:1', 'i:2'])
+
+
+class AsyncStore:
+    def __init__(self, data):
+        self.data = data
+
+    async def cache_get(self, key):
+        return self.data.get(key)
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def cache_set(self, key, value, expire):
+        self.data[key] = value
+
+
+def test_get_score_from_redis_bytes():
+    store = Mock()
+    store.cache_get.return_value = b'3.0'
+    assert get_score(store, 71234567890, 'email@com') == 3.0
+
+
+def test_get_score_async_caches_result():
+    store = AsyncStore({})
+    assert asyncio.run(get_score_async(store, 71234567890, 'email@com', '01.10.2016')) == 3
+    assert list(store.data.values()) == [3]
+
+
+def test_get_interests_async():
+    store = AsyncStore({'i:1': '["dogs"]'})
+    assert asyncio.run(get_interests_async(store, 1)) == ['dogs']
+    assert asyncio.run(get_interests_async(store, 2)) == []
+
+
+class DictStore:
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.calls = []
+
+    def cache_get(self, key):
+        return self.data.get(key)
+
+    def cache_set(self, key, value, expire):
+        self.data[key] = str(value)
+
+    def cache_get_many(self, keys):
+        self.calls.append('cache_get_many')
+        return [self.data.get(key) for key in keys]
+
+    def cache_set_many(self, mapping, expire):
+        self.calls.append('cache_set_many')
+        self.data.update((key, str(value)) for key, value in mapping.items())
+
+
+def random_columns(size, seed=0):
+    rnd = random.Random(seed)
+    columns = {'phone': [], 'email': [], 'birthday': [], 'gender': [], 'first_name': [], 'last_name': []}
+    for _ in range(size):
+        columns['phone'].append(rnd.choice([None, '', 79175002040, '79175002040']))
+        columns['email'].append(rnd.choice([None, '', 'a@b']))
+        columns['birthday'].append(rnd.choice([None, '01.01.2000']))
+        columns['gender'].append(rnd.choice([None, 0, 1, 2]))
+        columns['first_name'].append(rnd.choice([None, '', 'a']))
+        columns['last_name'].append(rnd.choice([None, 'b']))
+    return columns
+
+
+@pytest.mark.parametrize('use_numpy', [False, True], ids=['array', 'numpy'])
+def test_get_scores_matches_get_score(use_numpy, monkeypatch):
+    if use_numpy and scoring.numpy is None:
+        pytest.skip('numpy is not installed')
+    if not use_numpy:
+        monkeypatch.setattr(scoring, 'numpy', None)
+    columns = random_columns(300)
+    cached = DictStore({scoring.score_key('79175002040', '01.01.2000', 'a', 'b'): '7.5'})
+    expected_store = DictStore(cached.data)
+    rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    expected = [get_score(expected_store, **row) for row in rows]
+    scores = get_scores(cached, **columns)
+    assert scores == expected
+    assert [type(score) for score in scores] == [type(score) for score in expected]
+    assert cached.data == expected_store.data
+    assert cached.calls == ['cache_get_many', 'cache_set_many']
+
+
+def test_get_scores_all_cached_skips_set():
+    store = DictStore()
+    get_scores(store, ['79175002040'], ['a@b'])
+    assert get_scores(store, ['79175002040'], ['a@b']) == [3.0]
+    assert store.calls == ['cache_get_many', 'cache_set_many', 'cache_get_many']
+
+
+def test_get_scores_cache_connection_error():
+    store = Mock()
+    store.cache_get_many.side_effect = redis.ConnectionError()
+    store.cache_set_many.side_effect = redis.ConnectionError()
+    assert get_scores(store, [71234567890, None], ['email@com', None], ['01.10.2016', None], [1, None]) == [4.5, 0.0]
+
+
+class SlowStore(DictStore):
+    """
+    Store whose cache writes wait until `readers` lookups missed the cache.
+    """
+    def __init__(self, readers):
+        super().__init__()
+        self.readers = readers
+        self.misses = 0
+        self.sets = 0
+
+    def cache_get(self, key):
+        value = super().cache_get(key)
+        if value is None:
+            self.misses += 1
+        return value
+
+    def cache_set(self, key, value, expire):
+        self.sets += 1
+        deadline = time.monotonic() + 5
+        while self.misses < self.readers and time.monotonic() < deadline:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        super().cache_set(key, value, expire)
+
+
+def test_get_score_computes_concurrent_misses_once():
+    store = SlowStore(readers=4)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(get_score(store, '79175002040', 'a@b')))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == [3.0] * 4
+    assert store.sets == 1
+
+
+class LockStore(DictStore):
+    def __init__(self, data=None, locked=False):
+        super().__init__(data)
+        self.locks = {'lock:key': 'other'} if locked else {}
+
+    def acquire_lock(self, key, token, ttl):
+        return self.locks.setdefault(key, token) == token
+
+    def release_lock(self, key, token):
+        if self.locks.get(key) == token:
+            del self.locks[key]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_score_lock_holder_fills_and_releases():
+    store = LockStore()
+    assert ScoreLock().run(store, 'key', lambda: 3.0) == 3.0
+    assert store.locks == {}
+
+
+def test_score_lock_waits_for_holder_result():
+    store, clock = LockStore(locked=True), FakeClock()
+
+    def sleep(seconds):
+        clock.sleep(seconds)
+        store.data['key'] = '4.5'
+
+    lock = ScoreLock(ttl=1, sleep=sleep, clock=clock)
+    assert lock.run(store, 'key', lambda: pytest.fail('computed while locked')) == 4.5
+
+
+def test_score_lock_computes_after_holder_times_out():
+    store, clock = LockStore(locked=True), FakeClock()
+    lock = ScoreLock(ttl=1, poll_interval=0.1, sleep=clock.sleep, clock=clock)
+    assert lock.run(store, 'key', lambda: 3.0) == 3.0
+    assert clock.now >= 1
+    assert store.locks == {'lock:key': 'other'}
+
+
+def test_get_score_uses_score_lock(monkeypatch):
+    store = LockStore()
+    acquired = []
+    original = store.acquire_lock
+    store.acquire_lock = lambda key, token, ttl: acquired.append(key) or original(key, token, ttl)
+    monkeypatch.setattr(scoring, 'score_lock', ScoreLock())
+    assert get_score(store, '79175002040', 'a@b') == 3.0
+    assert acquired == ['lock:' + scoring.score_key('79175002040')]
+    assert store.locks == {}
+
+
+def test_batch_fills_do_not_take_score_lock(monkeypatch):
+    store = LockStore(locked=True)
+    store.acquire_lock = lambda key, token, ttl: pytest.fail('locked a batch fill')
+    batch_store = PrefetchedStore(store)
+    batch_store.prefetch([scoring.score_key('79175002040')])
+    monkeypatch.setattr(scoring, 'score_lock', ScoreLock(sleep=lambda seconds: pytest.fail('waited')))
+    assert get_score(batch_store, '79175002040', 'a@b') == 3.0
+    assert batch_store.writes == {scoring.score_key('79175002040'): (3.0, 60 * 60)}
+
+
+class InterestsStore:
+    def __init__(self, data):
+        self.data = data
+        self.gets = []
+
+    def get(self, key):
+        self.gets.append(key)
+        return self.data.get(key)
+
+    def get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+
+def test_pack_interests_round_trip():
+    assert unpack_interests(pack_interests([0, 3, 300])) == (0, 3, 300)
+    assert unpack_interests(b'["cars"]') is None
+    assert unpack_interests('["cars"]') is None
+
+
+def test_get_interests_many_reads_packed_and_json_values(monkeypatch):
+    monkeypatch.setattr(scoring, 'interests_vocabulary', InterestsVocabulary())
+    store = InterestsStore({
+        'i:1': pack_interests([1, 0]),
+        'i:2': b'["books"]',
+        'i:3': pack_interests([]),
+        scoring.VOCABULARY_KEY: b'["cars", "pets"]',
+    })
+    assert get_interests_many(store, [1, 2, 3, 4]) == {1: ['pets', 'cars'], 2: ['books'], 3: [], 4: []}
+    assert get_interests(store, 1) == ['pets', 'cars']
+    assert store.gets.count(scoring.VOCABULARY_KEY) == 1
+
+
+def test_vocabulary_reloads_when_it_grows(monkeypatch):
+    monkeypatch.setattr(scoring, 'interests_vocabulary', InterestsVocabulary())
+    store = InterestsStore({'i:1': pack_interests([0]), scoring.VOCABULARY_KEY: b'["cars"]'})
+    assert get_interests(store, 1) == ['cars']
+    store.data.update({'i:2': pack_interests([1]), scoring.VOCABULARY_KEY: b'["cars", "pets"]'})
+    assert get_interests(store, 2) == ['pets']
+    assert store.gets.count(scoring.VOCABULARY_KEY) == 2
+
+
+def test_get_interests_async_reads_packed_values(monkeypatch):
+    monkeypatch.setattr(scoring, 'interests_vocabulary', InterestsVocabulary())
+    store = AsyncStore({'i:1': pack_interests([1]), scoring.VOCABULARY_KEY: b'["cars", "pets"]'})
+    assert asyncio.run(get_interests_async(store, 1)) == ['pets']
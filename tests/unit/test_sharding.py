@@ -0,0 +1,136 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from sharding import HashRing, ShardedStore, parse_nodes
+from store import MemoryStore, BucketedScoreStore
+from scoring import get_score, get_interests_many
+
+
+KEYS = [f'uid:{i}' for i in range(5000)]
+
+
+def test_ring_spreads_keys_evenly():
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    counts = {}
+    for key in KEYS:
+        counts[ring.get(key)] = counts.get(ring.get(key), 0) + 1
+    assert set(counts) == {'a', 'b', 'c', 'd'}
+    assert all(abs(count - len(KEYS) / 4) < len(KEYS) / 4 * 0.25 for count in counts.values())
+
+
+def test_adding_node_moves_only_its_share_of_keys():
+    ring = HashRing(['a', 'b', 'c'])
+    before = {key: ring.get(key) for key in KEYS}
+    ring.add('d')
+    moved = [key for key in KEYS if ring.get(key) != before[key]]
+    assert all(ring.get(key) == 'd' for key in moved)
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+
+def test_removing_node_moves_only_its_keys():
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    before = {key: ring.get(key) for key in KEYS}
+    ring.remove('b')
+    assert all(ring.get(key) == owner for key, owner in before.items() if owner != 'b')
+    assert 'b' not in {ring.get(key) for key in KEYS}
+
+
+def test_ring_rejects_duplicates_and_empty_lookups():
+    ring = HashRing(['a'])
+    with pytest.raises(ValueError):
+        ring.add('a')
+    ring.remove('a')
+    with pytest.raises(LookupError):
+        ring.get('key')
+
+
+class RecordingStore(MemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.bulk_calls = 0
+        self.threads = set()
+
+    def get_many(self, keys):
+        self.bulk_calls += 1
+        self.threads.add(threading.current_thread().name)
+        return super().get_many(keys)
+
+
+@pytest.fixture()
+def sharded():
+    store = ShardedStore({name: RecordingStore() for name in ('a', 'b', 'c')})
+    yield store
+    store.close()
+
+
+def test_keys_are_stored_on_their_shard(sharded):
+    sharded.set_many({key: b'[]' for key in KEYS[:100]})
+    sharded.cache_set('score', 1.5, 60)
+    assert sharded.cache_get('score') == b'1.5'
+    for name, shard in sharded.shards.items():
+        assert all(sharded.ring.get(key) == name for key in shard.data)
+    assert sum(len(shard.data) for shard in sharded.shards.values()) == 101
+
+
+def test_bulk_reads_are_split_per_shard_in_parallel(sharded):
+    sharded.set_many({key: key.encode() for key in KEYS[:300]})
+    keys = KEYS[299::-1] + ['missing'] + KEYS[:300]
+    assert sharded.get_many(keys) == [key.encode() if key != 'missing' else None for key in keys]
+    assert [shard.bulk_calls for shard in sharded.shards.values()] == [1, 1, 1]
+    threads = [name for shard in sharded.shards.values() for name in shard.threads]
+    assert sorted(name.startswith('shard') for name in threads) == [False, True, True]
+
+
+class BarrierStore(MemoryStore):
+    def __init__(self, barrier):
+        super().__init__()
+        self.barrier = barrier
+
+    def get_many(self, keys):
+        self.barrier.wait()
+        return super().get_many(keys)
+
+
+def test_concurrent_bulk_reads_are_not_limited_by_shard_count():
+    barrier = threading.Barrier(8, timeout=5)
+    sharded = ShardedStore({name: BarrierStore(barrier) for name in ('a', 'b')}, workers_per_shard=2)
+    keys = [key for key in KEYS if sharded.ring.get(key) == 'a'][:1] + \
+        [key for key in KEYS if sharded.ring.get(key) == 'b'][:1]
+    try:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda _: sharded.get_many(keys), range(4)))
+    finally:
+        sharded.close()
+    assert results == [[None, None]] * 4
+
+
+def test_added_shard_takes_over_part_of_keys(sharded):
+    sharded.set_many({key: b'1' for key in KEYS})
+    sharded.add_shard('d', RecordingStore())
+    values = sharded.get_many(KEYS)
+    missing = [key for key, value in zip(KEYS, values) if value is None]
+    assert all(sharded.ring.get(key) == 'd' for key in missing)
+    assert 0.15 < len(missing) / len(KEYS) < 0.35
+    removed = sharded.remove_shard('d')
+    assert isinstance(removed, RecordingStore)
+    assert sharded.get_many(KEYS) == [b'1'] * len(KEYS)
+
+
+def test_scoring_on_sharded_store(sharded):
+    assert get_score(sharded, '79175002040', 'a@b') == 3.0
+    assert get_score(sharded, '79175002040', 'a@b') == 3.0
+    sharded.set_many({'i:1': b'["cars"]', 'i:2': b'["pets"]'})
+    assert get_interests_many(sharded, [1, 2, 3]) == {1: ['cars'], 2: ['pets'], 3: []}
+    bucketed = BucketedScoreStore(sharded, bucket_bits=4)
+    bucketed.cache_set_many({f'uid:{i:032x}': 1.5 for i in range(0, 2 ** 128, 2 ** 124)}, 60)
+    assert bucketed.cache_get_many([f'uid:{i:032x}' for i in range(0, 2 ** 128, 2 ** 124)]) == ['1.5'] * 16
+
+
+def test_parse_nodes():
+    assert parse_nodes('10.0.0.1:6379, :6380,/var/run/redis.sock') == {
+        '10.0.0.1:6379': {'host': '10.0.0.1', 'port': 6379, 'unix_socket_path': None},
+        ':6380': {'host': 'localhost', 'port': 6380, 'unix_socket_path': None},
+        '/var/run/redis.sock': {'unix_socket_path': '/var/run/redis.sock'},
+    }
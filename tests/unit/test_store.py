@@ -0,0 +1,319 @@
+import time
+import random
+
+import pytest
+import redis
+from mock import Mock
+
+from store import RedisStore, PrefetchedStore, BucketedScoreStore, WriteBehindStore, MemoryStore, ReplicaRoutedStore, \
+    make_connection_pool
+from scoring import get_score, score_key
+
+
+def test_tcp_pool_settings():
+    pool = make_connection_pool(host='redis.local', port=6380, max_connections=8, health_check_interval=10)
+    assert isinstance(pool, redis.BlockingConnectionPool)
+    assert pool.max_connections == 8
+    assert pool.connection_class is redis.Connection
+    assert pool.connection_kwargs['host'] == 'redis.local'
+    assert pool.connection_kwargs['socket_keepalive']
+    assert pool.connection_kwargs['health_check_interval'] == 10
+
+
+def test_unix_socket_pool():
+    pool = make_connection_pool(unix_socket_path='/tmp/redis.sock')
+    assert pool.connection_class is redis.UnixDomainSocketConnection
+    assert pool.connection_kwargs['path'] == '/tmp/redis.sock'
+
+
+def test_explicit_pool_is_shared():
+    pool = make_connection_pool()
+    first, second = RedisStore(connection_pool=pool), RedisStore(connection_pool=pool)
+    assert first.store.connection_pool is second.store.connection_pool is pool
+
+
+def test_reset_creates_new_pool_with_same_settings():
+    store = RedisStore(port=6380, max_connections=4)
+    pool = store.connection_pool
+    store.reset()
+    assert store.connection_pool is not pool
+    assert store.store.connection_pool is store.connection_pool
+    assert store.connection_pool.max_connections == 4
+    assert store.connection_pool.connection_kwargs['port'] == 6380
+
+
+def test_prefetched_store_serves_reads_from_prefetch():
+    store = Mock()
+    store.cache_get_many.return_value = [b'1.5', None]
+    store.get_many.side_effect = lambda keys: [b'[]' for _ in keys]
+    prefetched = PrefetchedStore(store)
+    prefetched.prefetch(['uid:1', 'uid:2', 'uid:1'], ['i:1'])
+    store.cache_get_many.assert_called_once_with(['uid:1', 'uid:2'])
+    assert prefetched.cache_get('uid:1') == b'1.5'
+    assert prefetched.cache_get('uid:2') is None
+    assert prefetched.get('i:1') == b'[]'
+    assert prefetched.get_many(['i:1', 'i:2']) == [b'[]', b'[]']
+    store.get_many.assert_called_with(['i:2'])
+    assert not store.cache_get.called and not store.get.called
+
+
+def test_prefetched_store_buffers_writes():
+    store = Mock()
+    prefetched = PrefetchedStore(store)
+    prefetched.cache_set('uid:1', 3.0, 60)
+    prefetched.cache_set('uid:2', 1.5, 60)
+    assert prefetched.cache_get('uid:1') == 3.0
+    assert not store.cache_set_many.called
+    prefetched.flush()
+    store.cache_set_many.assert_called_once_with({'uid:1': 3.0, 'uid:2': 1.5}, 60)
+
+
+def test_prefetch_tolerates_connection_error():
+    store = Mock()
+    store.cache_get_many.side_effect = redis.ConnectionError()
+    prefetched = PrefetchedStore(store)
+    prefetched.prefetch(['uid:1'])
+    assert prefetched.cached == {}
+
+
+class HashStore:
+    """
+    In-memory stand-in for RedisStore with string keys and hashes.
+    """
+    def __init__(self):
+        self.strings = {}
+        self.hashes = {}
+        self.expires = {}
+
+    def cache_get_many(self, keys):
+        return [self.strings.get(key) for key in keys]
+
+    def cache_set_many(self, mapping, expire):
+        self.strings.update(mapping)
+
+    def hash_get_many(self, items):
+        return [self.hashes.get(name, {}).get(field) for name, field in items]
+
+    def hash_set_many(self, items, expire):
+        for name, field, value in items:
+            self.hashes.setdefault(name, {})[field] = value
+            self.expires[name] = expire
+
+
+def test_bucketed_store_packs_scores_into_hashes():
+    clock = Mock(return_value=1000)
+    store = BucketedScoreStore(HashStore(), bucket_bits=8, clock=clock)
+    key = score_key('79175002040')
+    store.cache_set(key, 3.5, 60)
+    name, field = store.locate(key)
+    assert name == f's:0:{int(key[4:6], 16):x}'
+    assert field == bytes.fromhex(key[12:])
+    assert len(store.store.hashes[name][field]) == 12
+    assert store.store.expires == {name: 60}
+    assert store.store.strings == {}
+    assert store.cache_get(key) == '3.5'
+    clock.return_value = 1060
+    assert store.cache_get(key) is None
+
+
+def test_bucketed_store_keeps_score_precision():
+    store = BucketedScoreStore(HashStore())
+    store.cache_set(score_key('1'), 1.1, 60)
+    assert store.cache_get(score_key('1')) == '1.1'
+
+
+@pytest.mark.parametrize('bucket_bits', [0, 33])
+def test_bucketed_store_rejects_bucket_bits_out_of_range(bucket_bits):
+    with pytest.raises(ValueError):
+        BucketedScoreStore(HashStore(), bucket_bits=bucket_bits)
+
+
+def test_bucketed_store_drops_stale_buckets():
+    clock = Mock(return_value=1050)
+    memory = MemoryStore(clock=clock)
+    store = BucketedScoreStore(memory, bucket_bits=8, window=100, clock=clock)
+    first, second = score_key('1'), score_key('2')
+    store.cache_set(first, 1.5, 100)
+    clock.return_value = 1120
+    assert store.cache_get(first) == '1.5'
+    store.cache_set(second, 2.5, 100)
+    old_bucket, _ = store.locate(first, window=10)
+    assert store.locate(second)[0].startswith('s:b:')
+    clock.return_value = 1200
+    assert store.cache_get_many([first, second]) == [None, '2.5']
+    assert memory.hash_get_many([store.locate(first, window=10)]) == [None]
+    assert old_bucket not in memory.data
+
+
+def test_bucketed_store_reads_legacy_keys():
+    hashes = HashStore()
+    legacy, fresh = score_key('1'), score_key('2')
+    hashes.strings[legacy] = b'1.5'
+    store = BucketedScoreStore(hashes)
+    store.cache_set(fresh, 3.0, 60)
+    assert store.cache_get_many([legacy, fresh, score_key('3')]) == [b'1.5', '3.0', None]
+    store.legacy_reads = False
+    assert store.cache_get(legacy) is None
+
+
+def test_bucketed_store_passes_other_keys_through():
+    store = BucketedScoreStore(HashStore())
+    store.cache_set_many({'other': 'value', score_key('1'): 1.5}, 60)
+    assert store.store.strings == {'other': 'value'}
+    assert store.cache_get_many(['other', score_key('1')]) == ['value', '1.5']
+
+
+def test_get_score_with_bucketed_store():
+    store = BucketedScoreStore(HashStore())
+    assert get_score(store, '79175002040', 'a@b', first_name='a', last_name='b') == 3.5
+    assert get_score(store, '79175002040', 'a@b', first_name='a', last_name='b') == 3.5
+    assert sum(len(fields) for fields in store.store.hashes.values()) == 1
+
+
+class RecordingStore:
+    def __init__(self, fail=False):
+        self.data = {}
+        self.batches = []
+        self.fail = fail
+        self.closed = False
+
+    def cache_get(self, key):
+        return self.data.get(key)
+
+    def cache_get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def cache_set_many(self, mapping, expire):
+        if self.fail:
+            raise redis.ConnectionError()
+        self.batches.append((dict(mapping), expire))
+        self.data.update(mapping)
+
+    def close(self):
+        self.closed = True
+
+
+def test_write_behind_coalesces_and_flushes_on_close():
+    backend = RecordingStore()
+    store = WriteBehindStore(backend, flush_interval=0.5)
+    store.cache_set('a', 1, 60)
+    store.cache_set('a', 2, 60)
+    store.cache_set_many({'b': 3}, 30)
+    assert store.cache_get('a') == 2
+    assert store.cache_get_many(['b', 'c']) == [3, None]
+    store.close()
+    assert sorted(backend.batches, key=lambda batch: batch[1]) == [({'b': 3}, 30), ({'a': 2}, 60)]
+    assert backend.closed
+    with pytest.raises(RuntimeError):
+        store.cache_set('a', 1, 60)
+
+
+def test_write_behind_writes_in_background():
+    backend = RecordingStore()
+    store = WriteBehindStore(backend, flush_interval=0)
+    store.cache_set('a', 1, 60)
+    deadline = time.monotonic() + 5
+    while not backend.batches and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert backend.batches == [({'a': 1}, 60)]
+    store.close()
+
+
+def test_write_behind_drops_writes_over_limit():
+    backend = RecordingStore()
+    store = WriteBehindStore(backend, max_pending=2, flush_interval=0.5)
+    store.cache_set_many({'a': 1, 'b': 2, 'c': 3}, 60)
+    store.cache_set('a', 4, 60)
+    assert store.pending == {'a': (4, 60), 'b': (2, 60)}
+    store.close()
+    assert backend.data == {'a': 4, 'b': 2}
+
+
+def test_write_behind_survives_store_errors():
+    backend = RecordingStore(fail=True)
+    store = WriteBehindStore(backend, flush_interval=0)
+    store.cache_set('a', 1, 60)
+    store.flush()
+    backend.fail = False
+    store.cache_set('b', 2, 60)
+    store.close()
+    assert backend.data == {'b': 2}
+
+
+def test_memory_store_behaves_like_redis():
+    clock = Mock(return_value=0)
+    store = MemoryStore(clock=clock)
+    store.cache_set_many({'a': 1.5, 'b': 'x'}, 10)
+    store.set_many({'c': b'["cars"]'})
+    assert store.get_many(['a', 'b', 'c', 'd']) == [b'1.5', b'x', b'["cars"]', None]
+    assert store.acquire_lock('lock', 't1', 5) and not store.acquire_lock('lock', 't2', 5)
+    store.release_lock('lock', 't2')
+    assert store.get('lock') == b't1'
+    clock.return_value = 10
+    assert store.get_many(['a', 'c', 'lock']) == [None, b'["cars"]', None]
+
+
+class Replica(MemoryStore):
+    def __init__(self, data=None, delay=0, down=False, error=redis.ConnectionError):
+        super().__init__()
+        self.data.update(data or {})
+        self.delay = delay
+        self.down = down
+        self.error = error
+        self.reads = 0
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        self.reads += 1
+        if self.down:
+            raise self.error()
+        time.sleep(self.delay)
+        return super().get_many(keys)
+
+
+def test_replica_routing_reads_replicas_and_writes_primary():
+    primary, replica = MemoryStore(), Replica({'i:1': b'["replica"]'})
+    store = ReplicaRoutedStore(primary, [replica])
+    assert store.get('i:1') == b'["replica"]'
+    assert store.get_many(['i:1', 'i:2']) == [b'["replica"]', None]
+    store.cache_set('uid:1', 1.5, 60)
+    assert primary.data == {'uid:1': b'1.5'}
+    assert replica.reads == 2
+
+
+def test_replica_routing_prefers_faster_replicas():
+    fast, slow = Replica(), Replica(delay=0.01)
+    store = ReplicaRoutedStore(MemoryStore(), [fast, slow], rand=random.Random(0).random)
+    for _ in range(200):
+        store.get('i:1')
+    assert slow.reads >= 1
+    assert fast.reads > slow.reads * 5
+
+
+def test_replica_routing_falls_back_to_primary():
+    clock = Mock(return_value=0)
+    primary = MemoryStore()
+    primary.set_many({'i:1': b'["primary"]'})
+    broken, healthy = Replica(down=True), Replica({'i:1': b'["replica"]'})
+    store = ReplicaRoutedStore(primary, [broken, healthy], cooldown=5, clock=clock)
+    assert store.get('i:1') == b'["primary"]'
+    assert [store.get('i:1') for _ in range(10)] == [b'["replica"]'] * 10
+    assert broken.reads == 1
+    healthy.down = True
+    assert store.get('i:1') == b'["primary"]'
+    assert store.choose() is None
+    assert store.get('i:1') == b'["primary"]'
+    clock.return_value = 5
+    broken.down = healthy.down = False
+    assert store.choose() is not None
+
+
+def test_replica_routing_falls_back_on_timeout():
+    primary = MemoryStore()
+    primary.set_many({'i:1': b'["primary"]'})
+    replica = Replica({'i:1': b'["replica"]'}, down=True, error=redis.TimeoutError)
+    store = ReplicaRoutedStore(primary, [replica], clock=Mock(return_value=0))
+    assert store.get('i:1') == b'["primary"]'
+    assert store.choose() is None
@@ -1,6 +1,13 @@
+import json
+import time
+import threading
+
 import pytest
+import redis
+from mock import patch
 
-from utils import check_pairs
+from utils import check_pairs, redis_retry, RetryPolicy, CircuitBreaker, SingleFlight, StreamedResponse, stream_response
+from exceptions import CircuitOpenError
 from api import OnlineScoreRequest
 
 
@@ -49,4 +56,148 @@ def test_check_pairs_not_ok(phone, email, first_name, last_name, gender, birthda
         gender=gender,
         birthday=birthday
     )
-    assert not check_pairs(user_info)
\ No newline at end of file
+    assert not check_pairs(user_info)
+
+
+class FlakyStore:
+    def __init__(self, failures, retry_policy, circuit_breaker=None, error=redis.ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+
+    @redis_retry
+    def get(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error()
+        return 'value'
+
+
+def test_retry_policy_backoff_is_capped():
+    policy = RetryPolicy(base_delay=0.1, max_delay=0.3, jitter=0)
+    assert [policy.delay(attempt) for attempt in range(4)] == [0.1, 0.2, 0.3, 0.3]
+
+
+def test_retry_policy_jitter_stays_below_delay():
+    policy = RetryPolicy(base_delay=1, max_delay=1, jitter=0.5)
+    assert all(0.5 <= policy.delay(0) <= 1 for _ in range(100))
+
+
+def test_retry_policy_respects_budget():
+    policy = RetryPolicy(max_retries=10, base_delay=1, max_delay=5, jitter=0, budget=1.5)
+    with patch('utils.time.monotonic', return_value=100):
+        assert policy.next_delay(0, started=100) == 1
+        assert policy.next_delay(1, started=100) is None
+        assert policy.next_delay(10, started=100) is None
+
+
+@patch('utils.time.sleep')
+def test_redis_retry_recovers(sleep):
+    store = FlakyStore(2, RetryPolicy(max_retries=3, jitter=0, budget=10))
+    assert store.get() == 'value'
+    assert store.calls == 3
+    assert sleep.call_count == 2
+
+
+@patch('utils.time.sleep')
+def test_redis_retry_gives_up(sleep):
+    store = FlakyStore(10, RetryPolicy(max_retries=3, jitter=0, budget=10))
+    with pytest.raises(redis.ConnectionError):
+        store.get()
+    assert store.calls == 4
+
+
+def test_circuit_breaker_fails_fast_and_recovers():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=5)
+    store = FlakyStore(2, RetryPolicy(max_retries=0), breaker)
+    for _ in range(2):
+        with pytest.raises(redis.ConnectionError):
+            store.get()
+    with pytest.raises(CircuitOpenError):
+        store.get()
+    assert store.calls == 2
+    with patch('utils.time.monotonic', return_value=breaker._opened_at + 6):
+        assert store.get() == 'value'
+    assert not breaker.is_open
+
+
+def test_circuit_breaker_reopens_after_failed_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    with patch('utils.time.monotonic', return_value=breaker._opened_at + 6):
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.record_failure()
+        assert not breaker.allow()
+
+
+@pytest.mark.parametrize('error, reopens', [(redis.TimeoutError, True), (redis.ResponseError, False)])
+def test_circuit_breaker_probe_ends_on_any_error(error, reopens):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    store = FlakyStore(1, RetryPolicy(max_retries=0), breaker, error)
+    with patch('utils.time.monotonic', return_value=breaker._opened_at + 6):
+        with pytest.raises(error):
+            store.get()
+        assert breaker.is_open
+        assert breaker.allow() is not reopens
+
+
+def test_single_flight_shares_result_of_running_call():
+    flight, started, release = SingleFlight(), threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 42
+
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert len(calls) == 1
+    assert sorted(results) == [(42, False), (42, True)]
+    assert flight.do('key', lambda: 7) == (7, False)
+
+
+def test_single_flight_shares_errors():
+    flight, started, release = SingleFlight(), threading.Event(), threading.Event()
+    errors = []
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError('boom')
+
+    def call():
+        try:
+            flight.do('key', fail)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert errors == ['boom', 'boom']
+
+
+def test_stream_response_encodes_chunks_as_one_object():
+    response = StreamedResponse(iter([{1: ['cars']}, {}, {2: [], 3: ['pets']}]))
+    pieces = list(stream_response(response, 200))
+    assert json.loads(b''.join(pieces)) == {'response': {'1': ['cars'], '2': [], '3': ['pets']}, 'code': 200}
+    assert json.loads(b''.join(stream_response(StreamedResponse(iter([])), 200))) == {'response': {}, 'code': 200}
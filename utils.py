@@ -1,10 +1,15 @@
 import time
+import random
+import asyncio
 import logging
+import functools
+import threading
 import redis
 
-
-def alt_name(name):
-    return '_' + name
+import codec
+from constants import ERRORS
+from exceptions import CircuitOpenError
+from metrics import REDIS_LATENCY, REDIS_RETRIES
 
 
 def prettify_dict(d):
@@ -18,17 +23,245 @@ def check_pairs(user_info):
     return True
 
 
+def build_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+class StreamedResponse:
+    """
+    Successful response produced while it is written: `chunks` yields
+    dicts that together make up the response object.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+
+def stream_response(response, code):
+    """
+    Encodes a StreamedResponse like `build_response` would, one piece per chunk.
+    """
+    yield b'{"response":{'
+    first = True
+    for chunk in response.chunks:
+        if not chunk:
+            continue
+        encoded = codec.dumps(chunk)[1:-1]
+        yield encoded if first else b',' + encoded
+        first = False
+    yield b'},"code":%d}' % code
+
+
+def request_method(path, router, ctx):
+    """
+    Metrics label of a served request: the method name for method calls,
+    the route for other known routes.
+    """
+    if path not in router:
+        return 'unknown'
+    return ctx.get('method', path)
+
+
+class RetryPolicy:
+    """
+    Capped exponential backoff with jitter. `budget` bounds the total time
+    one call may spend on retries, so a Redis outage cannot stall a request
+    for longer than that.
+    """
+    def __init__(self, max_retries=3, base_delay=0.05, max_delay=1, jitter=0.5, budget=2):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budget = budget
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def next_delay(self, attempt, started):
+        """
+        Returns how long to wait before retry number `attempt` or None
+        if the call must give up.
+        """
+        if attempt >= self.max_retries:
+            return None
+        delay = self.delay(attempt)
+        if time.monotonic() - started + delay > self.budget:
+            return None
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Shared between all calls of a store. Opens after `failure_threshold`
+    consecutive connection failures or timeouts and fails fast until
+    `reset_timeout` passes, then lets a single probe call through to check
+    Redis again. A probe failing with any other error is not counted, the
+    next call becomes the probe.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                self._failures = 0
+                self._opened_at = None
+                self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logging.error('Redis circuit breaker is open')
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def end_probe(self):
+        if self._probing:
+            with self._lock:
+                self._probing = False
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function and the callers arriving meanwhile wait for its result or error.
+    `do` returns the result and whether it was shared from another call.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+        try:
+            call['result'] = func()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result'], False
+
+
+def _check_circuit(breaker):
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpenError('Redis is unavailable, circuit breaker is open')
+
+
+def _record_error(breaker, error):
+    if breaker is None:
+        return
+    if isinstance(error, redis.TimeoutError):
+        breaker.record_failure()
+    else:
+        breaker.end_probe()
+
+
+def _retry_delay(self, operation, attempt, started):
+    breaker = self.circuit_breaker
+    if breaker is not None:
+        breaker.record_failure()
+        if breaker.is_open:
+            return None
+    delay = self.retry_policy.next_delay(attempt, started)
+    if delay is not None:
+        REDIS_RETRIES.inc((operation,))
+        logging.warning('Cannot connect to Redis. Trying again in %.2f seconds...', delay)
+    return delay
+
+
 def redis_retry(func):
+    """
+    Retries store calls failed with redis.ConnectionError following the
+    store's `retry_policy` and reports outcomes to its `circuit_breaker`.
+    Other errors are raised at once; timeouts count as breaker failures.
+    """
+    @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
-        count = 0
-        while True:
-            try:
-                return func(self, *args, **kwargs)
-            except redis.ConnectionError:
-                logging.warning('Cannot connect to localhost:6379. Trying again in 2 seconds...')
-                count += 1
-                if count > self.max_retry_count:
+        _check_circuit(self.circuit_breaker)
+        started, attempt = time.monotonic(), 0
+        try:
+            while True:
+                try:
+                    result = func(self, *args, **kwargs)
+                except redis.ConnectionError:
+                    delay = _retry_delay(self, func.__name__, attempt, started)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    time.sleep(delay)
+                except Exception as e:
+                    _record_error(self.circuit_breaker, e)
+                    raise
+                else:
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record_success()
+                    return result
+        finally:
+            REDIS_LATENCY.observe(time.monotonic() - started, (func.__name__,))
+
+    return wrapper
+
+
+def async_redis_retry(func):
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        _check_circuit(self.circuit_breaker)
+        started, attempt = time.monotonic(), 0
+        try:
+            while True:
+                try:
+                    result = await func(self, *args, **kwargs)
+                except redis.ConnectionError:
+                    delay = _retry_delay(self, func.__name__, attempt, started)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                except Exception as e:
+                    _record_error(self.circuit_breaker, e)
                     raise
-                time.sleep(self.retry_delay)
+                else:
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record_success()
+                    return result
+        finally:
+            REDIS_LATENCY.observe(time.monotonic() - started, (func.__name__,))
 
     return wrapper